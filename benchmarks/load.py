@@ -0,0 +1,258 @@
+"""Нагрузочный тест обработчиков бота без сети и Telegram.
+
+Синтетические обновления (настоящие объекты telegram.Update и CallbackQuery)
+проходят через обработчики бота и ChatOrderedUpdateProcessor, а ответы
+уходят в StubBot, который только запоминает вызовы Bot API. Каждый личный
+чат проходит /start -> опросник -> 25 раундов битвы, каждая группа -
+/battle -> групповой опросник всех участников -> групповую битву. Все чаты
+работают одновременно на временной базе users.db.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.load --chats 200 --groups 50
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from collections import Counter
+from datetime import datetime, timezone
+
+# Без ключа TMDb бот берет фильмы из встроенного списка; паузы между раундами
+# и таймаут раунда не нужны, иначе тест измерял бы таймеры, а не обработчики
+os.environ['TMDB_API_KEY'] = ''
+os.environ.setdefault('ROUND_TRANSITION_DELAY', '0')
+os.environ.setdefault('ROUND_TIMEOUT', '0')
+
+from telegram import Update, Message, CallbackQuery, Chat, User
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+SURVEY_STEPS = ('survey_genre_comedy', 'survey_genres_done', 'survey_type_movie', 'survey_year_all')
+GROUP_SURVEY_STEPS = ('start_my_survey', 'group_survey_genre_comedy', 'group_survey_genres_done',
+                      'group_survey_type_movie', 'group_survey_year_all')
+
+class StubBot:
+    """Заглушка Bot API: запоминает вызовы и последнее сообщение с кнопками в каждом чате"""
+
+    def __init__(self, members: int):
+        self.members = members
+        self.calls = Counter()
+        self.screens = {}  # chat_id -> (message_id, reply_markup)
+        self._message_ids = itertools.count(1)
+
+    def _message(self, chat_id: int, message_id: int, text: str, reply_markup):
+        """Сообщение, которое вернул бы Telegram"""
+        chat = Chat(chat_id, Chat.PRIVATE if chat_id > 0 else Chat.GROUP)
+        message = Message(message_id, datetime.now(timezone.utc), chat, text=text, reply_markup=reply_markup)
+        message.set_bot(self)
+        if reply_markup is not None:
+            self.screens[chat_id] = (message_id, reply_markup)
+        return message
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.calls['sendMessage'] += 1
+        return self._message(chat_id, next(self._message_ids), text, reply_markup)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        self.calls['editMessageText'] += 1
+        return self._message(chat_id, message_id, text, reply_markup)
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.calls['answerCallbackQuery'] += 1
+        return True
+
+    async def get_chat_member_count(self, chat_id, **kwargs):
+        self.calls['getChatMemberCount'] += 1
+        return self.members
+
+    def buttons(self, chat_id: int, prefix: str):
+        """callback_data кнопок последнего сообщения чата, начинающиеся с prefix"""
+        message_id, markup = self.screens.get(chat_id, (None, None))
+        if markup is None:
+            return message_id, []
+        return message_id, [b.callback_data for row in markup.inline_keyboard for b in row
+                            if b.callback_data.startswith(prefix)]
+
+class StubContext:
+    """Минимальный контекст обработчика: бот, данные пользователя и чата, без JobQueue"""
+
+    def __init__(self, bot: StubBot, user_data: dict, chat_data: dict):
+        self.bot = bot
+        self.user_data = user_data
+        self.chat_data = chat_data
+        self.job_queue = None
+        self.application = None
+
+class LoadTest:
+    """Прогон сценариев с замером задержки каждого обработчика"""
+
+    def __init__(self, bot_module, members: int, concurrency: int):
+        self.bot_module = bot_module
+        self.bot = StubBot(members + 1)  # сам бот тоже участник группы
+        self.processor = bot_module.ChatOrderedUpdateProcessor(concurrency)
+        self.latencies = []
+        self.errors = 0
+        self.rounds = Counter()
+        self._user_data = {}
+        self._chat_data = {}
+        self._update_ids = itertools.count(1)
+
+    def _context(self, user: User, chat: Chat):
+        return StubContext(self.bot, self._user_data.setdefault(user.id, {}),
+                           self._chat_data.setdefault(chat.id, {}))
+
+    async def _dispatch(self, handler, update: Update, context):
+        """Обработка обновления тем же процессором, что и в приложении"""
+        async def timed():
+            started = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка обработчика: {e!r}")
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+        await self.processor.process_update(update, timed())
+
+    async def command(self, handler, user: User, chat: Chat, text: str):
+        """Команда, отправленная пользователем в чат"""
+        message = Message(next(self._update_ids), datetime.now(timezone.utc), chat, from_user=user, text=text)
+        message.set_bot(self.bot)
+        await self._dispatch(handler, Update(next(self._update_ids), message=message), self._context(user, chat))
+
+    async def press(self, user: User, chat: Chat, data: str, message_id: int = 1):
+        """Нажатие кнопки под сообщением бота"""
+        message = Message(message_id, datetime.now(timezone.utc), chat)
+        message.set_bot(self.bot)
+        update_id = next(self._update_ids)
+        query = CallbackQuery(str(update_id), user, str(chat.id), message=message, data=data)
+        query.set_bot(self.bot)
+        await self._dispatch(self.bot_module.button_handler, Update(update_id, callback_query=query),
+                             self._context(user, chat))
+
+    async def private_chat(self, index: int):
+        """Одиночная игра: /start, опросник и битва до победителя"""
+        user = User(index, f"Игрок {index}", False, username=f"player{index}")
+        chat = Chat(index, Chat.PRIVATE)
+        await self.command(self.bot_module.start, user, chat, '/start')
+        await self.press(user, chat, 'mode_single')
+        for data in SURVEY_STEPS:
+            await self.press(user, chat, data)
+        while True:
+            message_id, votes = self.bot.buttons(chat.id, 'vote_')
+            if not votes:
+                break
+            await self.press(user, chat, random.choice(votes), message_id)
+            self.rounds['single'] += 1
+
+    async def group_chat(self, index: int, members: int):
+        """Групповая игра: /battle, опросник каждого участника и раунды с голосованием"""
+        chat = Chat(-index, Chat.GROUP)
+        users = [User(10**6 + index * 100 + n, f"Участник {n}", False) for n in range(members)]
+        await self.command(self.bot_module.battle_command, users[0], chat, '/battle')
+        for user in users:
+            for data in GROUP_SURVEY_STEPS:
+                await self.press(user, chat, data)
+
+        open_rounds = self.bot_module.open_rounds
+        while True:
+            message_id, votes = self.bot.buttons(chat.id, 'vote_')
+            if not votes:
+                break
+            game_id = int(votes[0].rsplit('_', 1)[1])
+            for user in users:
+                await self.press(user, chat, random.choice(votes), message_id)
+            await self.press(users[0], chat, f"finish_round_{game_id}", message_id)
+            self.rounds['group'] += 1
+            # Следующий раунд запускается отложенным действием, а не обработчиком обновления
+            while open_rounds.get(game_id, False) is None:
+                await asyncio.sleep(0.001)
+            if game_id not in open_rounds:
+                break
+
+def percentile(values, fraction: float):
+    """Перцентиль по отсортированной выборке"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+async def run(args):
+    """Прогон всех чатов одновременно; возвращает отчет"""
+    import bot as bot_module
+
+    bot_module.init_database()
+    test = LoadTest(bot_module, args.members, args.concurrency)
+    store = storage.store
+    reads, writes, commits = store.reads, store.writes, store.commits
+
+    async def flush_votes():
+        # Замена периодической задачи flush_votes, которую обычно запускает JobQueue
+        while True:
+            await asyncio.sleep(bot_module.VOTE_FLUSH_INTERVAL)
+            await bot_module.vote_aggregator.flush()
+
+    flusher = asyncio.ensure_future(flush_votes())
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(test.private_chat(n) for n in range(1, args.chats + 1)),
+        *(test.group_chat(n, args.members) for n in range(1, args.groups + 1))
+    )
+    elapsed = time.perf_counter() - started
+    flusher.cancel()
+    await bot_module.vote_aggregator.flush()
+
+    updates = len(test.latencies)
+    return {
+        'chats': args.chats,
+        'groups': args.groups,
+        'members': args.members,
+        'updates': updates,
+        'errors': test.errors,
+        'rounds': dict(test.rounds),
+        'elapsed': elapsed,
+        'updates_per_sec': updates / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(test.latencies, 0.50) * 1000,
+        'p99_ms': percentile(test.latencies, 0.99) * 1000,
+        'db_reads_per_update': (store.reads - reads) / max(updates, 1),
+        'db_writes_per_update': (store.writes - writes) / max(updates, 1),
+        'db_commits': store.commits - commits,
+        'api_calls': dict(test.bot.calls)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chats', type=int, default=200, help='количество личных чатов с одиночной игрой')
+    parser.add_argument('--groups', type=int, default=50, help='количество групп с групповой битвой')
+    parser.add_argument('--members', type=int, default=3, help='участников в каждой группе')
+    parser.add_argument('--concurrency', type=int, default=16, help='обновлений в обработке одновременно')
+    parser.add_argument('--seed', type=int, default=0, help='зерно выбора голосов')
+    parser.add_argument('--database', help='путь к базе данных (по умолчанию временный файл)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        storage.configure_database(args.database or os.path.join(directory, 'users.db'))
+        report = asyncio.run(run(args))
+        storage.store.close()
+
+    print(f"Чатов: {report['chats']} личных, {report['groups']} групп по {report['members']} участника")
+    print(f"Раундов: {report['rounds']}, ошибок обработчиков: {report['errors']}")
+    print(f"Обновлений: {report['updates']} за {report['elapsed']:.2f} с ({report['updates_per_sec']:.0f}/с)")
+    print(f"Задержка обработчика: p50 {report['p50_ms']:.2f} мс, p99 {report['p99_ms']:.2f} мс")
+    print(f"База данных на обновление: {report['db_reads_per_update']:.2f} чтений, "
+          f"{report['db_writes_per_update']:.2f} записей; транзакций {report['db_commits']}")
+    print(f"Вызовы Bot API: {report['api_calls']}")
+    return 1 if report['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
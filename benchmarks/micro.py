@@ -0,0 +1,179 @@
+"""Микробенчмарки функций на горячем пути обработки голосов.
+
+Каждая функция замеряется отдельно на временной базе с реалистичным объемом
+данных: тысячи завершенных игр с сетками на 26 фильмов, опросники группы и
+временные данные опросников. Результаты сохраняются в JSON вместе с
+коммитом, чтобы сравнивать их между версиями:
+
+    python -m benchmarks.micro --output before.json
+    python -m benchmarks.micro --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+import storage
+from bracket import Bracket
+from rendering import format_movie_battle, format_battle_result, RoundView
+
+MOVIES_PER_GAME = 26
+OVERVIEW = ("Бывший агент спецслужб возвращается в родной город, чтобы разобраться с прошлым, "
+            "но старые враги находят его раньше, чем он успевает исчезнуть снова. ") * 4
+
+def git_commit():
+    """Текущий коммит репозитория или None вне git"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def make_movie(key: int):
+    """Фильм в формате каталога с описанием обычной длины"""
+    return {'id': key, 'title': f"Фильм номер {key}: возвращение", 'overview': OVERVIEW,
+            'release_date': '2015-06-01', 'vote_average': 7.4, 'poster_path': f"/poster{key}.jpg"}
+
+def populate(games: int, members: int):
+    """Заполнение базы историческими играми и опросниками; возвращает идентификаторы"""
+    game_ids = []
+    with storage.db.connection():
+        for n in range(games):
+            keys = random.sample(range(1, 10000), MOVIES_PER_GAME)
+            chat_id = -(n % 500) - 1 if n % 4 == 0 else n % 2000 + 1
+            game_type = 'group' if chat_id < 0 else 'single'
+            game_ids.append(storage.create_game(n % 2000 + 1, chat_id, game_type, Bracket(keys)))
+        for game_id in game_ids[:-100]:
+            storage.finish_game(game_id)
+
+        # Опросники: одна большая группа для замера и много других групп
+        for user_id in range(1, members + 1):
+            storage.save_survey_data(user_id, -1, random.sample(['28', '35', '18', '878', '27'], 3), 'movie', 'all')
+        for chat_id in range(2, 500):
+            for user_id in range(1, 4):
+                storage.save_survey_data(user_id, -chat_id, ['35'], 'movie', '2010s')
+        for user_id in range(1, 2000):
+            storage.save_user_survey_temp_data(user_id, -(user_id % 500) - 1, ['35', '18'])
+    return game_ids
+
+def benchmarks(game_ids: list):
+    """Замеряемые функции: имя -> вызов без аргументов"""
+    ids = itertools.cycle(random.sample(game_ids, len(game_ids)))
+    users = itertools.cycle(range(1, 2000))
+    genres = itertools.cycle([['35'], ['35', '18'], ['35', '18', '28']])
+    movies = [make_movie(key) for key in range(1, MOVIES_PER_GAME + 1)]
+    rounds = itertools.count(1)
+
+    # Цикл сетки из process_vote: строка games -> Bracket -> advance -> JSON для save_game_bracket
+    game = list(storage.get_current_game_by_id(game_ids[-1]))
+    start = game[4]
+
+    def bracket_round():
+        bracket = storage.load_game_bracket(game)
+        bracket.advance(random.randint(0, 1))
+        game[4] = start if bracket.finished else json.dumps(bracket.to_list())
+
+    view = RoundView(1, 1, MOVIES_PER_GAME - 1, movies[0], movies[1])
+
+    return {
+        'get_current_game_by_id': lambda: storage.get_current_game_by_id(next(ids)),
+        'update_game_round': lambda: storage.update_game_round(next(ids), next(rounds) % 25 + 1, '[1, 2]'),
+        'save_user_survey_temp_data': lambda: storage.save_user_survey_temp_data(next(users), -1, next(genres)),
+        'get_group_survey_data': lambda: storage.get_group_survey_data(-1),
+        'bracket_round': bracket_round,
+        'format_movie_battle': lambda: format_movie_battle(movies[0], movies[1], 12, MOVIES_PER_GAME - 1),
+        'format_battle_result': lambda: format_battle_result(movies[0], 'group'),
+        'round_view_tally': lambda: view.tally("Участник", [3, 2], 5, 8)
+    }
+
+def measure(func, repeat: int, min_time: float):
+    """Время одного вызова в микросекундах: лучшее и медиана по повторам"""
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    times = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {'best_us': min(times), 'median_us': statistics.median(times), 'loops': number, 'repeat': repeat}
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Сравнение с сохраненными результатами; возвращает имена замедлившихся функций"""
+    regressions = []
+    print(f"Сравнение с {baseline.get('commit') or 'базовыми результатами'}:")
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"  {name:28} новый замер")
+            continue
+        change = result['best_us'] / before['best_us'] - 1
+        mark = ''
+        if change > threshold:
+            regressions.append(name)
+            mark = '  <- медленнее'
+        print(f"  {name:28} {before['best_us']:10.2f} -> {result['best_us']:10.2f} мкс ({change:+.1%}){mark}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--games', type=int, default=5000, help='исторических игр в базе данных')
+    parser.add_argument('--members', type=int, default=10, help='участников группы в get_group_survey_data')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого замера')
+    parser.add_argument('--min-time', type=float, default=0.2, help='минимальная длительность одного повтора, с')
+    parser.add_argument('--only', nargs='*', help='замерять только эти функции')
+    parser.add_argument('--output', help='куда сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с результатами предыдущего запуска')
+    parser.add_argument('--threshold', type=float, default=0.10, help='допустимое замедление при сравнении')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # Функции хранилища логируют каждый вызов, в замер это попадать не должно
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('storage').setLevel(logging.WARNING)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage.configure_database(os.path.join(directory, 'users.db'))
+        storage.init_database()
+        started = time.perf_counter()
+        game_ids = populate(args.games, args.members)
+        print(f"База данных: {args.games} игр за {time.perf_counter() - started:.1f} с")
+
+        results = {}
+        for name, func in benchmarks(game_ids).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = measure(func, args.repeat, args.min_time)
+            print(f"  {name:28} {results[name]['best_us']:10.2f} мкс (медиана {results[name]['median_us']:.2f})")
+        storage.db.close()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': storage.sqlite3.sqlite_version,
+        'params': {'games': args.games, 'members': args.members, 'movies_per_game': MOVIES_PER_GAME},
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
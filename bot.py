@@ -1,17 +1,33 @@
 import os
+import asyncio
 import logging
-import sqlite3
-import requests
 import random
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ContextTypes
 from dotenv import load_dotenv
 import time
 
 # Загружаем переменные окружения
 load_dotenv()
 
+from cache import TTLCache
+from catalog import MovieCatalog, normalize_movie
+from bracket import Bracket, BRACKET_MODES
+from tmdb import TMDbClient, TMDbError, TMDB_BASE_URL
+from messaging import EditCoalescer
+from votes import VoteAggregator, VOTE_FLUSH_INTERVAL, DURABILITY_INTERVAL
+from scheduler import RoundScheduler
+from processing import ChatOrderedUpdateProcessor, UPDATE_CONCURRENCY, UPDATE_MAX_PENDING
+from maintenance import run_maintenance, MAINTENANCE_INTERVAL
+from metrics import instrument_handler, InstrumentedRequest, start_metrics_server, METRICS_HOST, METRICS_PORT
+from profiling import Profiler, PROFILE_ADMINS, PROFILE_DURATION, PROFILE_MAX_DURATION, PROFILE_ON_START
+from loop_watchdog import LoopWatchdog, LOOP_WATCHDOG_THRESHOLD
+from rendering import BattleRenderer, fit_message, format_battle_result
+from storage import (
+    init_database, save_user_state, load_game_bracket, store, GAME_SURVEYING, GAME_RUNNING, GAME_FINISHED
+)
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -22,7 +38,60 @@ logger = logging.getLogger(__name__)
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 TMDB_API_KEY = os.getenv('TMDB_API_KEY')
-TMDB_BASE_URL = "https://api.themoviedb.org/3"
+
+# Общий клиент TMDb с пулом соединений
+tmdb_client = TMDbClient(TMDB_API_KEY, TMDB_BASE_URL)
+
+# Постраничная выдача /discover
+TMDB_PAGE_SIZE = 20
+TMDB_MAX_DISCOVER_PAGES = int(os.getenv('TMDB_MAX_DISCOVER_PAGES', '5'))
+
+# Кэш результатов /discover по нормализованному запросу (жанры, тип контента, годы)
+TMDB_CACHE_TTL = float(os.getenv('TMDB_CACHE_TTL', '3600'))
+TMDB_CACHE_SIZE = int(os.getenv('TMDB_CACHE_SIZE', '128'))
+discover_cache = TTLCache(maxsize=TMDB_CACHE_SIZE, ttl=TMDB_CACHE_TTL)
+
+# Локальный каталог фильмов, сохраняемый между перезапусками
+movie_catalog = MovieCatalog()
+CATALOG_REFRESH_INTERVAL = float(os.getenv('CATALOG_REFRESH_INTERVAL', '1800'))
+CATALOG_REFRESH_BATCH = int(os.getenv('CATALOG_REFRESH_BATCH', '5'))
+
+# Кэш количества участников чатов
+MEMBER_COUNT_TTL = float(os.getenv('MEMBER_COUNT_TTL', '300'))
+member_count_cache = TTLCache(maxsize=10000, ttl=MEMBER_COUNT_TTL)
+member_count_requests = {}
+
+# Объединение частых правок сообщения с результатами голосования
+edit_coalescer = EditCoalescer()
+
+# Голоса текущих раундов в памяти с отложенной записью в базу данных
+vote_aggregator = VoteAggregator()
+
+# Переходы между раундами и таймауты раундов групповых битв
+ROUND_TRANSITION_DELAY = float(os.getenv('ROUND_TRANSITION_DELAY', '3'))
+ROUND_TIMEOUT = float(os.getenv('ROUND_TIMEOUT', '120'))
+round_scheduler = RoundScheduler()
+open_rounds = {}  # game_id -> раунд, принимающий голоса (None во время перехода к следующему)
+
+# Отрисованные раунды: текст битвы, описания и кнопки строятся один раз на раунд
+battle_renderer = BattleRenderer()
+
+# HTTP-эндпоинт с метриками (запускается, если задан METRICS_PORT)
+metrics_server = None
+
+# Профилирование по команде /profile или на старте (PROFILE_ON_START)
+profiler = Profiler()
+
+# Сторож цикла событий: стек синхронного вызова, надолго занявшего цикл
+loop_watchdog = LoopWatchdog()
+
+# Указатели на текущие игры групп: chat_id -> (game_id, статус) или None, если игры нет
+active_games = TTLCache(maxsize=10000, ttl=3600)
+
+# Режим турнирной сетки: single_elimination или king_of_the_hill
+BRACKET_MODE = os.getenv('BRACKET_MODE', 'single_elimination')
+if BRACKET_MODE not in BRACKET_MODES:
+    BRACKET_MODE = 'single_elimination'
 
 # Состояния игры
 GAME_STATES = {
@@ -61,422 +130,126 @@ YEAR_RANGES = {
     'all': {'name': 'Все года', 'min': 1900, 'max': 2025}
 }
 
-def init_database():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            current_state TEXT DEFAULT 'waiting_mode',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Проверяем, есть ли колонка current_state, если нет - добавляем
-    try:
-        cursor.execute('SELECT current_state FROM users LIMIT 1')
-    except sqlite3.OperationalError:
-        cursor.execute('ALTER TABLE users ADD COLUMN current_state TEXT DEFAULT "waiting_mode"')
-    
-    # Таблица игр
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS games (
-            game_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            chat_id INTEGER,
-            game_type TEXT,
-            movies_list TEXT,
-            current_round INTEGER DEFAULT 1,
-            total_rounds INTEGER,
-            current_pair TEXT,
-            votes TEXT,
-            survey_data TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
-    
-    # Таблица опросников
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS surveys (
-            survey_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            chat_id INTEGER,
-            selected_genres TEXT,
-            content_type TEXT,
-            year_range TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
-    
-    # Таблица временных данных опросников
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS survey_temp_data (
-            user_id INTEGER,
-            chat_id INTEGER,
-            selected_genres TEXT,
-            content_type TEXT,
-            year_range TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id, chat_id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-def save_user_state(user_id: int, state: str):
-    """Сохранение состояния пользователя"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, current_state) 
-        VALUES (?, ?)
-    ''', (user_id, state))
-    conn.commit()
-    conn.close()
-
-def get_user_state(user_id: int):
-    """Получение состояния пользователя"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT current_state FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else 'waiting_mode'
-
-def create_game(user_id: int, chat_id: int, game_type: str, movies_list: list):
-    """Создание новой игры"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # Сохраняем список фильмов как JSON строку
-    import json
-    movies_json = json.dumps(movies_list)
-    total_rounds = len(movies_list) - 1  # Количество раундов до победителя
-    
-    cursor.execute('''
-        INSERT INTO games (user_id, chat_id, game_type, movies_list, total_rounds)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, chat_id, game_type, movies_json, total_rounds))
-    
-    game_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return game_id
-
-def get_current_game(user_id: int, chat_id: int):
-    """Получение текущей игры"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM games 
-        WHERE user_id = ? AND chat_id = ? 
-        ORDER BY created_at DESC LIMIT 1
-    ''', (user_id, chat_id))
-    result = cursor.fetchone()
-    conn.close()
-    return result
-
-def update_game_round(game_id: int, current_round: int, current_pair: str, votes: str = None):
-    """Обновление раунда игры"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    if votes:
-        cursor.execute('''
-            UPDATE games 
-            SET current_round = ?, current_pair = ?, votes = ?
-            WHERE game_id = ?
-        ''', (current_round, current_pair, votes, game_id))
-    else:
-        cursor.execute('''
-            UPDATE games 
-            SET current_round = ?, current_pair = ?
-            WHERE game_id = ?
-        ''', (current_round, current_pair, game_id))
-    
-    conn.commit()
-    conn.close()
-
-def increment_game_round(game_id: int):
-    """Увеличение номера раунда"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE games 
-        SET current_round = current_round + 1
-        WHERE game_id = ?
-    ''', (game_id,))
-    
-    conn.commit()
-    conn.close()
-
-def save_survey_data(user_id: int, chat_id: int, selected_genres: list, content_type: str, year_range: str):
-    """Сохранение данных опросника"""
-    import json
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    genres_json = json.dumps(selected_genres)
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO surveys (user_id, chat_id, selected_genres, content_type, year_range)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, chat_id, genres_json, content_type, year_range))
-    
-    conn.commit()
-    conn.close()
-
-def get_survey_data(user_id: int, chat_id: int):
-    """Получение данных опросника"""
-    import json
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT selected_genres, content_type, year_range 
-        FROM surveys 
-        WHERE user_id = ? AND chat_id = ?
-        ORDER BY created_at DESC LIMIT 1
-    ''', (user_id, chat_id))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'selected_genres': json.loads(result[0]),
-            'content_type': result[1],
-            'year_range': result[2]
-        }
-    return None
-
-def get_active_group_game(chat_id: int):
-    """Получение активной игры в группе"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM games 
-        WHERE chat_id = ? AND game_type = 'group'
-        ORDER BY created_at DESC LIMIT 1
-    ''', (chat_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    return result
-
-def get_group_survey_data(chat_id: int):
-    """Получает объединенные данные всех завершенных опросников для данного группового чата."""
-    logger.info(f"Получение данных опросника для чата {chat_id}")
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, selected_genres, content_type, year_range FROM surveys WHERE chat_id = ?', (chat_id,))
-    results = cursor.fetchall()
-    conn.close()
-    
-    logger.info(f"Найдено {len(results)} завершенных опросников для чата {chat_id}")
-    
-    if not results:
-        logger.warning(f"Нет завершенных опросников для чата {chat_id}")
-        return None
-    
-    # Объединяем данные всех участников
-    all_genres = set()
-    content_types = {}
-    year_ranges = {}
-    
-    for row in results:
-        user_id = row[0]
-        genres = json.loads(row[1])
-        content_type = row[2]
-        year_range = row[3]
-        
-        # Добавляем жанры
-        all_genres.update(genres)
-        
-        # Подсчитываем типы контента
-        content_types[content_type] = content_types.get(content_type, 0) + 1
+def survey_cache_key(selected_genres: list, content_type: str, year_range: str):
+    """Нормализованный ключ запроса: порядок и повторы жанров не влияют на результат"""
+    genre_ids = tuple(sorted({GENRES[genre]['id'] for genre in selected_genres or [] if genre in GENRES}))
+    media_type = 'tv' if content_type == 'tv' else 'movie'
+    year_range = year_range if year_range in YEAR_RANGES else 'all'
+    return genre_ids, media_type, year_range
+
+async def fetch_discover_pages(media_type: str, params: dict, count: int):
+    """Параллельная загрузка страниц /discover до заполнения сетки.
+    
+    Страницы запрашиваются волнами ровно по количеству недостающих фильмов,
+    записи дедуплицируются по id TMDb, загрузка прекращается, как только
+    сетка заполнена или выдача TMDb закончилась.
+    """
+    movies = {}
+    next_page = 1
+    total_pages = TMDB_MAX_DISCOVER_PAGES
+    
+    while len(movies) < count and next_page <= total_pages:
+        pages_needed = -(-(count - len(movies)) // TMDB_PAGE_SIZE)
+        last_page = min(next_page + pages_needed - 1, total_pages)
+        responses = await asyncio.gather(*(
+            tmdb_client.discover(media_type, page=page, **params)
+            for page in range(next_page, last_page + 1)
+        ))
+        next_page = last_page + 1
         
-        # Подсчитываем годы
-        year_ranges[year_range] = year_ranges.get(year_range, 0) + 1
+        for data in responses:
+            total_pages = min(total_pages, data.get('total_pages', total_pages))
+            for movie in data.get('results', []):
+                if movie['id'] not in movies:
+                    movies[movie['id']] = normalize_movie(movie, media_type)
     
-    # Выбираем наиболее популярные варианты
-    most_popular_content_type = max(content_types.items(), key=lambda x: x[1])[0]
-    most_popular_year_range = max(year_ranges.items(), key=lambda x: x[1])[0]
-    
-    result = {
-        'selected_genres': list(all_genres),
-        'content_type': most_popular_content_type,
-        'year_range': most_popular_year_range
+    return list(movies.values())
+
+async def fetch_survey_candidates(genre_ids: tuple, media_type: str, year_range: str, count: int = 26):
+    """Загрузка кандидатов для битвы из TMDb по нормализованному запросу"""
+    # Формируем параметры запроса
+    params = {
+        'sort_by': 'popularity.desc',
+        'include_adult': False
     }
     
-    logger.info(f"Агрегированные данные опросника для чата {chat_id}: {result}")
-    return result
-
-def save_user_survey_temp_data(user_id: int, chat_id: int, selected_genres: list = None, content_type: str = None, year_range: str = None):
-    """Сохранение временных данных опросника пользователя"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    # Получаем текущие данные
-    cursor.execute('''
-        SELECT selected_genres, content_type, year_range 
-        FROM survey_temp_data 
-        WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    
-    result = cursor.fetchone()
-    current_data = {
-        'selected_genres': json.loads(result[0]) if result and result[0] else [],
-        'content_type': result[1] if result else 'movie',
-        'year_range': result[2] if result else None
-    }
+    # Добавляем жанры
+    if genre_ids:
+        params['with_genres'] = ','.join(map(str, genre_ids))
     
-    # Обновляем только переданные данные
-    if selected_genres is not None:
-        current_data['selected_genres'] = selected_genres
-    if content_type is not None:
-        current_data['content_type'] = content_type
-    if year_range is not None:
-        current_data['year_range'] = year_range
+    # Добавляем годы (у сериалов фильтр идет по дате первого эфира)
+    year_config = YEAR_RANGES[year_range]
+    date_field = 'first_air_date' if media_type == 'tv' else 'primary_release_date'
+    params[f'{date_field}.gte'] = f"{year_config['min']}-01-01"
+    params[f'{date_field}.lte'] = f"{year_config['max']}-12-31"
     
-    # Сохраняем обновленные данные
-    cursor.execute('''
-        INSERT OR REPLACE INTO survey_temp_data (user_id, chat_id, selected_genres, content_type, year_range)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, chat_id, json.dumps(current_data['selected_genres']), current_data['content_type'], current_data['year_range']))
-    
-    conn.commit()
-    conn.close()
-    
-    return current_data
-
-def get_user_survey_temp_data(user_id: int, chat_id: int):
-    """Получение временных данных опросника пользователя"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT selected_genres, content_type, year_range 
-        FROM survey_temp_data 
-        WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'selected_genres': json.loads(result[0]) if result[0] else [],
-            'content_type': result[1] if result[1] else 'movie',
-            'year_range': result[2]
-        }
-    return {
-        'selected_genres': [],
-        'content_type': 'movie',
-        'year_range': None
-    }
+    movies = await fetch_discover_pages(media_type, params, count)
+    
+    # Добавляем популярные, только если выдача по жанрам исчерпана
+    if len(movies) < count:
+        popular_movies = await get_popular_movies(count * 2)
+        movies.extend(normalize_movie(movie, 'movie') for movie in popular_movies)
+    
+    return movies
+
+async def load_survey_candidates(key: tuple, count: int = 26):
+    """Кандидаты для битвы: из индекса или свежего сегмента каталога, иначе из TMDb с сохранением в каталог"""
+    # Если в каталоге уже достаточно подходящих записей, сетка собирается локально
+    genre_ids, media_type, year_range = key
+    year_config = YEAR_RANGES[year_range]
+    movies = movie_catalog.find(genre_ids, media_type, year_config['min'], year_config['max'])
+    if len(movies) >= count:
+        return movies
+    
+    movies = movie_catalog.get_segment(key)
+    if movies is not None:
+        return movies
+    
+    try:
+        movies = await fetch_survey_candidates(*key, count)
+    except TMDbError:
+        # TMDb недоступен - используем устаревший сегмент, если он есть
+        movies = movie_catalog.get_segment(key, allow_stale=True)
+        if not movies:
+            raise
+        logger.warning(f"TMDb недоступен, используем устаревший сегмент каталога {key}")
+        return movies
+    
+    await movie_catalog.store_segment(key, movies)
+    return movies
 
-def clear_user_survey_temp_data(user_id: int, chat_id: int):
-    """Очистка временных данных опросника пользователя"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        DELETE FROM survey_temp_data 
-        WHERE user_id = ? AND chat_id = ?
-    ''', (user_id, chat_id))
-    
-    conn.commit()
-    conn.close()
-
-def clear_old_surveys(chat_id: int):
-    """Очистка старых опросников для чата"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM surveys WHERE chat_id = ?', (chat_id,))
-    conn.commit()
-    conn.close()
-    logger.info(f"Очищены старые опросники для чата {chat_id}")
-
-def get_movies_by_survey(selected_genres: list, content_type: str, year_range: str, count: int = 26):
+async def get_movies_by_survey(selected_genres: list, content_type: str, year_range: str, count: int = 26):
     """Получение фильмов на основе опросника"""
     try:
         # Проверяем, есть ли валидный API ключ
         if TMDB_API_KEY and TMDB_API_KEY != "placeholder_until_domain_ready":
-            # Определяем endpoint в зависимости от типа контента
-            if content_type == 'tv':
-                url = f"{TMDB_BASE_URL}/discover/tv"
-            else:
-                url = f"{TMDB_BASE_URL}/discover/movie"
-            
-            # Формируем параметры запроса
-            params = {
-                'api_key': TMDB_API_KEY,
-                'language': 'ru-RU',
-                'sort_by': 'popularity.desc',
-                'include_adult': False,
-                'page': 1
-            }
-            
-            # Добавляем жанры
-            if selected_genres:
-                genre_ids = [GENRES[genre]['id'] for genre in selected_genres if genre in GENRES]
-                if genre_ids:
-                    params['with_genres'] = ','.join(map(str, genre_ids))
-            
-            # Добавляем годы
-            year_config = YEAR_RANGES.get(year_range, YEAR_RANGES['all'])
-            params['primary_release_date.gte'] = f"{year_config['min']}-01-01"
-            params['primary_release_date.lte'] = f"{year_config['max']}-12-31"
+            key = survey_cache_key(selected_genres, content_type, year_range)
             
-            response = requests.get(url, params=params)
-            response.raise_for_status()
+            # Повторные опросники с тем же результатом обслуживаем из кэша
+            movies = discover_cache.get(key)
+            if movies is None:
+                movies = await load_survey_candidates(key, count)
+                discover_cache.set(key, movies)
             
-            data = response.json()
-            movies = data.get('results', [])
-            
-            # Если фильмов недостаточно, добавляем популярные
-            if len(movies) < count:
-                popular_movies = get_popular_movies(count * 2)
-                movies.extend(popular_movies)
-            
-            # Перемешиваем и берем нужное количество
+            # Перемешиваем копию и берем нужное количество
+            movies = list(movies)
             random.shuffle(movies)
             return movies[:count]
         else:
             # Возвращаем заглушки фильмов
             return get_mock_popular_movies(count)
         
-    except requests.RequestException as e:
+    except TMDbError as e:
         logger.error(f"Ошибка при запросе к TMDb API: {e}")
         # Возвращаем заглушки при ошибке API
         return get_mock_popular_movies(count)
 
-def get_popular_movies(count: int = 26):
+async def get_popular_movies(count: int = 26):
     """Получение популярных фильмов для битвы"""
     try:
         # Проверяем, есть ли валидный API ключ
         if TMDB_API_KEY and TMDB_API_KEY != "placeholder_until_domain_ready":
-            url = f"{TMDB_BASE_URL}/movie/popular"
-            params = {
-                'api_key': TMDB_API_KEY,
-                'language': 'ru-RU',
-                'page': 1,
-                'include_adult': False
-            }
-            
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await tmdb_client.popular_movies(page=1)
             movies = data.get('results', [])
             
             # Перемешиваем и берем нужное количество
@@ -486,7 +259,7 @@ def get_popular_movies(count: int = 26):
             # Возвращаем заглушки фильмов
             return get_mock_popular_movies(count)
         
-    except requests.RequestException as e:
+    except TMDbError as e:
         logger.error(f"Ошибка при запросе к TMDb API: {e}")
         # Возвращаем заглушки при ошибке API
         return get_mock_popular_movies(count)
@@ -654,102 +427,12 @@ def get_mock_popular_movies(count: int = 26):
     
     # Перемешиваем и берем нужное количество
     random.shuffle(mock_movies)
-    return mock_movies[:count]
-
-def format_movie_battle(movie1: dict, movie2: dict, round_num: int, total_rounds: int):
-    """Форматирование сообщения для битвы фильмов"""
-    message = f"⚔️ РАУНД {round_num}/{total_rounds}\n\n"
-    message += "Выбирай лучший фильм:\n\n"
-    
-    # Фильм 1
-    title1 = movie1.get('title', 'Без названия')
-    overview1 = movie1.get('overview', 'Описание отсутствует')
-    
-    message += f"🎬 {title1}\n"
-    message += f"📝 {overview1}\n\n"
-    
-    # Фильм 2
-    title2 = movie2.get('title', 'Без названия')
-    overview2 = movie2.get('overview', 'Описание отсутствует')
-    
-    message += f"🎬 {title2}\n"
-    message += f"📝 {overview2}\n\n"
-    
-    message += "Кто победит в этом раунде?"
-    
-    return message
-
-def format_battle_result(winner: dict, game_type: str):
-    """Форматирование результата битвы"""
-    title = winner.get('title', 'Без названия')
-    overview = winner.get('overview', 'Описание отсутствует')
-    
-    if len(overview) > 150:
-        overview = overview[:147] + "..."
-    
-    message = f"🏆 ПОБЕДИТЕЛЬ!\n\n"
-    message += f"🎬 {title}\n"
-    message += f"📝 {overview}\n\n"
-    
-    # Реферальные ссылки
-    streaming_links = {
-        'США': {
-            'Netflix': "https://netflix.com",
-            'Hulu': "https://hulu.com",
-            'Amazon Prime': "https://amazon.com/primevideo"
-        },
-        'ЕС': {
-            'Netflix': "https://netflix.com",
-            'Disney+': "https://disneyplus.com",
-            'HBO Max': "https://hbomax.com"
-        },
-        'СНГ': {
-            'Кинопоиск': "https://kinopoisk.ru",
-            'Okko': "https://okko.tv",
-            'Ivi': "https://ivi.ru"
-        }
-    }
-    
-    # Выбираем несколько сервисов
-    import random
-    all_services = []
-    for region, services in streaming_links.items():
-        for service, link in services.items():
-            all_services.append((service, link, region))
-    
-    num_services = random.randint(2, 3)
-    selected_services = random.sample(all_services, min(num_services, len(all_services)))
-    
-    message += "🎥 Где посмотреть:\n"
-    for service, link, region in selected_services:
-        message += f"• Смотреть на {service} ({region}): {link}\n"
-    
-    return message
-
-def get_streaming_links():
-    """Получение списка стриминговых сервисов"""
-    return {
-        'США': {
-            'Netflix': "https://netflix.com",
-            'Hulu': "https://hulu.com",
-            'Amazon Prime': "https://amazon.com/primevideo"
-        },
-        'ЕС': {
-            'Netflix': "https://netflix.com",
-            'Disney+': "https://disneyplus.com",
-            'HBO Max': "https://hbomax.com"
-        },
-        'СНГ': {
-            'Кинопоиск': "https://kinopoisk.ru",
-            'Okko': "https://okko.tv",
-            'Ivi': "https://ivi.ru"
-        }
-    }
+    return [normalize_movie(movie, 'mock') for movie in mock_movies[:count]]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
-    save_user_state(user_id, GAME_STATES['WAITING_MODE'])
+    await store.save_user_state(user_id, GAME_STATES['WAITING_MODE'])
     
     keyboard = [
         [InlineKeyboardButton("🎮 Играть одному", callback_data="mode_single")],
@@ -765,6 +448,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+async def get_active_game(chat_id: int):
+    """Текущая игра группы (game_id, статус) или None; база данных читается только при промахе кэша"""
+    pointer = active_games.get(chat_id, False)
+    if pointer is False:
+        pointer = await store.get_chat_active_game(chat_id)
+        active_games.set(chat_id, tuple(pointer) if pointer else None)
+    return pointer
+
+async def set_active_game(chat_id: int, game_id, status: str):
+    """Обновление указателя на текущую игру группы"""
+    await store.set_chat_active_game(chat_id, game_id, status)
+    active_games.set(chat_id, (game_id, status))
+
+async def finish_active_game(chat_id: int, game_id: int):
+    """Завершение игры и снятие указателя на нее"""
+    await store.finish_game(game_id)
+    pointer = active_games.get(chat_id)
+    if pointer and pointer[0] == game_id:
+        active_games.set(chat_id, None)
+    open_rounds.pop(game_id, None)
+
 async def battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /battle для группового режима"""
     chat_id = update.effective_chat.id
@@ -779,19 +483,24 @@ async def battle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Проверяем, есть ли активная игра в группе
-    active_game = get_active_group_game(chat_id)
+    pointer = await get_active_game(chat_id)
     
-    if active_game:
+    if pointer and pointer[1] == GAME_RUNNING:
         # Если игра уже идет, присоединяемся к ней
-        await join_existing_game(update, context, active_game)
+        await join_existing_game(update, context, pointer[0])
+    elif pointer and pointer[1] == GAME_SURVEYING:
+        # Опросник уже идет - повторно показываем кнопку, не сбрасывая ответы
+        await start_group_survey_for_all(update, context, clear=False)
     else:
         # Начинаем новый опросник для всех участников группы
         await start_group_survey_for_all(update, context)
 
 async def start_survey(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало опросника"""
-    user_id = update.effective_user.id
-    save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
+    # Вызывается и с Update (команда), и с CallbackQuery (кнопка "Играть одному")
+    user = update.from_user if hasattr(update, 'from_user') else update.effective_user
+    user_id = user.id
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
     
     # Создаем кнопки для выбора жанров
     keyboard = []
@@ -821,13 +530,13 @@ async def start_group_survey(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = update.effective_chat.id
     
     # Проверяем, не проходил ли пользователь уже опросник
-    existing_survey = get_survey_data(user_id, chat_id)
-    temp_data = get_user_survey_temp_data(user_id, chat_id)
+    existing_survey = await store.get_survey_data(user_id, chat_id)
+    temp_data = await store.get_user_survey_temp_data(user_id, chat_id)
     
     if existing_survey and not temp_data['selected_genres']:
         # Пользователь уже завершил опросник
-        survey_count = get_survey_participants_count(chat_id)
-        chat_members_count = await context.bot.get_chat_member_count(chat_id)
+        survey_count = await store.get_survey_participants_count(chat_id)
+        chat_members_count = await get_chat_member_count(context, chat_id)
         
         message = "✅ Ты уже проходил опросник в этой группе!\n\n"
         message += f"📊 Прошли опросник: {survey_count}/{chat_members_count - 1} участников\n"
@@ -843,7 +552,7 @@ async def start_group_survey(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Если есть временные данные, но опросник не завершен - продолжаем
     if temp_data['selected_genres']:
         # Продолжаем опросник с того места, где остановились
-        current_state = get_user_state(user_id)
+        current_state = await store.get_user_state(user_id)
         if current_state == GAME_STATES['SURVEY_GENRES']:
             # Показываем первый вопрос с текущими выборами
             keyboard = []
@@ -868,8 +577,8 @@ async def start_group_survey(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
     
     # Инициализируем временные данные пользователя в базе данных
-    save_user_survey_temp_data(user_id, chat_id, selected_genres=[], content_type='movie')
-    save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
+    await store.save_user_survey_temp_data(user_id, chat_id, selected_genres=[], content_type='movie')
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
     
     # Создаем кнопки для выбора жанров
     keyboard = []
@@ -893,13 +602,15 @@ async def start_group_survey(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Отправляем опросник в группу для конкретного пользователя
     await update.message.reply_text(message, reply_markup=reply_markup)
 
-async def start_group_survey_for_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def start_group_survey_for_all(update: Update, context: ContextTypes.DEFAULT_TYPE, clear: bool = True):
     """Начало группового опросника для всех участников"""
     chat_id = update.effective_chat.id
     
-    # Очищаем старые опросники для этого чата
-    clear_old_surveys(chat_id)
-    logger.info(f"Начинаем новый групповой опросник для чата {chat_id}")
+    if clear:
+        # Очищаем старые опросники для этого чата
+        await store.clear_old_surveys(chat_id)
+        await set_active_game(chat_id, None, GAME_SURVEYING)
+        logger.info(f"Начинаем новый групповой опросник для чата {chat_id}")
     
     try:
         # Создаем кнопку для начала опросника
@@ -930,13 +641,13 @@ async def start_individual_group_survey(query, context):
     logger.info(f"Начало индивидуального опросника для пользователя {user_id} в чате {chat_id}")
     
     # Проверяем, не проходил ли пользователь уже опросник
-    existing_survey = get_survey_data(user_id, chat_id)
-    temp_data = get_user_survey_temp_data(user_id, chat_id)
+    existing_survey = await store.get_survey_data(user_id, chat_id)
+    temp_data = await store.get_user_survey_temp_data(user_id, chat_id)
     
     if existing_survey and not temp_data['selected_genres']:
         # Пользователь уже завершил опросник
-        survey_count = get_survey_participants_count(chat_id)
-        chat_members_count = await context.bot.get_chat_member_count(chat_id)
+        survey_count = await store.get_survey_participants_count(chat_id)
+        chat_members_count = await get_chat_member_count(context, chat_id)
         
         message = "✅ **Ты уже проходил опросник в этой группе!**\n\n"
         message += f"📊 Прошли опросник: {survey_count}/{chat_members_count - 1} участников\n"
@@ -952,7 +663,7 @@ async def start_individual_group_survey(query, context):
     # Если есть временные данные, но опросник не завершен - продолжаем
     if temp_data['selected_genres']:
         # Продолжаем опросник с того места, где остановились
-        current_state = get_user_state(user_id)
+        current_state = await store.get_user_state(user_id)
         if current_state == GAME_STATES['SURVEY_GENRES']:
             # Показываем первый вопрос с текущими выборами
             keyboard = []
@@ -981,8 +692,8 @@ async def start_individual_group_survey(query, context):
             return
     
     # Инициализируем временные данные пользователя в базе данных
-    save_user_survey_temp_data(user_id, chat_id, selected_genres=[], content_type='movie')
-    save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
+    await store.save_user_survey_temp_data(user_id, chat_id, selected_genres=[], content_type='movie')
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_GENRES'])
     
     # Создаем кнопки для выбора жанров
     keyboard = []
@@ -1012,55 +723,51 @@ async def start_individual_group_survey(query, context):
     )
     logger.info(f"Опросник отправлен для пользователя {user_id}")
 
-async def join_existing_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def join_existing_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id: int):
     """Присоединение к существующей игре"""
-    game = get_active_group_game(update.effective_chat.id)
-    if not game:
+    game = await store.get_current_game_by_id(game_id)
+    if not game or game[11] == GAME_FINISHED:  # status
+        # Игра удалена обслуживанием базы или уже завершена, а указатель в кэше устарел
+        active_games.pop(update.effective_chat.id)
+        await start_group_survey_for_all(update, context)
         return
     
-    movies_json = game[4]  # movies_list
-    movies_list = json.loads(movies_json)
+    bracket = load_game_bracket(game)
     
     message = "🎮 **Присоединяемся к активной игре!**\n\n"
     message += "Голосование уже идет. Выбирай лучший фильм!"
     
-    # Показываем текущую пару фильмов
-    if len(movies_list) >= 2:
-        movie1 = movies_list[0]
-        movie2 = movies_list[1]
+    # Показываем текущую пару фильмов с кнопками для голосования (из отрисованного раунда)
+    if not bracket.finished:
+        pair = bracket.current_pair()
+        view = battle_renderer.view(game_id, game[5], game[6], pair, await movie_catalog.get_movies(pair))
+        message += "\n\n" + view.descriptions
         
-        message += f"\n\n🎬 **{movie1['title']}**\n"
-        message += f"📝 {movie1.get('overview', 'Описание отсутствует')}\n\n"
-        message += f"🎬 **{movie2['title']}**\n"
-        message += f"📝 {movie2.get('overview', 'Описание отсутствует')}\n\n"
+        sent = await update.message.reply_text(fit_message(message), reply_markup=view.markup)
         
-        # Создаем кнопки для голосования с полными названиями
-        keyboard = [
-            [
-                InlineKeyboardButton(f"🎬 {movie1['title']}", callback_data=f"vote_1_{game[0]}"),
-                InlineKeyboardButton(f"🎬 {movie2['title']}", callback_data=f"vote_2_{game[0]}")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        # После перезапуска бота раунд никто не закроет: восстанавливаем его таймаут
+        if game_id not in open_rounds:
+            open_rounds[game_id] = game[5]  # current_round
+            if ROUND_TIMEOUT > 0:
+                round_scheduler.schedule(context, f"round_timeout_{game_id}", ROUND_TIMEOUT,
+                                         round_timeout, update.effective_chat.id, sent.message_id, game_id, game[5])
     else:
         await update.message.reply_text(message)
 
-async def start_battle_round(update, context, game_id, movies_list):
+async def start_battle_round(update, context, game_id, bracket):
     """Начало раунда битвы"""
     # Получаем текущую игру
-    game = get_current_game_by_id(game_id)
+    game = await store.get_current_game_by_id(game_id)
     if not game:
         return
     
     current_round = game[5]  # current_round
     total_rounds = game[6]   # total_rounds
     
-    # Если фильмов осталось меньше 2, игра окончена
-    if len(movies_list) < 2:
-        winner = movies_list[0] if movies_list else None
-        if winner:
+    # Если победитель определен, игра окончена
+    if bracket.finished:
+        if bracket.winner is not None:
+            winner, = await movie_catalog.get_movies([bracket.winner])
             message = format_battle_result(winner, game[3])  # game_type
             keyboard = [[InlineKeyboardButton("🔄 Новая битва", callback_data="new_battle")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1069,28 +776,17 @@ async def start_battle_round(update, context, game_id, movies_list):
                 await update.edit_message_text(message, reply_markup=reply_markup)
             else:
                 await update.message.reply_text(message, reply_markup=reply_markup)
+        await store.finish_game(game_id)
         return
     
-    # Выбираем пару фильмов
-    movie1 = movies_list[0]
-    movie2 = movies_list[1]
-    
-    # Создаем кнопки для голосования
-    keyboard = [
-        [
-            InlineKeyboardButton(f"🎬 {movie1['title'][:20]}...", callback_data=f"vote_1_{game_id}"),
-            InlineKeyboardButton(f"🎬 {movie2['title'][:20]}...", callback_data=f"vote_2_{game_id}")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Выбираем пару фильмов и готовим сообщение с кнопками для голосования
+    pair = bracket.current_pair()
+    view = battle_renderer.view(game_id, current_round, total_rounds, pair, await movie_catalog.get_movies(pair), compact=True)
+    message, reply_markup = view.text, view.markup
     
-    # Формируем сообщение
-    message = format_movie_battle(movie1, movie2, current_round, total_rounds)
-    
-    # Сохраняем текущую пару
-    current_pair = json.dumps([movie1, movie2])
-    update_game_round(game_id, current_round, current_pair)
+    # Сохраняем текущую пару (ключи каталога)
+    current_pair = json.dumps(pair)
+    await store.update_game_round(game_id, current_round, current_pair)
     
     # Отправляем сообщение
     if hasattr(update, 'edit_message_text'):
@@ -1102,14 +798,20 @@ async def start_battle_round(update, context, game_id, movies_list):
         else:
             await update.message.reply_text(message, reply_markup=reply_markup)
 
-def get_current_game_by_id(game_id: int):
-    """Получение игры по ID"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM games WHERE game_id = ?', (game_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+# Префиксы callback_data с переменной частью; метрики обработчика кнопок считаются по ним
+CALLBACK_PREFIXES = (
+    'survey_genre_', 'survey_type_', 'survey_year_',
+    'group_survey_genre_', 'group_survey_type_', 'group_survey_year_',
+    'vote_', 'finish_round_'
+)
+
+def callback_route(update: Update):
+    """Метка ветки button_handler для метрик: префикс callback_data без идентификаторов"""
+    data = update.callback_query.data or ''
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip('_')
+    return data
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
@@ -1194,7 +896,7 @@ async def handle_group_survey_genre_selection(query, context):
     logger.info(f"Выбор жанра: user_id={user_id}, genre_key={genre_key}, callback_data={query.data}")
     
     # Получаем текущие данные пользователя из базы данных
-    user_data = get_user_survey_temp_data(user_id, chat_id)
+    user_data = await store.get_user_survey_temp_data(user_id, chat_id)
     selected_genres = user_data['selected_genres']
     
     # Переключаем выбор жанра
@@ -1212,7 +914,7 @@ async def handle_group_survey_genre_selection(query, context):
     logger.info(f"Обновленные выбранные жанры: {selected_genres}")
     
     # Сохраняем обновленные данные
-    save_user_survey_temp_data(user_id, chat_id, selected_genres=selected_genres)
+    await store.save_user_survey_temp_data(user_id, chat_id, selected_genres=selected_genres)
     
     # Обновляем кнопки
     keyboard = []
@@ -1246,14 +948,14 @@ async def handle_group_survey_genres_done(query, context):
     chat_id = query.message.chat.id
     
     # Получаем данные пользователя из базы данных
-    user_data = get_user_survey_temp_data(user_id, chat_id)
+    user_data = await store.get_user_survey_temp_data(user_id, chat_id)
     selected_genres = user_data['selected_genres']
     
     if not selected_genres:
         await query.answer("Выбери хотя бы один жанр!")
         return
     
-    save_user_state(user_id, GAME_STATES['SURVEY_TYPE'])
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_TYPE'])
     
     # Создаем кнопки для выбора типа контента
     keyboard = []
@@ -1279,8 +981,8 @@ async def handle_group_survey_type_selection(query, context):
     content_type = query.data.replace("group_survey_type_", "")
     
     # Сохраняем выбранный тип контента
-    save_user_survey_temp_data(user_id, chat_id, content_type=content_type)
-    save_user_state(user_id, GAME_STATES['SURVEY_YEARS'])
+    await store.save_user_survey_temp_data(user_id, chat_id, content_type=content_type)
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_YEARS'])
     
     # Создаем кнопки для выбора года
     keyboard = []
@@ -1308,15 +1010,15 @@ async def handle_group_survey_year_selection(query, context):
     logger.info(f"Извлеченные данные: user_id={user_id}, chat_id={chat_id}, year_range={year_range}")
     
     # Получаем данные пользователя из базы данных
-    user_data = get_user_survey_temp_data(user_id, chat_id)
+    user_data = await store.get_user_survey_temp_data(user_id, chat_id)
     selected_genres = user_data['selected_genres']
     content_type = user_data['content_type']
     
     # Сохраняем финальные данные опросника
-    save_survey_data(user_id, chat_id, selected_genres, content_type, year_range)
+    await store.save_survey_data(user_id, chat_id, selected_genres, content_type, year_range)
     
     # Очищаем временные данные
-    clear_user_survey_temp_data(user_id, chat_id)
+    await store.clear_user_survey_temp_data(user_id, chat_id)
     
     # Показываем сообщение о завершении опросника
     selected_genres_names = [GENRES[g]['name'] for g in selected_genres]
@@ -1331,9 +1033,9 @@ async def handle_group_survey_year_selection(query, context):
     
     # Проверяем, сколько участников прошли опросник
     logger.info(f"Получаем количество участников для чата {chat_id}")
-    survey_count = get_survey_participants_count(chat_id)
+    survey_count = await store.get_survey_participants_count(chat_id)
     logger.info(f"Количество прошедших опросник: {survey_count}")
-    chat_members_count = await context.bot.get_chat_member_count(chat_id)
+    chat_members_count = await get_chat_member_count(context, chat_id)
     logger.info(f"Общее количество участников: {chat_members_count}")
     
     message += f"📊 Прошли опросник: {survey_count}/{chat_members_count - 1} участников\n"
@@ -1357,8 +1059,8 @@ async def handle_group_survey_year_selection(query, context):
         logger.warning(f"Не удалось отправить уведомление в группу {chat_id}: {e}")
     
     # Проверяем, достаточно ли участников прошли опросник
-    survey_count = get_survey_participants_count(chat_id)
-    chat_members_count = await context.bot.get_chat_member_count(chat_id)
+    survey_count = await store.get_survey_participants_count(chat_id)
+    chat_members_count = await get_chat_member_count(context, chat_id)
     expected_participants = max(chat_members_count - 1, 2)  # Минимум 2 участника
     
     logger.info(f"В чате {chat_id} опросник прошли: {survey_count}, ожидается: {expected_participants}")
@@ -1379,41 +1081,53 @@ async def handle_group_survey_year_selection(query, context):
         # Запускаем игру
         await start_group_game_from_survey(query, context, chat_id)
 
-def get_survey_participants_count(chat_id: int):
-    """Получение количества участников, прошедших опросник"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT COUNT(DISTINCT user_id) 
-        FROM surveys 
-        WHERE chat_id = ?
-    ''', (chat_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else 0
+async def get_chat_member_count(context, chat_id: int):
+    """Количество участников чата с кэшированием.
+    
+    Одновременные промахи по одному чату объединяются в один запрос к Telegram,
+    а обновления chat_member поправляют закэшированное значение без запроса.
+    """
+    count = member_count_cache.get(chat_id)
+    if count is not None:
+        return count
+    
+    request = member_count_requests.get(chat_id)
+    if request is None:
+        request = asyncio.ensure_future(context.bot.get_chat_member_count(chat_id))
+        member_count_requests[chat_id] = request
+        try:
+            count = await request
+        finally:
+            member_count_requests.pop(chat_id, None)
+        member_count_cache.set(chat_id, count)
+        return count
+    return await asyncio.shield(request)
 
-def get_survey_user_ids(chat_id: int):
-    """Получение списка ID пользователей, прошедших опросник"""
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT DISTINCT user_id 
-        FROM surveys 
-        WHERE chat_id = ?
-    ''', (chat_id,))
+async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновление закэшированного количества участников по событиям chat_member"""
+    member_update = update.chat_member or update.my_chat_member
+    if not member_update:
+        return
     
-    results = cursor.fetchall()
-    conn.close()
-    return {row[0] for row in results}
+    chat_id = member_update.chat.id
+    was_member = is_chat_member(member_update.old_chat_member)
+    is_member = is_chat_member(member_update.new_chat_member)
+    count = member_count_cache.get(chat_id)
+    if count is not None and was_member != is_member:
+        member_count_cache.set(chat_id, count + (1 if is_member else -1))
+        logger.info(f"Количество участников чата {chat_id} обновлено: {count} -> {count + (1 if is_member else -1)}")
+
+def is_chat_member(member: ChatMember):
+    """Является ли участник членом чата"""
+    if member.status in (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER):
+        return True
+    return member.status == ChatMember.RESTRICTED and member.is_member
 
 async def get_all_group_user_ids(context, chat_id: int):
     """Получение списка всех пользователей в группе (кроме бота)"""
     try:
         # Получаем количество участников группы
-        chat_member_count = await context.bot.get_chat_member_count(chat_id)
+        chat_member_count = await get_chat_member_count(context, chat_id)
         logger.info(f"Общее количество участников в группе {chat_id}: {chat_member_count}")
         
         # Получаем администраторов группы (это все, что мы можем получить без специальных прав)
@@ -1437,7 +1151,7 @@ async def start_group_game_from_survey(query, context, chat_id):
     logger.info(f"Начало start_group_game_from_survey для чата {chat_id}")
     
     # Получаем объединенные данные опросника
-    survey_data = get_group_survey_data(chat_id)
+    survey_data = await store.get_group_survey_data(chat_id)
     logger.info(f"Полученные данные опросника: {survey_data}")
     
     if not survey_data:
@@ -1455,9 +1169,17 @@ async def start_group_game_from_survey(query, context, chat_id):
     )
     logger.info(f"Получено фильмов: {len(movies)}")
     
-    # Создаем игру
+    # Игра уже запущена (например, опросник завершили одновременно)
+    pointer = await get_active_game(chat_id)
+    if pointer and pointer[1] == GAME_RUNNING:
+        logger.info(f"В чате {chat_id} уже идет игра {pointer[0]}")
+        return
+    
+    # Создаем игру: в ней хранятся только ключи каталога, и она становится текущей игрой чата
     user_id = query.from_user.id
-    game_id = create_game(user_id, chat_id, 'group', movies)
+    bracket = Bracket(await movie_catalog.ensure_keys(movies), BRACKET_MODE)
+    game_id = await store.create_game(user_id, chat_id, 'group', bracket)
+    active_games.set(chat_id, (game_id, GAME_RUNNING))
     logger.info(f"Создана игра с ID: {game_id}")
     
     # Показываем результат опросника в группе
@@ -1480,14 +1202,14 @@ async def start_group_game_from_survey(query, context, chat_id):
     
     # Начинаем первый раунд - отправляем в группу
     logger.info(f"Начинаем первый раунд для игры {game_id}")
-    await start_battle_round_group(context, chat_id, game_id, movies)
+    await start_battle_round_group(context, chat_id, game_id, bracket)
 
-async def start_battle_round_group(context, chat_id, game_id, movies_list):
-    """Начало раунда битвы в группе"""
-    logger.info(f"Начало start_battle_round_group для игры {game_id}, чат {chat_id}, фильмов: {len(movies_list)}")
+async def start_battle_round_group(context, chat_id, game_id, bracket, message_id=None):
+    """Начало раунда битвы в группе (в новом сообщении или в сообщении предыдущего раунда)"""
+    logger.info(f"Начало start_battle_round_group для игры {game_id}, чат {chat_id}, раунд: {bracket.round}")
     
     # Получаем текущую игру
-    game = get_current_game_by_id(game_id)
+    game = await store.get_current_game_by_id(game_id)
     if not game:
         logger.error(f"Игра {game_id} не найдена в базе данных")
         return
@@ -1495,43 +1217,123 @@ async def start_battle_round_group(context, chat_id, game_id, movies_list):
     current_round = game[5]  # current_round
     total_rounds = game[6]   # total_rounds
     
-    # Если фильмов осталось меньше 2, игра окончена
-    if len(movies_list) < 2:
-        winner = movies_list[0] if movies_list else None
-        if winner:
+    # Если победитель определен, игра окончена
+    if bracket.finished:
+        if bracket.winner is not None:
+            winner, = await movie_catalog.get_movies([bracket.winner])
             message = format_battle_result(winner, game[3])  # game_type
             keyboard = [[InlineKeyboardButton("🔄 Новая битва", callback_data="new_battle")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await context.bot.send_message(chat_id, message, reply_markup=reply_markup)
+        await finish_active_game(chat_id, game_id)
         return
     
-    # Выбираем пару фильмов
-    movie1 = movies_list[0]
-    movie2 = movies_list[1]
+    # Выбираем пару фильмов и готовим сообщение с кнопками (полные названия)
+    pair = bracket.current_pair()
+    view = battle_renderer.view(game_id, current_round, total_rounds, pair, await movie_catalog.get_movies(pair))
+    message, reply_markup = view.text, view.markup
     
-    # Создаем кнопки для голосования с полными названиями
-    keyboard = [
-        [
-            InlineKeyboardButton(f"🎬 {movie1['title']}", callback_data=f"vote_1_{game_id}"),
-            InlineKeyboardButton(f"🎬 {movie2['title']}", callback_data=f"vote_2_{game_id}")
-        ]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Формируем сообщение
-    message = format_movie_battle(movie1, movie2, current_round, total_rounds)
-    
-    # Сохраняем текущую пару
-    current_pair = json.dumps([movie1, movie2])
-    update_game_round(game_id, current_round, current_pair)
+    # Сохраняем текущую пару (ключи каталога)
+    current_pair = json.dumps(pair)
+    await store.update_game_round(game_id, current_round, current_pair)
     
     # Отправляем сообщение в группу
     try:
-        await context.bot.send_message(chat_id, message, reply_markup=reply_markup)
+        if message_id is None:
+            sent = await context.bot.send_message(chat_id, message, reply_markup=reply_markup)
+            message_id = sent.message_id
+        else:
+            await context.bot.edit_message_text(message, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
         logger.info(f"Отправлено сообщение с битвой в чат {chat_id}, раунд {current_round}/{total_rounds}")
     except Exception as e:
         logger.warning(f"Не удалось отправить сообщение в группу {chat_id}: {e}")
+        open_rounds.pop(game_id, None)
+        return
+    
+    # Раунд принимает голоса; если голосов не хватит, он завершится по таймауту
+    open_rounds[game_id] = current_round
+    if ROUND_TIMEOUT > 0:
+        round_scheduler.schedule(context, f"round_timeout_{game_id}", ROUND_TIMEOUT,
+                                 round_timeout, chat_id, message_id, game_id, current_round)
+
+async def refresh_catalog(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновое обновление устаревших сегментов каталога"""
+    if not TMDB_API_KEY or TMDB_API_KEY == "placeholder_until_domain_ready":
+        return
+    
+    for key in movie_catalog.stale_segments()[:CATALOG_REFRESH_BATCH]:
+        try:
+            movies = await fetch_survey_candidates(*key)
+        except TMDbError as e:
+            logger.warning(f"Не удалось обновить сегмент каталога {key}: {e}")
+            continue
+        await movie_catalog.store_segment(key, movies)
+        discover_cache.pop(key)
+        logger.info(f"Сегмент каталога {key} обновлен: {len(movies)} записей")
+
+async def on_startup(application: Application):
+    """Теплый старт: загрузка каталога и запуск его фонового обновления"""
+    global metrics_server
+    await store.read(movie_catalog.load)
+    if METRICS_PORT:
+        metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    if LOOP_WATCHDOG_THRESHOLD > 0:
+        loop_watchdog.start()
+    if PROFILE_ON_START > 0 and application.job_queue:
+        profiler.start()
+        application.job_queue.run_once(finish_profiling, PROFILE_ON_START, name='profile_stop')
+    if application.job_queue:
+        application.job_queue.run_repeating(refresh_catalog, interval=CATALOG_REFRESH_INTERVAL, first=CATALOG_REFRESH_INTERVAL, name='refresh_catalog')
+        if vote_aggregator.durability == DURABILITY_INTERVAL:
+            application.job_queue.run_repeating(flush_votes, interval=VOTE_FLUSH_INTERVAL, first=VOTE_FLUSH_INTERVAL, name='flush_votes')
+        application.job_queue.run_repeating(maintain_database, interval=MAINTENANCE_INTERVAL, first=60, name='maintain_database')
+    else:
+        logger.warning("JobQueue недоступен, фоновые задачи (каталог, запись голосов, обслуживание базы) отключены")
+
+async def maintain_database(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая очистка старых данных и сжатие базы данных"""
+    await run_maintenance()
+
+async def flush_votes(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись накопленных голосов в базу данных"""
+    await vote_aggregator.flush()
+
+async def on_shutdown(application: Application):
+    """Освобождение ресурсов при остановке бота"""
+    await vote_aggregator.flush()
+    await tmdb_client.aclose()
+    await loop_watchdog.stop()
+    if profiler.active:
+        profiler.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    store.close()
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Профилирование бота на заданное время (только для администраторов из PROFILE_ADMINS)"""
+    if update.effective_user.id not in PROFILE_ADMINS:
+        return
+    try:
+        seconds = float(context.args[0]) if context.args else PROFILE_DURATION
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунд]")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_DURATION)
+    
+    if not profiler.start():
+        await update.message.reply_text("⏳ Профилирование уже идет")
+        return
+    round_scheduler.schedule(context, 'profile_stop', seconds, finish_profiling, update.effective_chat.id)
+    await update.message.reply_text(f"📈 Профилирование запущено на {seconds:g} сек")
+
+async def finish_profiling(context: ContextTypes.DEFAULT_TYPE, chat_id: int = None):
+    """Остановка профилирования и отправка отчета"""
+    report, path = profiler.stop()
+    if report is None:
+        return
+    if chat_id is not None:
+        await context.bot.send_message(chat_id, fit_message(f"{report}\nСтатистика: {path}"))
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
@@ -1545,20 +1347,15 @@ async def reset_survey_command(update: Update, context: ContextTypes.DEFAULT_TYP
     logger.info(f"Сброс опросника для пользователя {user_id} в чате {chat_id}")
     
     # Очищаем временные данные
-    clear_user_survey_temp_data(user_id, chat_id)
+    await store.clear_user_survey_temp_data(user_id, chat_id)
     logger.info(f"Временные данные очищены для пользователя {user_id}")
     
     # Удаляем завершенный опросник из базы данных
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM surveys WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-    deleted_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    deleted_count = await store.delete_user_surveys(user_id, chat_id)
     logger.info(f"Удалено {deleted_count} записей опросника для пользователя {user_id}")
     
     # Сбрасываем состояние пользователя
-    save_user_state(user_id, 'waiting_mode')
+    await store.save_user_state(user_id, 'waiting_mode')
     logger.info(f"Состояние пользователя {user_id} сброшено на 'waiting_mode'")
     
     await update.message.reply_text("🔄 Опросник сброшен!\nТеперь можешь начать заново командой /battle")
@@ -1570,206 +1367,194 @@ async def clear_all_surveys_command(update: Update, context: ContextTypes.DEFAUL
     logger.info(f"Очистка всех опросников в чате {chat_id}")
     
     # Очищаем все опросники для этого чата
-    clear_old_surveys(chat_id)
+    await store.clear_old_surveys(chat_id)
+    
+    # Незавершенный групповой опросник больше не считается текущей игрой
+    pointer = await get_active_game(chat_id)
+    if pointer and pointer[1] == GAME_SURVEYING:
+        await store.clear_chat_active_game(chat_id)
+        active_games.set(chat_id, None)
     
     await update.message.reply_text("🧹 Все опросники в чате очищены!\nТеперь можно начать новый опросник командой /battle")
 
 async def process_vote(query, context, game_id, vote):
     """Обработка голосования"""
-    import json
+    user_id = query.from_user.id
     
-    # Получаем текущую игру
-    game = get_current_game_by_id(game_id)
+    game = await store.get_current_game_by_id(game_id)
     if not game:
         return
-    
     game_type = game[3]  # game_type
-    movies_json = game[4]  # movies_list
-    current_round = game[5]  # current_round
-    current_pair = game[7]  # current_pair
-    votes_json = game[8]  # votes
+    round_num = game[5]  # current_round
     
-    # Парсим данные
-    movies_list = json.loads(movies_json)
-    current_pair_movies = json.loads(current_pair) if current_pair else []
-    votes = json.loads(votes_json) if votes_json else {}
+    # Голоса за завершенную игру или не текущую игру группы не принимаются
+    if game[11] == GAME_FINISHED:  # status
+        await query.answer("Эта игра уже завершена!")
+        return
+    if game_type != 'single':
+        pointer = await get_active_game(game[2])  # chat_id
+        if not pointer or pointer[0] != game_id:
+            await query.answer("Эта игра уже завершена!")
+            return
     
-    # Добавляем голос
-    user_id = query.from_user.id
+    # Голоса раунда загружаются заранее: таймаут может закрыть раунд, пока они читаются из базы
+    await vote_aggregator.get(game_id, round_num)
     
-    # Проверяем, не голосовал ли уже этот пользователь
-    if str(user_id) in votes:
-        await query.answer("Ты уже проголосовал в этом раунде!")
+    # Голоса за раунд, который уже завершается, не принимаются. Между этой
+    # проверкой и учетом голоса нет await, поэтому раунд не закроется посередине
+    if game_type != 'single' and open_rounds.get(game_id, round_num) != round_num:
+        await query.answer("Раунд уже завершен!")
         return
     
-    votes[str(user_id)] = vote
+    # Проверяем, не голосовал ли уже этот пользователь, и учитываем голос
+    round_votes = await vote_aggregator.record(game_id, round_num, user_id, vote)
+    if round_votes is None:
+        await query.answer("Ты уже проголосовал в этом раунде!")
+        return
     
-    # Сохраняем голоса
-    update_game_round(game_id, current_round, current_pair, json.dumps(votes))
+    bracket = load_game_bracket(game)
+    current_pair_keys = json.loads(game[7]) if game[7] else []  # current_pair
     
     if game_type == 'single':
-        # Одиночный режим - сразу определяем победителя
-        winner = current_pair_movies[vote - 1]  # vote 1 или 2
-        loser = current_pair_movies[2 - vote]   # противоположный
-        
-        # Удаляем проигравший фильм из списка
-        movies_list.remove(loser)
-        
-        # Обновляем список фильмов в базе
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE games SET movies_list = ? WHERE game_id = ?', 
-                      (json.dumps(movies_list), game_id))
-        conn.commit()
-        conn.close()
+        # Одиночный режим - сразу определяем победителя (vote 1 или 2)
+        bracket.advance(vote - 1)
+        await store.save_game_bracket(game_id, bracket)
+        await vote_aggregator.close_round(game_id, round_num)
+        battle_renderer.discard(game_id, round_num, current_pair_keys)
         
-        # Если остался один фильм - игра окончена
-        if len(movies_list) == 1:
-            winner = movies_list[0]
+        # Если победитель определен - игра окончена
+        if bracket.finished:
+            await store.finish_game(game_id)
+            winner, = await movie_catalog.get_movies([bracket.winner])
             message = format_battle_result(winner, game_type)
             keyboard = [[InlineKeyboardButton("🔄 Новая битва", callback_data="new_battle")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(message, reply_markup=reply_markup)
         else:
-            # Увеличиваем номер раунда и продолжаем игру
-            increment_game_round(game_id)
-            await start_battle_round(query, context, game_id, movies_list)
+            # Продолжаем игру со следующим раундом
+            await start_battle_round(query, context, game_id, bracket)
     
     else:
         # Групповой режим - показываем обновленные результаты голосования
-        vote1_count = sum(1 for v in votes.values() if v == 1)
-        vote2_count = sum(1 for v in votes.values() if v == 2)
-        
-        # Показываем кто проголосовал
-        voter_name = query.from_user.first_name or query.from_user.username or "Участник"
-        message = f"🗳️ **{voter_name}** проголосовал!\n\n"
-        message += f"📊 **Текущие результаты:**\n"
-        message += f"🎬 {current_pair_movies[0]['title']}: {vote1_count} голосов\n"
-        message += f"🎬 {current_pair_movies[1]['title']}: {vote2_count} голосов\n\n"
-        
-        # Показываем список проголосовавших
-        if votes:
-            voted_users = []
-            for user_id_str in votes.keys():
-                # Здесь можно было бы получить имена пользователей, но пока показываем количество
-                voted_users.append(f"👤 Участник {len(voted_users) + 1}")
-            
-            message += f"✅ **Проголосовали:** {', '.join(voted_users)}\n\n"
-        
-        # Показываем полные описания фильмов
-        message += f"🎬 **{current_pair_movies[0]['title']}**\n"
-        message += f"📝 {current_pair_movies[0].get('overview', 'Описание отсутствует')}\n\n"
-        message += f"🎬 **{current_pair_movies[1]['title']}**\n"
-        message += f"📝 {current_pair_movies[1].get('overview', 'Описание отсутствует')}\n\n"
+        view = battle_renderer.cached(game_id, round_num, current_pair_keys)
+        if view is None:
+            view = battle_renderer.view(game_id, round_num, game[6], current_pair_keys,  # total_rounds
+                                        await movie_catalog.get_movies(current_pair_keys))
         
         # Проверяем, нужно ли завершить раунд
-        total_votes = len(votes)
-        chat_members_count = await context.bot.get_chat_member_count(game[2])  # chat_id
+        total_votes = len(round_votes)
+        chat_members_count = await get_chat_member_count(context, game[2])  # chat_id
         
-        # Показываем прогресс голосования
-        message += f"📊 **Прогресс:** {total_votes}/{chat_members_count - 1} участников проголосовали\n\n"
+        # В готовый шаблон подставляются только имя проголосовавшего и счетчики
+        voter_name = query.from_user.first_name or query.from_user.username or "Участник"
+        message = view.tally(voter_name, round_votes.counts, total_votes, chat_members_count - 1)
         
         # Завершаем раунд только если проголосовали все участники или минимум 3 участника
         min_votes_required = max(3, min(chat_members_count - 1, 5))  # Минимум 3, максимум 5 голосов
         
-        if total_votes >= min_votes_required:
-            # Добавляем кнопку для принудительного завершения раунда
-            keyboard = [
-                [
-                    InlineKeyboardButton(f"🎬 {current_pair_movies[0]['title']}", callback_data=f"vote_1_{game_id}"),
-                    InlineKeyboardButton(f"🎬 {current_pair_movies[1]['title']}", callback_data=f"vote_2_{game_id}")
-                ],
-                [InlineKeyboardButton("✅ Завершить раунд", callback_data=f"finish_round_{game_id}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, reply_markup=reply_markup)
-        else:
-            # Показываем кнопки для продолжения голосования
-            keyboard = [
-                [
-                    InlineKeyboardButton(f"🎬 {current_pair_movies[0]['title']}", callback_data=f"vote_1_{game_id}"),
-                    InlineKeyboardButton(f"🎬 {current_pair_movies[1]['title']}", callback_data=f"vote_2_{game_id}")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(message, reply_markup=reply_markup)
+        # Кнопка принудительного завершения раунда появляется, когда голосов достаточно
+        reply_markup = view.finish_markup if total_votes >= min_votes_required else view.markup
+        
+        # Пока считались участники и готовилось сообщение, раунд мог завершиться:
+        # промежуточный счет не должен затирать финальные результаты
+        if open_rounds.get(game_id, round_num) != round_num:
+            return
+        edit_coalescer.submit(context.bot, query.message.chat.id, query.message.message_id, message, reply_markup)
 
 async def finish_round_manually(query, context, game_id):
     """Принудительное завершение раунда"""
-    import json
-    
+    await close_group_round(context, query.message.chat.id, query.message.message_id, game_id)
+
+async def round_timeout(context, chat_id, message_id, game_id, round_num):
+    """Завершение раунда, в котором не набралось голосов за отведенное время"""
+    logger.info(f"Таймаут раунда {round_num} в игре {game_id}")
+    await close_group_round(context, chat_id, message_id, game_id, round_num)
+
+async def close_group_round(context, chat_id, message_id, game_id, round_num=None):
+    """Завершение текущего раунда группы (по кнопке или по таймауту)"""
     # Получаем текущую игру
-    game = get_current_game_by_id(game_id)
+    game = await store.get_current_game_by_id(game_id)
     if not game:
         return
     
-    movies_json = game[4]  # movies_list
-    current_pair = game[7]  # current_pair
-    votes_json = game[8]  # votes
+    # Кнопка или таймаут завершенной игры (в том числе игры до миграции со старым форматом сетки)
+    if game[11] == GAME_FINISHED:  # status
+        open_rounds.pop(game_id, None)
+        return
+    
+    # Раунд уже завершен или завершается другим обработчиком
+    current_round = game[5]  # current_round
+    if round_num is not None and current_round != round_num:
+        return
+    if open_rounds.get(game_id, current_round) != current_round:
+        return
+    
+    bracket = load_game_bracket(game)
+    if bracket.finished:
+        return
+    open_rounds[game_id] = None
     
     # Парсим данные
-    movies_list = json.loads(movies_json)
-    current_pair_movies = json.loads(current_pair) if current_pair else []
-    votes = json.loads(votes_json) if votes_json else {}
+    current_pair = game[7]  # current_pair
+    current_pair_keys = json.loads(current_pair) if current_pair else []
+    round_votes = await vote_aggregator.get(game_id, current_round)
     
-    await finish_group_round(query, context, game_id, movies_list, current_pair_movies, votes)
+    await finish_group_round(context, chat_id, message_id, game_id, bracket, current_pair_keys, round_votes)
 
-async def finish_group_round(query, context, game_id, movies_list, current_pair_movies, votes):
+async def next_group_round(context, chat_id, message_id, game_id):
+    """Запуск следующего раунда группы после паузы"""
+    game = await store.get_current_game_by_id(game_id)
+    if not game or game[11] == GAME_FINISHED:  # status
+        return
+    await start_battle_round_group(context, chat_id, game_id, load_game_bracket(game), message_id)
+
+async def finish_group_round(context, chat_id, message_id, game_id, bracket, current_pair_keys, round_votes):
     """Завершение раунда в групповом режиме"""
-    import json
+    round_scheduler.cancel(context, f"round_timeout_{game_id}")
+    current_pair_movies = await movie_catalog.get_movies(current_pair_keys)
     
-    vote1_count = sum(1 for v in votes.values() if v == 1)
-    vote2_count = sum(1 for v in votes.values() if v == 2)
+    vote1_count, vote2_count = round_votes.counts
     
     message = f"📊 **Финальные результаты голосования:**\n\n"
     message += f"🎬 {current_pair_movies[0]['title']}: {vote1_count} голосов\n"
     message += f"🎬 {current_pair_movies[1]['title']}: {vote2_count} голосов\n\n"
     
-    # Определяем победителя
+    # Определяем победителя (индекс в паре)
     if vote1_count > vote2_count:
-        winner = current_pair_movies[0]
-        loser = current_pair_movies[1]
-        message += f"🏆 **Победитель раунда:** {winner['title']}\n\n"
+        winner_index = 0
+        message += f"🏆 **Победитель раунда:** {current_pair_movies[0]['title']}\n\n"
     elif vote2_count > vote1_count:
-        winner = current_pair_movies[1]
-        loser = current_pair_movies[0]
-        message += f"🏆 **Победитель раунда:** {winner['title']}\n\n"
+        winner_index = 1
+        message += f"🏆 **Победитель раунда:** {current_pair_movies[1]['title']}\n\n"
     else:
         # Ничья - случайный выбор
-        winner = random.choice(current_pair_movies)
-        loser = current_pair_movies[1] if winner == current_pair_movies[0] else current_pair_movies[0]
-        message += f"🏆 **Победитель раунда (ничья):** {winner['title']}\n\n"
-    
-    # Удаляем проигравший фильм
-    movies_list.remove(loser)
-    
-    # Обновляем список фильмов
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE games SET movies_list = ? WHERE game_id = ?', 
-                  (json.dumps(movies_list), game_id))
-    conn.commit()
-    conn.close()
-    
-    # Если остался один фильм - игра окончена
-    if len(movies_list) == 1:
-        winner = movies_list[0]
+        winner_index = random.randint(0, 1)
+        message += f"🏆 **Победитель раунда (ничья):** {current_pair_movies[winner_index]['title']}\n\n"
+    
+    # Продвигаем сетку и сохраняем ее вместе с номером раунда
+    round_num = bracket.round
+    bracket.advance(winner_index)
+    await store.save_game_bracket(game_id, bracket)
+    await vote_aggregator.close_round(game_id, round_num)
+    battle_renderer.discard(game_id, round_num, current_pair_keys)
+    
+    # Отложенные правки с промежуточными результатами больше не нужны
+    edit_coalescer.discard(chat_id, message_id)
+
+    # Если победитель определен - игра окончена
+    if bracket.finished:
+        winner = current_pair_movies[winner_index]
         result_message = format_battle_result(winner, 'group')
         keyboard = [[InlineKeyboardButton("🔄 Новая битва", callback_data="new_battle")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(result_message, reply_markup=reply_markup)
+        await finish_active_game(chat_id, game_id)
+        await context.bot.edit_message_text(result_message, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
     else:
-        # Автоматически переходим к следующему раунду через 3 секунды
-        message += "⏳ Переход к следующему раунду через 3 секунды..."
-        await query.edit_message_text(message)
-        
-        # Увеличиваем номер раунда
-        increment_game_round(game_id)
-        
-        # Ждем 3 секунды и переходим к следующему раунду
-        import asyncio
-        await asyncio.sleep(3)
-        await start_battle_round(query, context, game_id, movies_list)
+        # Следующий раунд начнется по таймеру, обработчик не ждет паузу
+        message += f"⏳ Следующий раунд через {ROUND_TRANSITION_DELAY:g} сек..."
+        round_scheduler.schedule(context, f"next_round_{game_id}", ROUND_TRANSITION_DELAY,
+                                 next_group_round, chat_id, message_id, game_id)
+        await context.bot.edit_message_text(fit_message(message), chat_id=chat_id, message_id=message_id)
 
 async def handle_survey_genre_selection(query, context):
     """Обработка выбора жанра в опроснике"""
@@ -1828,7 +1613,7 @@ async def handle_survey_genres_done(query, context):
         await query.answer("Выбери хотя бы один жанр!")
         return
     
-    save_user_state(user_id, GAME_STATES['SURVEY_TYPE'])
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_TYPE'])
     
     # Создаем кнопки для выбора типа контента
     keyboard = []
@@ -1851,7 +1636,7 @@ async def handle_survey_type_selection(query, context):
     content_type = query.data.replace("survey_type_", "")
     
     context.user_data['content_type'] = content_type
-    save_user_state(user_id, GAME_STATES['SURVEY_YEARS'])
+    await store.save_user_state(user_id, GAME_STATES['SURVEY_YEARS'])
     
     # Создаем кнопки для выбора года
     keyboard = []
@@ -1879,7 +1664,7 @@ async def handle_survey_year_selection(query, context):
     content_type = context.user_data.get('content_type', 'movie')
     
     # Сохраняем данные опросника
-    save_survey_data(user_id, chat_id, selected_genres, content_type, year_range)
+    await store.save_survey_data(user_id, chat_id, selected_genres, content_type, year_range)
     
     # Показываем результат
     selected_genres_names = [GENRES[g]['name'] for g in selected_genres]
@@ -1895,13 +1680,14 @@ async def handle_survey_year_selection(query, context):
     await query.edit_message_text(message)
     
     # Получаем фильмы на основе опросника
-    movies = get_movies_by_survey(selected_genres, content_type, year_range, 26)
+    movies = await get_movies_by_survey(selected_genres, content_type, year_range, 26)
     
-    # Создаем игру
-    game_id = create_game(user_id, chat_id, 'single', movies)
+    # Создаем игру: в ней хранятся только ключи каталога
+    bracket = Bracket(await movie_catalog.ensure_keys(movies), BRACKET_MODE)
+    game_id = await store.create_game(user_id, chat_id, 'single', bracket)
     
     # Начинаем первый раунд
-    await start_battle_round(query, context, game_id, movies)
+    await start_battle_round(query, context, game_id, bracket)
 
 def main():
     """Запуск бота"""
@@ -1931,7 +1717,17 @@ def main():
     # Создаем приложение
     logger.info("Создание приложения...")
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+        update_processor = ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(InstrumentedRequest(connection_pool_size=256))
+            .concurrent_updates(update_processor)
+            .post_init(on_startup)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         logger.info("Приложение создано успешно")
     except Exception as e:
         logger.error(f"Ошибка при создании приложения: {e}")
@@ -1940,11 +1736,18 @@ def main():
     # Добавляем обработчики
     logger.info("Добавление обработчиков...")
     try:
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("battle", battle_command))
-        application.add_handler(CommandHandler("reset_survey", reset_survey_command))
-        application.add_handler(CommandHandler("clear_surveys", clear_all_surveys_command))
-        application.add_handler(CallbackQueryHandler(button_handler))
+        # Каждый обработчик обернут замером длительности для метрик и профилировщика
+        def instrumented(callback, name=None, route=None):
+            return instrument_handler(profiler.wrap(callback, name, route), name, route)
+        
+        application.add_handler(CommandHandler("start", instrumented(start, 'start')))
+        application.add_handler(CommandHandler("battle", instrumented(battle_command, 'battle')))
+        application.add_handler(CommandHandler("reset_survey", instrumented(reset_survey_command, 'reset_survey')))
+        application.add_handler(CommandHandler("clear_surveys", instrumented(clear_all_surveys_command, 'clear_surveys')))
+        application.add_handler(CommandHandler("profile", instrumented(profile_command, 'profile')))
+        application.add_handler(CallbackQueryHandler(instrumented(button_handler, route=callback_route)))
+        application.add_handler(ChatMemberHandler(instrumented(track_chat_members, 'chat_member'),
+                                                  ChatMemberHandler.ANY_CHAT_MEMBER))
         logger.info("Обработчики добавлены успешно")
     except Exception as e:
         logger.error(f"Ошибка при добавлении обработчиков: {e}")
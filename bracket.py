@@ -0,0 +1,109 @@
+from array import array
+
+# Режимы турнирной сетки
+SINGLE_ELIMINATION = 'single_elimination'
+KING_OF_THE_HILL = 'king_of_the_hill'
+BRACKET_MODES = (SINGLE_ELIMINATION, KING_OF_THE_HILL)
+
+# Версия формата сериализации
+BRACKET_FORMAT_VERSION = 1
+
+class Bracket:
+    """Турнирная сетка на массиве целочисленных ключей фильмов.
+
+    В режиме single elimination текущий круг занимает entries[0:size]: пары
+    читаются указателем read, а победители записываются на место указателем
+    write, поэтому следующий круг собирается без копирования. При нечетном
+    количестве участников последний проходит дальше без пары.
+
+    В режиме king of the hill entries[0] - действующий чемпион, а read
+    указывает на очередного претендента.
+
+    Переход к следующему раунду в обоих режимах выполняется за O(1).
+    """
+
+    def __init__(self, movie_keys, mode: str = SINGLE_ELIMINATION):
+        if mode not in BRACKET_MODES:
+            raise ValueError(f"Неизвестный режим сетки: {mode}")
+        self.mode = mode
+        self.entries = array('q', movie_keys)
+        self.size = len(self.entries)
+        self.read = 1 if mode == KING_OF_THE_HILL else 0
+        self.write = 0
+        self.round = 1
+
+    @property
+    def total_rounds(self):
+        """Количество раундов до победителя"""
+        return max(len(self.entries) - 1, 0)
+
+    @property
+    def finished(self):
+        """Определен ли победитель"""
+        if self.mode == KING_OF_THE_HILL:
+            return self.read >= self.size
+        return self.size <= 1
+
+    @property
+    def winner(self):
+        """Ключ победителя или None, если сетка еще не завершена"""
+        if not self.finished or not self.entries:
+            return None
+        return self.entries[0]
+
+    def current_pair(self):
+        """Пара ключей текущего раунда"""
+        if self.finished:
+            return None
+        if self.mode == KING_OF_THE_HILL:
+            return self.entries[0], self.entries[self.read]
+        return self.entries[self.read], self.entries[self.read + 1]
+
+    def advance(self, winner_slot: int):
+        """Фиксация победителя текущей пары (0 или 1) и переход к следующему раунду"""
+        if self.finished:
+            raise ValueError("Сетка уже завершена")
+        if winner_slot not in (0, 1):
+            raise ValueError(f"Некорректный слот победителя: {winner_slot}")
+
+        if self.mode == KING_OF_THE_HILL:
+            if winner_slot == 1:
+                self.entries[0] = self.entries[self.read]
+            self.read += 1
+        else:
+            self.entries[self.write] = self.entries[self.read + winner_slot]
+            self.write += 1
+            self.read += 2
+            if self.read >= self.size - 1:
+                # Круг завершен: участник без пары проходит дальше
+                if self.read == self.size - 1:
+                    self.entries[self.write] = self.entries[self.read]
+                    self.write += 1
+                self.size = self.write
+                self.read = 0
+                self.write = 0
+        self.round += 1
+
+    def to_list(self):
+        """Компактная сериализация в список целых чисел"""
+        mode_code = BRACKET_MODES.index(self.mode)
+        return [BRACKET_FORMAT_VERSION, mode_code, self.round, self.size, self.read, self.write, *self.entries]
+
+    @classmethod
+    def from_list(cls, data: list):
+        """Восстановление сетки из списка целых чисел"""
+        version, mode_code, round_num, size, read, write, *entries = data
+        if version != BRACKET_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия сетки: {version}")
+        bracket = cls(entries, BRACKET_MODES[mode_code])
+        bracket.round, bracket.size, bracket.read, bracket.write = round_num, size, read, write
+        return bracket
+
+    def to_bytes(self):
+        """Двоичная сериализация (массив 64-битных целых)"""
+        return array('q', self.to_list()).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """Восстановление сетки из двоичного представления"""
+        return cls.from_list(array('q', data).tolist())
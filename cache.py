@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """Кэш в памяти с ограничением размера (LRU) и временем жизни записей.
+
+    Ведет счетчики попаданий, промахов, вытеснений и истечений, чтобы по ним
+    можно было судить об эффективности кэша.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Получение значения; просроченные записи удаляются"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= self.clock():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Сохранение значения с вытеснением самой давней записи при переполнении"""
+        self._data[key] = (value, self.clock() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Удаление записи"""
+        entry = self._data.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        """Очистка кэша (счетчики сохраняются)"""
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Счетчики кэша"""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
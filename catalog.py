@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import bisect
+import logging
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд сегмент каталога считается устаревшим и обновляется из TMDb
+CATALOG_MAX_AGE = float(os.getenv('CATALOG_MAX_AGE', str(24 * 3600)))
+
+def normalize_movie(movie: dict, media_type: str):
+    """Компактная запись каталога из ответа TMDb (фильмы и сериалы в едином виде)"""
+    return {
+        'id': movie['id'],
+        'media_type': movie.get('media_type', media_type),
+        'title': movie.get('title') or movie.get('name') or 'Без названия',
+        'overview': movie.get('overview') or '',
+        'poster_path': movie.get('poster_path'),
+        'genre_ids': movie.get('genre_ids', []),
+        'release_date': movie.get('release_date') or movie.get('first_air_date') or '',
+        'popularity': movie.get('popularity', 0)
+    }
+
+def segment_name(segment: tuple):
+    """Строковое имя сегмента по нормализованному ключу запроса"""
+    genre_ids, media_type, year_range = segment
+    return f"{media_type}|{','.join(map(str, genre_ids))}|{year_range}"
+
+def parse_segment_name(name: str):
+    """Обратное преобразование имени сегмента в ключ запроса"""
+    media_type, genre_ids, year_range = name.split('|')
+    return tuple(int(genre_id) for genre_id in genre_ids.split(',') if genre_id), media_type, year_range
+
+def save_catalog_movies(records: list, updated_at: float):
+    """Сохранение записей каталога; возвращает их ключи в том же порядке"""
+    movie_keys = []
+    with storage.db.connection() as conn:
+        for record in records:
+            conn.execute('''
+                INSERT INTO catalog_movies (media_type, tmdb_id, data, genre_ids, release_date, popularity, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (media_type, tmdb_id) DO UPDATE SET
+                    data = excluded.data,
+                    genre_ids = excluded.genre_ids,
+                    release_date = excluded.release_date,
+                    popularity = excluded.popularity,
+                    updated_at = excluded.updated_at
+            ''', (record['media_type'], record['id'], json.dumps(record, ensure_ascii=False),
+                  json.dumps(record['genre_ids']), record['release_date'], record['popularity'], updated_at))
+            movie_key = conn.execute('SELECT movie_key FROM catalog_movies WHERE media_type = ? AND tmdb_id = ?',
+                                     (record['media_type'], record['id'])).fetchone()[0]
+            movie_keys.append(movie_key)
+    return movie_keys
+
+def save_catalog_segment(name: str, records: list, fetched_at: float):
+    """Сохранение записей каталога и состава сегмента; возвращает ключи записей"""
+    with storage.db.connection() as conn:
+        movie_keys = save_catalog_movies(records, fetched_at)
+        conn.execute('''
+            INSERT OR REPLACE INTO catalog_segments (segment, movie_keys, fetched_at)
+            VALUES (?, ?, ?)
+        ''', (name, json.dumps(list(dict.fromkeys(movie_keys))), fetched_at))
+    return movie_keys
+
+def load_catalog_rows():
+    """Чтение всего каталога из базы данных"""
+    with storage.db.connection() as conn:
+        movies = conn.execute('SELECT movie_key, data FROM catalog_movies').fetchall()
+        segments = conn.execute('SELECT segment, movie_keys, fetched_at FROM catalog_segments').fetchall()
+    return movies, segments
+
+def load_catalog_movies(movie_keys: list):
+    """Чтение записей каталога по ключам"""
+    with storage.db.connection() as conn:
+        rows = conn.execute(
+            f"SELECT movie_key, data FROM catalog_movies WHERE movie_key IN ({','.join('?' * len(movie_keys))})",
+            list(movie_keys)
+        ).fetchall()
+    return {movie_key: json.loads(data) for movie_key, data in rows}
+
+def release_year(record: dict):
+    """Год выпуска записи каталога (0, если дата неизвестна)"""
+    release_date = record.get('release_date') or ''
+    return int(release_date[:4]) if release_date[:4].isdigit() else 0
+
+class CatalogIndex:
+    """Инвертированный индекс каталога для сборки сетки без сетевых запросов.
+
+    Жанры отображаются в множества ключей записей, а годы выпуска хранятся
+    в отсортированных массивах по типу контента, поэтому фильтр по жанрам -
+    это операции над множествами, а фильтр по годам - два bisect.
+    """
+
+    def __init__(self, movies: dict = None):
+        self.genres = {}  # genre_id -> множество movie_key
+        self.years = {}   # media_type -> (отсортированные годы, movie_key в том же порядке)
+        self.build(movies or {})
+
+    def build(self, movies: dict):
+        """Построение индекса по записям каталога"""
+        genres = {}
+        by_media_type = {}
+        for movie_key, record in movies.items():
+            for genre_id in record.get('genre_ids', []):
+                genres.setdefault(genre_id, set()).add(movie_key)
+            by_media_type.setdefault(record['media_type'], []).append((release_year(record), movie_key))
+
+        self.genres = genres
+        self.years = {}
+        for media_type, entries in by_media_type.items():
+            entries.sort()
+            self.years[media_type] = ([year for year, _ in entries], [movie_key for _, movie_key in entries])
+
+    def add(self, movie_key, record: dict):
+        """Добавление записи в готовый индекс без перестройки"""
+        for genre_id in record.get('genre_ids', []):
+            self.genres.setdefault(genre_id, set()).add(movie_key)
+        years, keys = self.years.setdefault(record['media_type'], ([], []))
+        year = release_year(record)
+        position = bisect.bisect_right(years, year)
+        years.insert(position, year)
+        keys.insert(position, movie_key)
+
+    def remove(self, movie_key, record: dict):
+        """Удаление записи из индекса (перед заменой обновленной записью)"""
+        for genre_id in record.get('genre_ids', []):
+            self.genres.get(genre_id, set()).discard(movie_key)
+        years, keys = self.years.get(record['media_type'], ([], []))
+        year = release_year(record)
+        # Запись ищется только среди ключей того же года
+        low = bisect.bisect_left(years, year)
+        high = bisect.bisect_right(years, year)
+        for position in range(low, high):
+            if keys[position] == movie_key:
+                del years[position]
+                del keys[position]
+                break
+
+    def query(self, genre_ids: tuple, media_type: str, year_min: int, year_max: int, match_all: bool = True):
+        """Ключи записей нужного типа и годов, подходящие по жанрам.
+
+        match_all=True требует все жанры сразу (как with_genres=a,b в TMDb),
+        иначе достаточно любого из них.
+        """
+        years, keys = self.years.get(media_type, ([], []))
+        low = bisect.bisect_left(years, year_min)
+        high = bisect.bisect_right(years, year_max)
+        result = set(keys[low:high])
+
+        if genre_ids:
+            genre_sets = sorted((self.genres.get(genre_id, set()) for genre_id in genre_ids), key=len)
+            matching = set.intersection(*genre_sets) if match_all else set().union(*genre_sets)
+            result &= matching
+        return result
+
+class MovieCatalog:
+    """Локальный каталог фильмов и сериалов, сохраняемый в SQLite.
+
+    Загружается в память при старте, поэтому опросники обслуживаются без сети,
+    пока сегмент (нормализованный запрос) не устарел.
+    """
+
+    def __init__(self, max_age: float = CATALOG_MAX_AGE, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self.movies = {}    # movie_key -> запись каталога
+        self.keys = {}      # (media_type, id TMDb) -> movie_key
+        self.segments = {}  # ключ запроса -> (movie_keys, fetched_at)
+        self._index = None
+
+    @property
+    def index(self):
+        """Индекс по жанрам и годам; перестраивается лениво после изменений каталога"""
+        if self._index is None:
+            self._index = CatalogIndex(self.movies)
+        return self._index
+
+    def find(self, genre_ids: tuple, media_type: str, year_min: int, year_max: int):
+        """Записи каталога, подходящие под запрос, без обращения к сети"""
+        movie_keys = self.index.query(genre_ids, media_type, year_min, year_max)
+        return [self.movies[movie_key] for movie_key in sorted(movie_keys)]
+
+    def load(self):
+        """Загрузка каталога из базы данных (теплый старт)"""
+        movies, segments = load_catalog_rows()
+        self.movies = {movie_key: json.loads(data) for movie_key, data in movies}
+        self.keys = {(record['media_type'], record['id']): movie_key for movie_key, record in self.movies.items()}
+        self.segments = {
+            parse_segment_name(name): (json.loads(movie_keys), fetched_at)
+            for name, movie_keys, fetched_at in segments
+        }
+        self._index = CatalogIndex(self.movies)
+        logger.info(f"Каталог загружен: {len(self.movies)} записей, {len(self.segments)} сегментов")
+
+    def is_fresh(self, segment: tuple):
+        """Есть ли сегмент и не устарел ли он"""
+        entry = self.segments.get(segment)
+        return entry is not None and self.clock() - entry[1] < self.max_age
+
+    def get_segment(self, segment: tuple, allow_stale: bool = False):
+        """Записи сегмента или None, если сегмента нет (или он устарел)"""
+        if not allow_stale and not self.is_fresh(segment):
+            return None
+        entry = self.segments.get(segment)
+        if entry is None:
+            return None
+        return [self.movies[movie_key] for movie_key in entry[0] if movie_key in self.movies]
+
+    def stale_segments(self):
+        """Сегменты, которые пора обновить, начиная с самых старых"""
+        now = self.clock()
+        stale = [(fetched_at, segment) for segment, (_, fetched_at) in self.segments.items() if now - fetched_at >= self.max_age]
+        return [segment for _, segment in sorted(stale)]
+
+    def _remember(self, movie_keys: list, records: list):
+        """Запоминание записей в памяти"""
+        for movie_key, record in zip(movie_keys, records):
+            # Индекс обновляется по месту, а не перестраивается на каждом изменении каталога
+            if self._index is not None:
+                previous = self.movies.get(movie_key)
+                if previous is not None:
+                    self._index.remove(movie_key, previous)
+                self._index.add(movie_key, record)
+            self.movies[movie_key] = record
+            self.keys[(record['media_type'], record['id'])] = movie_key
+
+    async def store_segment(self, segment: tuple, records: list):
+        """Сохранение свежих записей сегмента на диск и в память"""
+        fetched_at = self.clock()
+        movie_keys = await storage.store.run(save_catalog_segment, segment_name(segment), records, fetched_at)
+        self._remember(movie_keys, records)
+        movie_keys = list(dict.fromkeys(movie_keys))
+        self.segments[segment] = (movie_keys, fetched_at)
+        return movie_keys
+
+    async def ensure_keys(self, records: list):
+        """Ключи каталога для записей; неизвестные записи сохраняются"""
+        missing = list({(record['media_type'], record['id']): record for record in records
+                        if (record['media_type'], record['id']) not in self.keys}.values())
+        if missing:
+            movie_keys = await storage.store.run(save_catalog_movies, missing, self.clock())
+            self._remember(movie_keys, missing)
+        return [self.keys[(record['media_type'], record['id'])] for record in records]
+
+    async def get_movies(self, movie_keys: list):
+        """Записи по ключам каталога; отсутствующие в памяти дочитываются из базы данных"""
+        missing = [movie_key for movie_key in movie_keys if movie_key not in self.movies]
+        if missing:
+            self.movies.update(await storage.store.read(load_catalog_movies, missing))
+        return [self.movies[movie_key] for movie_key in movie_keys]
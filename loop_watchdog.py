@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import functools
+import traceback
+from collections import deque
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Задержка цикла событий, после которой снимается стек (0 отключает сторожа), и период проверки
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv('LOOP_WATCHDOG_THRESHOLD', '0.25'))
+LOOP_WATCHDOG_INTERVAL = float(os.getenv('LOOP_WATCHDOG_INTERVAL', '0.05'))
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+loop_lag_seconds = registry.histogram(
+    'bot_event_loop_lag_seconds', 'Задержка срабатывания таймеров цикла событий',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+loop_blocks = registry.counter(
+    'bot_event_loop_blocks', 'Блокировки цикла событий дольше порога по функции проекта', ('function',))
+
+def blocking_function(stack):
+    """Самая глубокая функция проекта в стеке - вероятный виновник блокировки"""
+    for frame in reversed(stack):
+        if frame.filename.startswith(PROJECT_DIR) and os.path.abspath(frame.filename) != os.path.abspath(__file__):
+            return f"{os.path.relpath(frame.filename, PROJECT_DIR)}:{frame.lineno}({frame.name})"
+    return stack[-1].name if stack else 'unknown'
+
+class LoopWatchdog:
+    """Сторож цикла событий: замечает синхронные вызовы, которые держат цикл.
+
+    Цикл событий раз в interval отмечает пульс, а отдельный поток проверяет,
+    как давно это было. Если пульса нет дольше threshold, поток снимает стек
+    потока цикла событий - в нем видна функция, которая сейчас блокирует цикл
+    (например, синхронный запрос к SQLite или sleep внутри обработчика).
+    Задержка каждого пульса попадает в метрики.
+    """
+
+    def __init__(self, threshold: float = LOOP_WATCHDOG_THRESHOLD, interval: float = LOOP_WATCHDOG_INTERVAL,
+                 history: int = 20):
+        self.threshold = threshold
+        self.interval = interval
+        self.blocks = deque(maxlen=history)  # последние блокировки: (длительность на момент снятия, функция, стек)
+        self._beat = None
+        self._loop = None
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Запуск пульса в текущем цикле событий и потока-наблюдателя"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._task = self._loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info(f"Сторож цикла событий запущен: порог {self.threshold * 1000:g} мс")
+
+    async def stop(self):
+        """Остановка пульса и потока-наблюдателя"""
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+
+    async def _heartbeat(self):
+        """Пульс цикла событий; опоздание пробуждения - это задержка цикла"""
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = now = time.monotonic()
+            loop_lag_seconds.observe(max(now - expected, 0))
+
+    def _watch(self):
+        """Поток-наблюдатель: снимок стека цикла, если пульс задерживается"""
+        reported = None
+        while not self._stopped.wait(self.interval / 2):
+            beat = self._beat
+            lag = time.monotonic() - beat
+            if lag < self.threshold or beat == reported:
+                continue
+            # Одна блокировка (один пропущенный пульс) отмечается один раз
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            function = blocking_function(stack)
+            self.blocks.append((lag, function, stack))
+            # Метрики обновляются только из цикла событий: счетчик увеличится, когда цикл освободится
+            self._loop.call_soon_threadsafe(functools.partial(loop_blocks.inc, function=function))
+            logger.warning(
+                f"Цикл событий заблокирован дольше {lag * 1000:.0f} мс в {function}:\n"
+                + ''.join(traceback.format_list(stack[-8:]))
+            )
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import logging
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Сроки хранения данных в секундах: завершенные игры, брошенные незавершенные игры и опросники
+GAME_RETENTION = float(os.getenv('GAME_RETENTION', str(30 * 24 * 3600)))
+STALE_GAME_RETENTION = float(os.getenv('STALE_GAME_RETENTION', str(90 * 24 * 3600)))
+SURVEY_TEMP_TTL = float(os.getenv('SURVEY_TEMP_TTL', str(24 * 3600)))
+
+# Период обслуживания базы данных и сколько свободных страниц возвращать за один проход
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', str(6 * 3600)))
+VACUUM_STEP_PAGES = int(os.getenv('VACUUM_STEP_PAGES', '2000'))
+
+def purge_expired_data(game_max_age: float = GAME_RETENTION, temp_max_age: float = SURVEY_TEMP_TTL,
+                       stale_max_age: float = STALE_GAME_RETENTION):
+    """Удаление старых игр с их голосами и указателями, старых опросников и брошенных временных данных.
+
+    Завершенные игры удаляются через game_max_age, а незавершенные - только
+    через stale_max_age, чтобы не удалить игру, которая еще идет.
+    Возвращает количество удаленных строк по таблицам.
+    """
+    game_cutoff = f'-{int(game_max_age)} seconds'
+    stale_cutoff = f'-{int(stale_max_age)} seconds'
+    temp_cutoff = f'-{int(temp_max_age)} seconds'
+    expired_games = '''
+        SELECT game_id FROM games
+        WHERE (status = ? AND created_at < datetime('now', ?))
+           OR (status != ? AND created_at < datetime('now', ?))
+    '''
+    expired_params = (storage.GAME_FINISHED, game_cutoff, storage.GAME_FINISHED, stale_cutoff)
+    with storage.db.connection() as conn:
+        deleted = {
+            'votes': conn.execute(
+                f"DELETE FROM votes WHERE game_id IN ({expired_games})", expired_params
+            ).rowcount,
+            'chat_active_games': conn.execute(
+                f"DELETE FROM chat_active_games WHERE game_id IN ({expired_games})", expired_params
+            ).rowcount,
+            'games': conn.execute(
+                f"DELETE FROM games WHERE game_id IN ({expired_games})", expired_params
+            ).rowcount,
+            'surveys': conn.execute("DELETE FROM surveys WHERE created_at < datetime('now', ?)", (game_cutoff,)).rowcount,
+            'survey_temp_data': conn.execute(
+                "DELETE FROM survey_temp_data WHERE created_at < datetime('now', ?)", (temp_cutoff,)
+            ).rowcount
+        }
+    return deleted
+
+def database_size():
+    """Размер базы данных в байтах (по количеству страниц)"""
+    with storage.db.connection() as conn:
+        return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+def compact_database(max_pages: int = VACUUM_STEP_PAGES):
+    """Возврат свободных страниц файлу (incremental vacuum) и PRAGMA optimize.
+
+    Возвращает, сколько байт осталось на свободных страницах.
+    """
+    with storage.db.connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:  # INCREMENTAL
+            free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            # Модуль sqlite3 выполняет один шаг PRAGMA за вызов, а каждый шаг освобождает одну страницу
+            for _ in range(min(free_pages, max_pages)):
+                conn.execute('PRAGMA incremental_vacuum(1)')
+        conn.execute('PRAGMA optimize')
+        return conn.execute('PRAGMA freelist_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+def enable_incremental_vacuum():
+    """Однократный перевод базы, созданной без auto_vacuum, в режим INCREMENTAL.
+
+    Требует полного VACUUM, поэтому выполняется на отдельном соединении монопольной
+    задачей писателя (store.run_exclusive), когда ни одна транзакция не открыта.
+    Возвращает True, если база была переведена.
+    """
+    conn = sqlite3.connect(storage.db.path, isolation_level=None, timeout=storage.SQLITE_BUSY_TIMEOUT / 1000)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+async def run_maintenance(game_max_age: float = GAME_RETENTION, temp_max_age: float = SURVEY_TEMP_TTL,
+                          max_pages: int = VACUUM_STEP_PAGES, stale_max_age: float = STALE_GAME_RETENTION):
+    """Полный проход обслуживания базы данных; возвращает отчет"""
+    size_before = await storage.store.read(database_size)
+    deleted = await storage.store.run(purge_expired_data, game_max_age, temp_max_age, stale_max_age)
+    converted = await storage.store.run_exclusive(enable_incremental_vacuum)
+    remaining = await storage.store.run(compact_database, max_pages)
+    reclaimed = size_before - await storage.store.read(database_size)
+    report = {'deleted': deleted, 'converted': converted, 'reclaimed_bytes': reclaimed, 'free_bytes': remaining}
+    logger.info(
+        f"Обслуживание базы данных: удалено {sum(deleted.values())} строк {deleted}, "
+        f"освобождено {reclaimed // 1024} КБ, свободно в файле еще {remaining // 1024} КБ"
+    )
+    return report
@@ -0,0 +1,97 @@
+import os
+import asyncio
+import logging
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from cache import TTLCache
+from rendering import fit_message
+
+logger = logging.getLogger(__name__)
+
+# Окно, в течение которого правки одного сообщения объединяются в одну
+EDIT_COALESCE_WINDOW = float(os.getenv('EDIT_COALESCE_WINDOW', '1.0'))
+
+class EditCoalescer:
+    """Объединение частых правок одного сообщения.
+
+    Правки копятся в течение окна, после чего отправляется только последнее
+    состояние. Если текст и клавиатура не изменились с прошлой отправки,
+    правка пропускается, а при RetryAfter отправка откладывается на время,
+    указанное Telegram. После сетевой ошибки или таймаута правка повторяется
+    один раз в следующем окне.
+    """
+
+    def __init__(self, window: float = EDIT_COALESCE_WINDOW):
+        self.window = window
+        self.sent = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.flood_waits = 0
+        self.errors = 0
+        self._pending = {}  # (chat_id, message_id) -> (text, reply_markup)
+        self._tasks = {}    # (chat_id, message_id) -> задача отправки
+        self._last_sent = TTLCache(maxsize=10000, ttl=3600)
+
+    def submit(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """Постановка правки в очередь; возвращается сразу"""
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = (fit_message(text), reply_markup)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(self._flush_later(bot, key))
+
+    def discard(self, chat_id: int, message_id: int):
+        """Отмена ожидающих правок (например, перед финальным редактированием сообщения)"""
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _flush_later(self, bot, key: tuple):
+        """Отправка последнего состояния сообщения по истечении окна"""
+        retried = False
+        try:
+            while True:
+                # Не чаще одной правки сообщения за окно
+                await asyncio.sleep(self.window)
+                state = self._pending.pop(key, None)
+                if state is None:
+                    break
+                if self._last_sent.get(key) == state:
+                    self.skipped += 1
+                    continue
+
+                text, reply_markup = state
+                try:
+                    await bot.edit_message_text(text, chat_id=key[0], message_id=key[1], reply_markup=reply_markup)
+                    self._last_sent.set(key, state)
+                    self.sent += 1
+                    retried = False
+                except RetryAfter as e:
+                    # Ждем, сколько просит Telegram, и отправляем самое свежее состояние
+                    self.flood_waits += 1
+                    self._pending.setdefault(key, state)
+                    logger.warning(f"Flood control для сообщения {key}, ждем {e.retry_after} с")
+                    await asyncio.sleep(float(e.retry_after))
+                except BadRequest as e:
+                    if "not modified" in str(e).lower():
+                        self._last_sent.set(key, state)
+                        self.skipped += 1
+                    else:
+                        logger.warning(f"Не удалось отредактировать сообщение {key}: {e}")
+                except TelegramError as e:
+                    # Сетевая ошибка или таймаут: состояние возвращается в очередь для одного повтора
+                    self.errors += 1
+                    if retried:
+                        logger.warning(f"Не удалось отредактировать сообщение {key} после повтора: {e}")
+                        retried = False
+                    else:
+                        logger.warning(f"Ошибка при редактировании сообщения {key}, повторим: {e}")
+                        self._pending.setdefault(key, state)
+                        retried = True
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
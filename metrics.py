@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Адрес HTTP-эндпоинта с метриками; порт 0 отключает его
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Границы корзин гистограмм длительности в секундах
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value):
+    """Экранирование значения метки для текстового формата Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: tuple, values: tuple, extra: str = ''):
+    """Метки в виде {name="value",...}"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Счетчик событий с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # значения меток -> число
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}_total{_format_labels(self.labelnames, key)} {value:g}"
+
+class Histogram:
+    """Гистограмма длительностей с метками (накопительные корзины, сумма и количество)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # значения меток -> [счетчики корзин..., +Inf], сумма
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, **labels):
+        entry = self.values.get(tuple(labels[name] for name in self.labelnames))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total:.6f}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+class Registry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus.
+
+    Метрики обновляются из цикла событий, поэтому обходятся без блокировок.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Все метрики в текстовом формате exposition 0.0.4"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Длительность обработчиков обновлений', ('handler',))
+handler_errors = registry.counter(
+    'bot_handler_errors', 'Исключения в обработчиках обновлений', ('handler',))
+storage_seconds = registry.histogram(
+    'bot_storage_seconds', 'Длительность операций хранилища вместе с ожиданием в очереди', ('operation',))
+storage_errors = registry.counter(
+    'bot_storage_errors', 'Ошибки операций хранилища', ('operation',))
+tmdb_seconds = registry.histogram(
+    'bot_tmdb_request_seconds', 'Длительность запросов к TMDb API', ('path',))
+tmdb_errors = registry.counter(
+    'bot_tmdb_request_errors', 'Неудачные запросы к TMDb API', ('path',))
+telegram_seconds = registry.histogram(
+    'bot_telegram_request_seconds', 'Длительность запросов к Telegram Bot API', ('method',))
+telegram_errors = registry.counter(
+    'bot_telegram_request_errors', 'Неудачные запросы к Telegram Bot API', ('method',))
+
+@contextmanager
+def measure(histogram: Histogram, errors: Counter, **labels):
+    """Замер длительности блока в histogram; исключение учитывается в errors"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+def instrument_handler(callback, name: str = None, route=None):
+    """Обертка обработчика с замером длительности и подсчетом ошибок.
+
+    Метка handler - name или результат route(update), например префикс callback_data.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        label = route(update) if route is not None else (name or callback.__name__)
+        with measure(handler_seconds, handler_errors, handler=label):
+            return await callback(update, context)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest с замером длительности каждого вызова Bot API по методу"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # Последний сегмент URL - метод API; токен из пути в метки не попадает
+        api_method = url.rsplit('/', 1)[-1]
+        with measure(telegram_seconds, telegram_errors, method=api_method):
+            return await super().do_request(url, method, *args, **kwargs)
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Ответ на HTTP-запрос: GET /metrics отдает метрики, остальное - 404"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их нужно дочитать до пустой строки
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        logger.debug(f"Запрос метрик прерван: {e!r}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Запуск HTTP-эндпоинта /metrics; возвращает asyncio.Server"""
+    server = await asyncio.start_server(_handle_connection, host, port)
+    address = server.sockets[0].getsockname()
+    logger.info(f"Метрики доступны на http://{address[0]}:{address[1]}/metrics")
+    return server
@@ -0,0 +1,73 @@
+import os
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений обрабатывается одновременно и сколько может ждать своей очереди
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '256'))
+
+def ordering_key(update):
+    """Ключ, в пределах которого обновления обрабатываются строго по порядку.
+
+    Игра всегда живет в одном чате, поэтому порядок по чату сохраняет и порядок
+    голосов и изменений сетки каждой игры.
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return ('chat', update.effective_chat.id)
+    if update.effective_user is not None:
+        return ('user', update.effective_user.id)
+    return None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных чатов с порядком внутри чата.
+
+    Обновления одного чата ждут друг друга на общей блокировке (в порядке
+    поступления), а обновления разных чатов выполняются одновременно, но не
+    больше max_concurrent_updates за раз. Семафор базового класса ограничивает
+    общее число обновлений в работе, включая ожидающие своей очереди.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY, max_pending_updates: int = UPDATE_MAX_PENDING,
+                 key_func=ordering_key):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.concurrency = max(max_concurrent_updates, 1)
+        self.key_func = key_func
+        self._running = asyncio.Semaphore(self.concurrency)
+        self._locks = {}  # ключ -> [блокировка, количество обновлений в очереди]
+
+    async def do_process_update(self, update, coroutine):
+        """Обработка обновления после всех предыдущих обновлений того же чата"""
+        key = self.key_func(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        """Ресурсы создаются в конструкторе, дополнительная инициализация не нужна"""
+
+    async def shutdown(self):
+        """Сброс блокировок чатов"""
+        if self._locks:
+            logger.warning(f"Остановка обработки обновлений: в очереди {len(self._locks)} чатов")
+        self._locks.clear()
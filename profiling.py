@@ -0,0 +1,131 @@
+import os
+import time
+import pstats
+import cProfile
+import logging
+import functools
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Кто может запускать /profile (ID пользователей через запятую) и куда сохраняются отчеты
+PROFILE_ADMINS = {int(user_id) for user_id in os.getenv('PROFILE_ADMINS', '').split(',') if user_id.strip()}
+PROFILE_DIR = os.getenv('PROFILE_DIR', '.')
+
+# Длительность профилирования по умолчанию и сразу после запуска бота (0 - не профилировать)
+PROFILE_DURATION = float(os.getenv('PROFILE_DURATION', '60'))
+PROFILE_MAX_DURATION = float(os.getenv('PROFILE_MAX_DURATION', '600'))
+PROFILE_ON_START = float(os.getenv('PROFILE_ON_START', '0'))
+
+# Обработчики и шаги корутин дольше порога попадают в отчет отдельно
+PROFILE_SLOW_THRESHOLD = float(os.getenv('PROFILE_SLOW_THRESHOLD', '0.1'))
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '15'))
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _function_label(key: tuple):
+    """Имя функции из ключа pstats: файл:строка(функция)"""
+    filename, line, name = key
+    if filename == '~':  # встроенные функции
+        return name
+    if filename.startswith(PROJECT_DIR):
+        filename = os.path.relpath(filename, PROJECT_DIR)
+    else:
+        filename = os.path.basename(filename)
+    return f"{filename}:{line}({name})"
+
+class Profiler:
+    """Профилирование цикла событий по запросу на ограниченное время.
+
+    На время сессии в потоке цикла событий включается cProfile, а обертки
+    обработчиков записывают обновления, обработка которых заняла больше
+    порога. cProfile считает каждое возобновление корутины отдельным вызовом,
+    поэтому среднее время вызова функции проекта - это время, на которое
+    один ее шаг занимает цикл событий. Вне сессии обертка только проверяет флаг.
+    """
+
+    def __init__(self, slow_threshold: float = PROFILE_SLOW_THRESHOLD, top: int = PROFILE_TOP,
+                 directory: str = PROFILE_DIR):
+        self.slow_threshold = slow_threshold
+        self.top = top
+        self.directory = directory
+        self._profile = None
+        self._started = None
+        self._slow_handlers = []  # (длительность, метка)
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        """Начало сессии; False, если профилирование уже идет"""
+        if self.active:
+            return False
+        self._slow_handlers = []
+        self._started = time.perf_counter()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        logger.info("Профилирование запущено")
+        return True
+
+    def stop(self):
+        """Завершение сессии; возвращает текст отчета и путь к файлу со статистикой"""
+        if not self.active:
+            return None, None
+        self._profile.disable()
+        elapsed = time.perf_counter() - self._started
+        stats = pstats.Stats(self._profile)
+        self._profile = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{datetime.now():%Y%m%d-%H%M%S}")
+        stats.dump_stats(f"{path}.prof")
+        report = self.report(stats, elapsed)
+        with open(f"{path}.txt", 'w', encoding='utf-8') as f:
+            f.write(report)
+        logger.info(f"Профилирование завершено за {elapsed:.1f} с, отчет в {path}.txt")
+        return report, f"{path}.prof"
+
+    def report(self, stats: pstats.Stats, elapsed: float):
+        """Текстовый отчет: медленные обработчики, функции проекта и самые дорогие функции"""
+        threshold_ms = self.slow_threshold * 1000
+        lines = [f"📈 Профилирование за {elapsed:.1f} с", ""]
+
+        lines.append(f"Обработчики дольше {threshold_ms:g} мс: {len(self._slow_handlers)}")
+        for duration, label in sorted(self._slow_handlers, reverse=True)[:self.top]:
+            lines.append(f"  {duration * 1000:8.1f} мс  {label}")
+
+        # Время функций проекта в цикле событий: у корутин оно не включает ожидание после await
+        project = sorted(
+            ((cumulative, calls, key) for key, (primitive, calls, own, cumulative, callers) in stats.stats.items()
+             if key[0].startswith(PROJECT_DIR) and calls),
+            reverse=True
+        )
+        lines.append("")
+        lines.append(f"Функции проекта по времени в цикле событий (⚠️ - шаг в среднем дольше {threshold_ms:g} мс):")
+        for cumulative, calls, key in project[:self.top]:
+            mark = '⚠️ ' if cumulative / calls >= self.slow_threshold else ''
+            lines.append(f"  {cumulative * 1000:8.1f} мс x{calls}  {mark}{_function_label(key)}")
+
+        lines.append("")
+        lines.append("Больше всего собственного времени:")
+        by_own_time = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        for key, (primitive, calls, own, cumulative, callers) in by_own_time[:self.top]:
+            lines.append(f"  {own * 1000:8.1f} мс x{calls}  {_function_label(key)}")
+        return '\n'.join(lines) + '\n'
+
+    def wrap(self, callback, name: str = None, route=None):
+        """Обертка обработчика, записывающая медленные обновления во время сессии"""
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            if not self.active:
+                return await callback(update, context)
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                duration = time.perf_counter() - started
+                if duration >= self.slow_threshold:
+                    label = route(update) if route is not None else (name or callback.__name__)
+                    self._slow_handlers.append((duration, label))
+        return wrapper
@@ -0,0 +1,198 @@
+import os
+import random
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from cache import TTLCache
+
+# Ограничения Telegram
+MESSAGE_LIMIT = 4096       # длина текста сообщения в единицах UTF-16
+CALLBACK_DATA_LIMIT = 64   # длина callback_data в байтах
+BUTTON_LABEL_LIMIT = 64    # длина надписи кнопки (длиннее не помещается на экране)
+
+# Бюджеты полей сообщений в символах
+TITLE_LENGTH = int(os.getenv('TITLE_LENGTH', '100'))
+OVERVIEW_LENGTH = int(os.getenv('OVERVIEW_LENGTH', '700'))
+TALLY_OVERVIEW_LENGTH = int(os.getenv('TALLY_OVERVIEW_LENGTH', '300'))
+RESULT_OVERVIEW_LENGTH = 150
+COMPACT_LABEL_LENGTH = 23
+VOTERS_SHOWN = 10
+
+def utf16_length(text: str):
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def _cut_at_word(text: str):
+    """Отбрасывание оборванного слова в конце обрезанного текста"""
+    space = text.rfind(' ')
+    if space > len(text) // 2:
+        text = text[:space]
+    return text.rstrip(' ,.;:-—') + "..."
+
+def shorten(text: str, limit: int):
+    """Обрезка текста до limit символов по границе слова с многоточием"""
+    if len(text) <= limit:
+        return text
+    return _cut_at_word(text[:limit - 3])
+
+def fit_message(text: str, limit: int = MESSAGE_LIMIT):
+    """Жесткое ограничение длины всего сообщения"""
+    if utf16_length(text) <= limit:
+        return text
+    units = 0
+    for index, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit - 3:
+            return _cut_at_word(text[:index])
+    return text
+
+def button(label: str, data: str):
+    """Кнопка с проверкой длины надписи и callback_data"""
+    if len(data.encode('utf-8')) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {data!r}")
+    return InlineKeyboardButton(shorten(label, BUTTON_LABEL_LIMIT), callback_data=data)
+
+def format_movie_battle(movie1: dict, movie2: dict, round_num: int, total_rounds: int):
+    """Форматирование сообщения для битвы фильмов"""
+    message = f"⚔️ РАУНД {round_num}/{total_rounds}\n\n"
+    message += "Выбирай лучший фильм:\n\n"
+    
+    # Фильм 1
+    title1 = shorten(movie1.get('title', 'Без названия'), TITLE_LENGTH)
+    overview1 = shorten(movie1.get('overview', 'Описание отсутствует'), OVERVIEW_LENGTH)
+    
+    message += f"🎬 {title1}\n"
+    message += f"📝 {overview1}\n\n"
+    
+    # Фильм 2
+    title2 = shorten(movie2.get('title', 'Без названия'), TITLE_LENGTH)
+    overview2 = shorten(movie2.get('overview', 'Описание отсутствует'), OVERVIEW_LENGTH)
+    
+    message += f"🎬 {title2}\n"
+    message += f"📝 {overview2}\n\n"
+    
+    message += "Кто победит в этом раунде?"
+    
+    return fit_message(message)
+
+def format_battle_result(winner: dict, game_type: str):
+    """Форматирование результата битвы"""
+    title = shorten(winner.get('title', 'Без названия'), TITLE_LENGTH)
+    overview = shorten(winner.get('overview', 'Описание отсутствует'), RESULT_OVERVIEW_LENGTH)
+    
+    message = f"🏆 ПОБЕДИТЕЛЬ!\n\n"
+    message += f"🎬 {title}\n"
+    message += f"📝 {overview}\n\n"
+    
+    # Реферальные ссылки
+    streaming_links = get_streaming_links()
+    
+    # Выбираем несколько сервисов
+    all_services = []
+    for region, services in streaming_links.items():
+        for service, link in services.items():
+            all_services.append((service, link, region))
+    
+    num_services = random.randint(2, 3)
+    selected_services = random.sample(all_services, min(num_services, len(all_services)))
+    
+    message += "🎥 Где посмотреть:\n"
+    for service, link, region in selected_services:
+        message += f"• Смотреть на {service} ({region}): {link}\n"
+    
+    return fit_message(message)
+
+def get_streaming_links():
+    """Получение списка стриминговых сервисов"""
+    return {
+        'США': {
+            'Netflix': "https://netflix.com",
+            'Hulu': "https://hulu.com",
+            'Amazon Prime': "https://amazon.com/primevideo"
+        },
+        'ЕС': {
+            'Netflix': "https://netflix.com",
+            'Disney+': "https://disneyplus.com",
+            'HBO Max': "https://hbomax.com"
+        },
+        'СНГ': {
+            'Кинопоиск': "https://kinopoisk.ru",
+            'Okko': "https://okko.tv",
+            'Ivi': "https://ivi.ru"
+        }
+    }
+
+class RoundView:
+    """Неизменные части сообщений одного раунда: текст битвы, описания и кнопки.
+
+    Строится один раз на раунд; при каждом голосе к готовым частям
+    добавляются только строки со счетчиками.
+    """
+
+    def __init__(self, game_id: int, round_num: int, total_rounds: int, movie1: dict, movie2: dict, compact: bool = False):
+        title1 = shorten(movie1.get('title', 'Без названия'), TITLE_LENGTH)
+        title2 = shorten(movie2.get('title', 'Без названия'), TITLE_LENGTH)
+        self.text = format_movie_battle(movie1, movie2, round_num, total_rounds)
+
+        # Одиночный режим показывает короткие названия на кнопках, групповой - полные
+        label_length = COMPACT_LABEL_LENGTH if compact else BUTTON_LABEL_LIMIT
+        vote_row = [
+            button(f"🎬 {shorten(title1, label_length)}", f"vote_1_{game_id}"),
+            button(f"🎬 {shorten(title2, label_length)}", f"vote_2_{game_id}")
+        ]
+        self.markup = InlineKeyboardMarkup([vote_row])
+        self.finish_markup = InlineKeyboardMarkup([
+            vote_row,
+            [button("✅ Завершить раунд", f"finish_round_{game_id}")]
+        ])
+
+        self._titles = (title1, title2)
+        self.descriptions = (
+            f"🎬 **{title1}**\n📝 {shorten(movie1.get('overview', 'Описание отсутствует'), TALLY_OVERVIEW_LENGTH)}\n\n"
+            f"🎬 **{title2}**\n📝 {shorten(movie2.get('overview', 'Описание отсутствует'), TALLY_OVERVIEW_LENGTH)}\n\n"
+        )
+        self._voters = []
+
+    def voters_line(self, count: int):
+        """Строка со списком проголосовавших: первые VOTERS_SHOWN и количество остальных"""
+        while len(self._voters) < min(count, VOTERS_SHOWN):
+            self._voters.append(f"👤 Участник {len(self._voters) + 1}")
+        line = ', '.join(self._voters[:count])
+        if count > VOTERS_SHOWN:
+            line += f" и еще {count - VOTERS_SHOWN}"
+        return line
+
+    def tally(self, voter_name: str, counts, voters: int, members: int):
+        """Сообщение с промежуточными результатами голосования"""
+        title1, title2 = self._titles
+        message = (
+            f"🗳️ **{shorten(voter_name, BUTTON_LABEL_LIMIT)}** проголосовал!\n\n"
+            f"📊 **Текущие результаты:**\n🎬 {title1}: {counts[0]} голосов\n🎬 {title2}: {counts[1]} голосов\n\n"
+        )
+        if voters:
+            message += f"✅ **Проголосовали:** {self.voters_line(voters)}\n\n"
+        message += self.descriptions + f"📊 **Прогресс:** {voters}/{members} участников проголосовали\n\n"
+        return fit_message(message)
+
+class BattleRenderer:
+    """Кэш отрисованных раундов по (game_id, раунд, пара фильмов)"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def view(self, game_id: int, round_num: int, total_rounds: int, pair, movies, compact: bool = False):
+        """Готовое представление раунда; строится при первом обращении"""
+        key = (game_id, round_num, tuple(pair))
+        view = self.cache.get(key)
+        if view is None:
+            view = RoundView(game_id, round_num, total_rounds, movies[0], movies[1], compact)
+            self.cache.set(key, view)
+        return view
+
+    def cached(self, game_id: int, round_num: int, pair):
+        """Представление раунда из кэша или None"""
+        return self.cache.get((game_id, round_num, tuple(pair)))
+
+    def discard(self, game_id: int, round_num: int, pair):
+        """Удаление представления завершенного раунда"""
+        self.cache.pop((game_id, round_num, tuple(pair)))
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RoundScheduler:
+    """Отложенные действия игр: переход к следующему раунду и таймаут раунда.
+
+    Обработчик обновления только ставит действие в очередь и сразу
+    завершается. Действия выполняются через JobQueue приложения, а если его
+    нет (например, в тестах) - через таймеры цикла событий. Повторное
+    планирование под тем же именем заменяет предыдущее действие.
+    """
+
+    def __init__(self):
+        self._handles = {}  # имя -> asyncio.TimerHandle (без JobQueue)
+        self._tasks = set()
+
+    def schedule(self, context, name: str, delay: float, callback, *args):
+        """Вызов callback(context, *args) через delay секунд"""
+        self.cancel(context, name)
+        if context.job_queue is not None:
+            async def job(job_context):
+                await callback(job_context, *args)
+            context.job_queue.run_once(job, delay, name=name)
+        else:
+            loop = asyncio.get_running_loop()
+            self._handles[name] = loop.call_later(delay, self._fire, name, context, callback, args)
+
+    def cancel(self, context, name: str):
+        """Отмена запланированного действия"""
+        if context.job_queue is not None:
+            for job in context.job_queue.get_jobs_by_name(name):
+                job.schedule_removal()
+        handle = self._handles.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+
+    def pending(self):
+        """Имена действий, ожидающих выполнения на таймерах цикла событий"""
+        return list(self._handles)
+
+    def _fire(self, name: str, context, callback, args: tuple):
+        """Запуск действия по таймеру цикла событий"""
+        self._handles.pop(name, None)
+        task = asyncio.ensure_future(callback(context, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        """Логирование ошибок действий, запущенных без JobQueue"""
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка отложенного действия: {task.exception()}")
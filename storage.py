@@ -0,0 +1,761 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import queue
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from bracket import Bracket
+from metrics import measure, storage_seconds, storage_errors
+
+logger = logging.getLogger(__name__)
+
+# Путь к базе данных и настройки SQLite
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'users.db')
+SQLITE_CACHED_STATEMENTS = int(os.getenv('SQLITE_CACHED_STATEMENTS', '256'))
+
+# Максимальное количество запросов к хранилищу, ожидающих выполнения в потоках базы данных
+STORAGE_MAX_PENDING = int(os.getenv('STORAGE_MAX_PENDING', '64'))
+# Сколько записей поток-писатель объединяет в одну транзакцию и сколько потоков обслуживают чтения
+STORAGE_WRITE_BATCH = int(os.getenv('STORAGE_WRITE_BATCH', '64'))
+STORAGE_READERS = int(os.getenv('STORAGE_READERS', '2'))
+
+# Журнал и надежность фиксации: WAL не блокирует читателей во время записи,
+# а synchronous=NORMAL в режиме WAL не делает fsync на каждую транзакцию
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))
+
+# Статусы игр
+GAME_SURVEYING = 'surveying'
+GAME_RUNNING = 'running'
+GAME_FINISHED = 'finished'
+
+# PRAGMA, которые применяются к каждому новому соединению
+# (auto_vacuum действует только для новых баз, старые переводятся обслуживанием)
+DEFAULT_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': SQLITE_JOURNAL_MODE,
+    'synchronous': SQLITE_SYNCHRONOUS,
+    'busy_timeout': str(SQLITE_BUSY_TIMEOUT),
+    'cache_size': '-8000',
+    'temp_store': 'MEMORY'
+}
+
+def parse_pragmas(value: str):
+    """Разбор строки вида 'cache_size=-8000,temp_store=MEMORY' в словарь PRAGMA"""
+    pragmas = {}
+    for item in (value or '').split(','):
+        if '=' not in item:
+            continue
+        name, pragma_value = item.split('=', 1)
+        pragmas[name.strip()] = pragma_value.strip()
+    return pragmas
+
+class Database:
+    """Долгоживущие соединения с SQLite: по одному на поток, с кэшем подготовленных запросов"""
+
+    def __init__(self, path: str = DATABASE_PATH, pragmas: dict = None, cached_statements: int = SQLITE_CACHED_STATEMENTS):
+        self.path = path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(parse_pragmas(os.getenv('SQLITE_PRAGMAS', '')))
+        self.pragmas.update(pragmas or {})
+        self.cached_statements = cached_statements
+        self.checkouts = 0
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Открытие нового соединения и применение PRAGMA"""
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._connections.append(conn)
+        logger.debug(f"Открыто соединение с {self.path} (PRAGMA: {self.pragmas})")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Выдача соединения текущего потока.
+
+        Вложенные вызовы переиспользуют ту же выдачу, а фиксация транзакции
+        происходит только при выходе из внешнего блока.
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self._connect()
+            local.depth = 0
+
+        outermost = local.depth == 0
+        if outermost:
+            self.checkouts += 1
+        local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            local.depth -= 1
+            if outermost:
+                conn.rollback()
+            raise
+        else:
+            local.depth -= 1
+            if outermost:
+                conn.commit()
+
+    def close(self):
+        """Закрытие всех открытых соединений"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+db = Database()
+
+def configure_database(path: str = DATABASE_PATH, pragmas: dict = None):
+    """Переключение хранилища на другой файл базы данных (например, во временный для тестов)"""
+    global db
+    db.close()
+    db = Database(path, pragmas)
+    return db
+
+def _migrate_users_current_state(conn):
+    """Колонка current_state в таблице users (для баз, созданных до ее появления)"""
+    try:
+        conn.execute('SELECT current_state FROM users LIMIT 1')
+    except sqlite3.OperationalError:
+        conn.execute('ALTER TABLE users ADD COLUMN current_state TEXT DEFAULT "waiting_mode"')
+
+def _migrate_lookup_indexes(conn):
+    """Составные индексы под частые выборки игр и опросников"""
+    # get_current_game: WHERE user_id = ? AND chat_id = ? ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_games_user_chat_created ON games (user_id, chat_id, created_at)')
+    # get_active_group_game: WHERE chat_id = ? AND game_type = 'group' ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_games_chat_type_created ON games (chat_id, game_type, created_at)')
+    # get_group_survey_data, get_survey_participants_count, get_survey_user_ids, clear_old_surveys
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_surveys_chat_user ON surveys (chat_id, user_id)')
+    # get_survey_data, delete_user_surveys: WHERE user_id = ? AND chat_id = ? ORDER BY created_at DESC
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_surveys_user_chat_created ON surveys (user_id, chat_id, created_at)')
+
+def _migrate_game_status(conn):
+    """Статус игры и указатель на текущую игру чата"""
+    conn.execute("ALTER TABLE games ADD COLUMN status TEXT NOT NULL DEFAULT 'running'")
+    # Статус игр, созданных до появления колонки, неизвестен: считаем их завершенными
+    conn.execute("UPDATE games SET status = 'finished'")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_active_games (
+            chat_id INTEGER PRIMARY KEY,
+            game_id INTEGER,
+            status TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+# Миграции схемы по порядку: номер миграции - ее позиция в списке, начиная с 1.
+# Номер последней примененной миграции хранится в PRAGMA user_version.
+# Новые миграции только добавляются в конец списка.
+MIGRATIONS = [
+    _migrate_users_current_state,
+    _migrate_lookup_indexes,
+    _migrate_game_status,
+]
+
+def migrate_database(conn):
+    """Применение недостающих миграций схемы; возвращает версию схемы"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        logger.info(f"Применена миграция базы данных {number}: {migration.__doc__}")
+    return max(version, len(MIGRATIONS))
+
+def init_database():
+    """Инициализация базы данных"""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                current_state TEXT DEFAULT 'waiting_mode',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+
+        # Таблица игр
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS games (
+                game_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                game_type TEXT,
+                movies_list TEXT,
+                current_round INTEGER DEFAULT 1,
+                total_rounds INTEGER,
+                current_pair TEXT,
+                votes TEXT,
+                survey_data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+
+        # Таблица опросников
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS surveys (
+                survey_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                selected_genres TEXT,
+                content_type TEXT,
+                year_range TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+
+        # Таблица временных данных опросников
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS survey_temp_data (
+                user_id INTEGER,
+                chat_id INTEGER,
+                selected_genres TEXT,
+                content_type TEXT,
+                year_range TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, chat_id)
+            )
+        ''')
+
+        # Голоса битв по раундам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS votes (
+                game_id INTEGER NOT NULL,
+                round INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                choice INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (game_id, round, user_id)
+            )
+        ''')
+
+        # Локальный каталог фильмов и сериалов из TMDb
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS catalog_movies (
+                movie_key INTEGER PRIMARY KEY AUTOINCREMENT,
+                media_type TEXT NOT NULL,
+                tmdb_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                genre_ids TEXT,
+                release_date TEXT,
+                popularity REAL,
+                updated_at REAL,
+                UNIQUE (media_type, tmdb_id)
+            )
+        ''')
+
+        # Сегменты каталога: какие записи вернул TMDb на нормализованный запрос и когда
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS catalog_segments (
+                segment TEXT PRIMARY KEY,
+                movie_keys TEXT,
+                fetched_at REAL
+            )
+        ''')
+
+        # Доводим схему до актуальной версии
+        migrate_database(conn)
+
+def save_user_state(user_id: int, state: str):
+    """Сохранение состояния пользователя"""
+    with db.connection() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO users (user_id, current_state)
+            VALUES (?, ?)
+        ''', (user_id, state))
+
+def get_user_state(user_id: int):
+    """Получение состояния пользователя"""
+    with db.connection() as conn:
+        result = conn.execute('SELECT current_state FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return result[0] if result else 'waiting_mode'
+
+def create_game(user_id: int, chat_id: int, game_type: str, bracket: Bracket):
+    """Создание новой игры"""
+    # Сохраняем сетку как компактный JSON-список целых чисел
+    movies_json = json.dumps(bracket.to_list())
+    total_rounds = bracket.total_rounds  # Количество раундов до победителя
+
+    with db.connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO games (user_id, chat_id, game_type, movies_list, total_rounds, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, game_type, movies_json, total_rounds, GAME_RUNNING))
+        if game_type == 'group':
+            # Новая групповая игра становится текущей игрой чата
+            set_chat_active_game(chat_id, cursor.lastrowid, GAME_RUNNING)
+    return cursor.lastrowid
+
+def finish_game(game_id: int):
+    """Отметка игры как завершенной и снятие указателя на нее"""
+    with db.connection() as conn:
+        conn.execute('UPDATE games SET status = ? WHERE game_id = ?', (GAME_FINISHED, game_id))
+        conn.execute('DELETE FROM chat_active_games WHERE game_id = ?', (game_id,))
+
+def set_chat_active_game(chat_id: int, game_id: int, status: str):
+    """Установка текущей игры чата (game_id равен None, пока идет опросник)"""
+    with db.connection() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO chat_active_games (chat_id, game_id, status)
+            VALUES (?, ?, ?)
+        ''', (chat_id, game_id, status))
+
+def get_chat_active_game(chat_id: int):
+    """Текущая игра чата в виде (game_id, status) или None"""
+    with db.connection() as conn:
+        return conn.execute('SELECT game_id, status FROM chat_active_games WHERE chat_id = ?', (chat_id,)).fetchone()
+
+def clear_chat_active_game(chat_id: int):
+    """Снятие указателя на текущую игру чата"""
+    with db.connection() as conn:
+        conn.execute('DELETE FROM chat_active_games WHERE chat_id = ?', (chat_id,))
+
+def get_current_game(user_id: int, chat_id: int):
+    """Получение текущей игры"""
+    with db.connection() as conn:
+        return conn.execute('''
+            SELECT * FROM games
+            WHERE user_id = ? AND chat_id = ?
+            ORDER BY created_at DESC LIMIT 1
+        ''', (user_id, chat_id)).fetchone()
+
+def get_current_game_by_id(game_id: int):
+    """Получение игры по ID"""
+    with db.connection() as conn:
+        return conn.execute('SELECT * FROM games WHERE game_id = ?', (game_id,)).fetchone()
+
+def update_game_round(game_id: int, current_round: int, current_pair: str, votes: str = None):
+    """Обновление раунда игры"""
+    with db.connection() as conn:
+        if votes:
+            conn.execute('''
+                UPDATE games
+                SET current_round = ?, current_pair = ?, votes = ?
+                WHERE game_id = ?
+            ''', (current_round, current_pair, votes, game_id))
+        else:
+            conn.execute('''
+                UPDATE games
+                SET current_round = ?, current_pair = ?
+                WHERE game_id = ?
+            ''', (current_round, current_pair, game_id))
+
+def save_game_bracket(game_id: int, bracket: Bracket):
+    """Сохранение состояния сетки и номера раунда игры"""
+    with db.connection() as conn:
+        conn.execute('UPDATE games SET movies_list = ?, current_round = ? WHERE game_id = ?',
+                     (json.dumps(bracket.to_list()), bracket.round, game_id))
+
+def load_game_bracket(game):
+    """Сетка игры из строки таблицы games"""
+    return Bracket.from_list(json.loads(game[4]))  # movies_list
+
+def save_votes(rows: list):
+    """Пакетное сохранение голосов (game_id, round, user_id, choice) одной транзакцией"""
+    with db.connection() as conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO votes (game_id, round, user_id, choice)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+
+def load_round_votes(game_id: int, round_num: int):
+    """Голоса раунда в виде списка (user_id, choice) в порядке поступления"""
+    with db.connection() as conn:
+        return conn.execute('''
+            SELECT user_id, choice FROM votes
+            WHERE game_id = ? AND round = ?
+            ORDER BY rowid
+        ''', (game_id, round_num)).fetchall()
+
+def save_survey_data(user_id: int, chat_id: int, selected_genres: list, content_type: str, year_range: str):
+    """Сохранение данных опросника"""
+    genres_json = json.dumps(selected_genres)
+
+    with db.connection() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO surveys (user_id, chat_id, selected_genres, content_type, year_range)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, genres_json, content_type, year_range))
+
+def get_survey_data(user_id: int, chat_id: int):
+    """Получение данных опросника"""
+    with db.connection() as conn:
+        result = conn.execute('''
+            SELECT selected_genres, content_type, year_range
+            FROM surveys
+            WHERE user_id = ? AND chat_id = ?
+            ORDER BY created_at DESC LIMIT 1
+        ''', (user_id, chat_id)).fetchone()
+
+    if result:
+        return {
+            'selected_genres': json.loads(result[0]),
+            'content_type': result[1],
+            'year_range': result[2]
+        }
+    return None
+
+def get_active_group_game(chat_id: int):
+    """Получение активной игры в группе по указателю чата"""
+    with db.connection() as conn:
+        return conn.execute('''
+            SELECT games.* FROM chat_active_games
+            JOIN games ON games.game_id = chat_active_games.game_id
+            WHERE chat_active_games.chat_id = ? AND chat_active_games.status = ?
+        ''', (chat_id, GAME_RUNNING)).fetchone()
+
+def get_group_survey_data(chat_id: int):
+    """Получает объединенные данные всех завершенных опросников для данного группового чата."""
+    logger.debug(f"Получение данных опросника для чата {chat_id}")
+    with db.connection() as conn:
+        results = conn.execute('SELECT user_id, selected_genres, content_type, year_range FROM surveys WHERE chat_id = ?', (chat_id,)).fetchall()
+
+    logger.debug(f"Найдено {len(results)} завершенных опросников для чата {chat_id}")
+
+    if not results:
+        logger.warning(f"Нет завершенных опросников для чата {chat_id}")
+        return None
+
+    # Объединяем данные всех участников
+    all_genres = set()
+    content_types = {}
+    year_ranges = {}
+
+    for row in results:
+        genres = json.loads(row[1])
+        content_type = row[2]
+        year_range = row[3]
+
+        # Добавляем жанры
+        all_genres.update(genres)
+
+        # Подсчитываем типы контента
+        content_types[content_type] = content_types.get(content_type, 0) + 1
+
+        # Подсчитываем годы
+        year_ranges[year_range] = year_ranges.get(year_range, 0) + 1
+
+    # Выбираем наиболее популярные варианты
+    most_popular_content_type = max(content_types.items(), key=lambda x: x[1])[0]
+    most_popular_year_range = max(year_ranges.items(), key=lambda x: x[1])[0]
+
+    result = {
+        'selected_genres': list(all_genres),
+        'content_type': most_popular_content_type,
+        'year_range': most_popular_year_range
+    }
+
+    logger.debug(f"Агрегированные данные опросника для чата {chat_id}: {result}")
+    return result
+
+def save_user_survey_temp_data(user_id: int, chat_id: int, selected_genres: list = None, content_type: str = None, year_range: str = None):
+    """Сохранение временных данных опросника пользователя"""
+    with db.connection() as conn:
+        # Получаем текущие данные
+        result = conn.execute('''
+            SELECT selected_genres, content_type, year_range
+            FROM survey_temp_data
+            WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id)).fetchone()
+
+        current_data = {
+            'selected_genres': json.loads(result[0]) if result and result[0] else [],
+            'content_type': result[1] if result else 'movie',
+            'year_range': result[2] if result else None
+        }
+
+        # Обновляем только переданные данные
+        if selected_genres is not None:
+            current_data['selected_genres'] = selected_genres
+        if content_type is not None:
+            current_data['content_type'] = content_type
+        if year_range is not None:
+            current_data['year_range'] = year_range
+
+        # Сохраняем обновленные данные
+        conn.execute('''
+            INSERT OR REPLACE INTO survey_temp_data (user_id, chat_id, selected_genres, content_type, year_range)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, json.dumps(current_data['selected_genres']), current_data['content_type'], current_data['year_range']))
+
+    return current_data
+
+def get_user_survey_temp_data(user_id: int, chat_id: int):
+    """Получение временных данных опросника пользователя"""
+    with db.connection() as conn:
+        result = conn.execute('''
+            SELECT selected_genres, content_type, year_range
+            FROM survey_temp_data
+            WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id)).fetchone()
+
+    if result:
+        return {
+            'selected_genres': json.loads(result[0]) if result[0] else [],
+            'content_type': result[1] if result[1] else 'movie',
+            'year_range': result[2]
+        }
+    return {
+        'selected_genres': [],
+        'content_type': 'movie',
+        'year_range': None
+    }
+
+def clear_user_survey_temp_data(user_id: int, chat_id: int):
+    """Очистка временных данных опросника пользователя"""
+    with db.connection() as conn:
+        conn.execute('''
+            DELETE FROM survey_temp_data
+            WHERE user_id = ? AND chat_id = ?
+        ''', (user_id, chat_id))
+
+def delete_user_surveys(user_id: int, chat_id: int):
+    """Удаление завершенных опросников пользователя в чате"""
+    with db.connection() as conn:
+        cursor = conn.execute('DELETE FROM surveys WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
+    return cursor.rowcount
+
+def clear_old_surveys(chat_id: int):
+    """Очистка старых опросников для чата"""
+    with db.connection() as conn:
+        conn.execute('DELETE FROM surveys WHERE chat_id = ?', (chat_id,))
+    logger.info(f"Очищены старые опросники для чата {chat_id}")
+
+def get_survey_participants_count(chat_id: int):
+    """Получение количества участников, прошедших опросник"""
+    with db.connection() as conn:
+        result = conn.execute('''
+            SELECT COUNT(DISTINCT user_id)
+            FROM surveys
+            WHERE chat_id = ?
+        ''', (chat_id,)).fetchone()
+    return result[0] if result else 0
+
+def get_survey_user_ids(chat_id: int):
+    """Получение списка ID пользователей, прошедших опросник"""
+    with db.connection() as conn:
+        results = conn.execute('''
+            SELECT DISTINCT user_id
+            FROM surveys
+            WHERE chat_id = ?
+        ''', (chat_id,)).fetchall()
+    return {row[0] for row in results}
+
+def _operation_name(func):
+    """Имя операции хранилища для метрик"""
+    return getattr(func, '__name__', type(func).__name__)
+
+class AsyncStore:
+    """Асинхронный интерфейс к хранилищу.
+
+    Блокирующие вызовы SQLite выполняются вне цикла событий, поэтому fsync или
+    ожидание блокировки не останавливают обработку обновлений.
+
+    Записи идут через единственный поток-писатель: он забирает из очереди все
+    накопившиеся запросы (до STORAGE_WRITE_BATCH) и выполняет их одной
+    транзакцией, каждый в своей точке сохранения, так что ошибка одного запроса
+    не откатывает остальные. Результат возвращается обработчику только после
+    фиксации транзакции. Чтения выполняются в отдельных потоках со своими
+    соединениями и в режиме WAL не ждут писателя.
+
+    Очередь ограничена STORAGE_MAX_PENDING запросами: при переполнении
+    обработчики ждут освобождения места, а не накапливают бесконечный хвост задач.
+    """
+
+    def __init__(self, max_pending: int = STORAGE_MAX_PENDING, write_batch: int = STORAGE_WRITE_BATCH,
+                 readers: int = STORAGE_READERS):
+        self.max_pending = max_pending
+        self.write_batch = max(write_batch, 1)
+        self.readers = max(readers, 1)
+        self.commits = 0
+        self.writes = 0
+        self.reads = 0
+        self._queue = queue.Queue()
+        self._writer = None
+        self._executor = None
+        self._semaphore = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self):
+        """Семафор очереди, привязанный к текущему циклу событий"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнение синхронной функции хранилища в потоке-писателе"""
+        return await self._submit(func, args, kwargs, exclusive=False)
+
+    async def run_exclusive(self, func, *args, **kwargs):
+        """Выполнение функции в потоке-писателе между пачками, вне транзакции (например, VACUUM)"""
+        return await self._submit(func, args, kwargs, exclusive=True)
+
+    async def _submit(self, func, args: tuple, kwargs: dict, exclusive: bool):
+        """Постановка записи в очередь потока-писателя и ожидание ее выполнения"""
+        with self._lock:
+            if self._writer is not None and not self._writer.is_alive():
+                logger.error("Поток-писатель остановился, запускаем новый")
+                self._writer = None
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='storage-writer', daemon=True)
+                self._writer.start()
+        with measure(storage_seconds, storage_errors, operation=_operation_name(func)):
+            async with self._get_semaphore():
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._queue.put((functools.partial(func, *args, **kwargs), loop, future, exclusive))
+                return await future
+
+    async def read(self, func, *args, **kwargs):
+        """Выполнение читающей функции хранилища в потоке чтения"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix='storage-reader')
+        self.reads += 1
+        with measure(storage_seconds, storage_errors, operation=_operation_name(func)):
+            async with self._get_semaphore():
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _write_loop(self):
+        """Поток-писатель: выполнение накопившихся записей пачками"""
+        held = None
+        while True:
+            job = held if held is not None else self._queue.get()
+            held = None
+            if job is None:
+                return
+            batch = [job]
+            try:
+                if job[3]:  # exclusive
+                    self._write_exclusive(job)
+                    continue
+                while len(batch) < self.write_batch:
+                    try:
+                        job = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        self._queue.put(None)
+                        break
+                    if job[3]:
+                        # Монопольная задача ждет фиксации пачки, чтобы не держать блокировку записи
+                        held = job
+                        break
+                    batch.append(job)
+                self._write_batch(batch)
+            except Exception as e:
+                # Без писателя все записи ждали бы вечно, поэтому сбой завершает только эту пачку
+                logger.error(f"Сбой потока-писателя на пачке из {len(batch)} записей: {e!r}")
+                _deliver(batch, [(None, e)] * len(batch))
+
+    def _write_batch(self, batch: list):
+        """Выполнение пачки записей одной транзакцией"""
+        results = []
+        try:
+            with db.connection() as conn:
+                conn.execute('BEGIN')
+                for func, _, _, _ in batch:
+                    conn.execute('SAVEPOINT store_job')
+                    try:
+                        results.append((func(), None))
+                        conn.execute('RELEASE store_job')
+                    except Exception as e:
+                        conn.execute('ROLLBACK TO store_job')
+                        conn.execute('RELEASE store_job')
+                        results.append((None, e))
+            self.commits += 1
+            self.writes += len(batch)
+        except Exception as e:
+            logger.error(f"Не удалось зафиксировать пачку из {len(batch)} записей: {e}")
+            results = [(None, e)] * len(batch)
+
+        _deliver(batch, results)
+
+    def _write_exclusive(self, job: tuple):
+        """Выполнение монопольной задачи без транзакции писателя"""
+        func = job[0]
+        try:
+            result, error = func(), None
+            self.writes += 1
+        except Exception as e:
+            logger.error(f"Не удалось выполнить монопольную запись: {e}")
+            result, error = None, e
+        _deliver([job], [(result, error)])
+
+    def close(self):
+        """Остановка потоков базы данных (ожидающие записи выполняются до остановки)"""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+            self._queue = queue.Queue()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+def _deliver(jobs: list, results: list):
+    """Передача результатов записей в циклы событий обработчиков"""
+    for (_, loop, future, _), (result, error) in zip(jobs, results):
+        try:
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+        except RuntimeError:
+            # Цикл событий закрылся, результат уже никто не ждет
+            pass
+
+def _resolve(future, result, error):
+    """Передача результата записи в цикл событий обработчика"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def _mirror(func, method: str = 'run'):
+    """Асинхронная обертка над синхронной функцией хранилища"""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await getattr(self, method)(func, *args, **kwargs)
+    return wrapper
+
+# Записи выполняются потоком-писателем
+for _func in (
+    init_database, save_user_state, create_game, finish_game, set_chat_active_game, clear_chat_active_game,
+    update_game_round, save_game_bracket,
+    save_votes, save_survey_data, save_user_survey_temp_data, clear_user_survey_temp_data,
+    delete_user_surveys, clear_old_surveys
+):
+    setattr(AsyncStore, _func.__name__, _mirror(_func))
+
+# Чтения выполняются параллельно с записями
+for _func in (
+    get_user_state, get_current_game, get_current_game_by_id, get_chat_active_game, load_round_votes, get_survey_data,
+    get_active_group_game, get_group_survey_data, get_user_survey_temp_data,
+    get_survey_participants_count, get_survey_user_ids
+):
+    setattr(AsyncStore, _func.__name__, _mirror(_func, 'read'))
+
+store = AsyncStore()
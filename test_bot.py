@@ -3,36 +3,678 @@
 Тестовый скрипт для проверки функций бота
 """
 
+import os
+import json
+import asyncio
 import sqlite3
-import requests
-from bot import GENRES, init_database, save_user_genre, get_movies_by_genre, format_movie_message
+import threading
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import storage
+import bot
+from cache import TTLCache
+from catalog import CatalogIndex, MovieCatalog, normalize_movie
+from bracket import Bracket
+from votes import VoteAggregator
+from tmdb import TMDbClient, TMDbError
+from rendering import format_movie_battle
+from bot import GENRES, init_database, save_user_state, get_movies_by_survey
 
 def test_database():
     """Тест базы данных"""
     print("🧪 Тестирование базы данных...")
     
+    db_path = os.path.join(tempfile.mkdtemp(), 'users.db')
+    storage.configure_database(db_path)
     try:
         init_database()
         print("✅ База данных инициализирована")
         
         # Тест сохранения
-        save_user_genre(12345, "comedy")
+        save_user_state(12345, "survey_genres")
         print("✅ Сохранение пользователя работает")
         
         # Проверка сохранения
-        conn = sqlite3.connect('users.db')
+        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (12345,))
         result = cursor.fetchone()
         conn.close()
         
-        if result and result[1] == "comedy":
+        # База работает в режиме WAL
+        with storage.db.connection() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        
+        if result and result[1] == "survey_genres":
             print("✅ Чтение из базы данных работает")
         else:
             print("❌ Ошибка чтения из базы данных")
+        assert result and result[1] == "survey_genres"
+        
+        # Вложенные вызовы хранилища переиспользуют одну выдачу соединения
+        checkouts = storage.db.checkouts
+        with storage.db.connection():
+            save_user_state(12345, "waiting_mode")
+            assert storage.get_user_state(12345) == "waiting_mode"
+        assert storage.db.checkouts == checkouts + 1
+        print("✅ Соединение с базой данных переиспользуется")
+    finally:
+        storage.configure_database()
+
+def test_query_plans():
+    """Тест индексов для частых выборок"""
+    print("\n🧪 Тестирование планов запросов...")
+    
+    db_path = os.path.join(tempfile.mkdtemp(), 'users.db')
+    
+    # База старой версии без колонки current_state и без индексов
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.close()
+    
+    storage.configure_database(db_path)
+    try:
+        init_database()
+        with storage.db.connection() as conn:
+            assert conn.execute('PRAGMA user_version').fetchone()[0] == len(storage.MIGRATIONS)
+            assert storage.migrate_database(conn) == len(storage.MIGRATIONS)
             
-    except Exception as e:
-        print(f"❌ Ошибка базы данных: {e}")
+            queries = {
+                'idx_games_user_chat_created': 'SELECT * FROM games WHERE user_id = 1 AND chat_id = 2 ORDER BY created_at DESC LIMIT 1',
+                'idx_games_chat_type_created': "SELECT * FROM games WHERE chat_id = 2 AND game_type = 'group' ORDER BY created_at DESC LIMIT 1",
+                'idx_surveys_chat_user': 'SELECT COUNT(DISTINCT user_id) FROM surveys WHERE chat_id = 2',
+                'idx_surveys_user_chat_created': 'SELECT selected_genres FROM surveys WHERE user_id = 1 AND chat_id = 2 ORDER BY created_at DESC LIMIT 1'
+            }
+            for index_name, query in queries.items():
+                plan = ' '.join(row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}'))
+                assert index_name in plan and 'TEMP B-TREE' not in plan, plan
+            
+            plan = ' '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN SELECT user_id FROM surveys WHERE chat_id = 2'))
+            assert 'idx_surveys_chat_user' in plan, plan
+        
+        save_user_state(1, 'survey_genres')
+        assert storage.get_user_state(1) == 'survey_genres'
+        print("✅ Частые выборки используют индексы")
+    finally:
+        storage.configure_database()
+
+def test_maintenance():
+    """Тест очистки и сжатия базы данных"""
+    print("\n🧪 Тестирование обслуживания базы данных...")
+    from maintenance import run_maintenance
+    
+    db_path = os.path.join(tempfile.mkdtemp(), 'users.db')
+    
+    # База, созданная без auto_vacuum
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.close()
+    
+    storage.configure_database(db_path, {'auto_vacuum': 'NONE'})
+    try:
+        init_database()
+        bracket = Bracket(list(range(64)))
+        with storage.db.connection() as conn:
+            for game_number in range(200):
+                game_id = storage.create_game(1, 2, 'group', bracket)
+                storage.save_votes([(game_id, 1, user_id, 1) for user_id in range(20)])
+            conn.execute("UPDATE games SET created_at = datetime('now', '-40 days') WHERE game_id > 1")
+            # Завершенные игры старше срока хранения удаляются, а идущая игра того же возраста - нет
+            for game_id in range(2, 200):
+                storage.finish_game(game_id)
+            # Брошенная незавершенная игра удаляется только после срока для незавершенных игр
+            stale_game_id = storage.create_game(1, 3, 'group', bracket)
+            storage.save_votes([(stale_game_id, 1, user_id, 1) for user_id in range(20)])
+            conn.execute("UPDATE games SET created_at = datetime('now', '-100 days') WHERE game_id = ?", (stale_game_id,))
+            storage.save_user_survey_temp_data(1, 2, ['comedy'], None, None)
+            storage.save_user_survey_temp_data(3, 2, ['drama'], None, None)
+            conn.execute("UPDATE survey_temp_data SET created_at = datetime('now', '-2 days') WHERE user_id = 1")
+        
+        report = asyncio.run(run_maintenance())
+        assert report['deleted'] == {'votes': 199 * 20, 'chat_active_games': 1, 'games': 199, 'surveys': 0, 'survey_temp_data': 1}
+        assert report['converted'] and report['reclaimed_bytes'] > 0
+        assert storage.get_current_game_by_id(1) is not None
+        assert storage.get_current_game_by_id(200) is not None and storage.get_chat_active_game(2)[0] == 200
+        assert storage.get_current_game_by_id(stale_game_id) is None and storage.get_chat_active_game(3) is None
+        assert storage.get_user_survey_temp_data(3, 2)['selected_genres'] == ['drama']
+        assert storage.get_user_survey_temp_data(1, 2)['selected_genres'] == []
+        
+        # Повторный проход ничего не удаляет и не требует полного VACUUM
+        report = asyncio.run(run_maintenance())
+        assert sum(report['deleted'].values()) == 0 and not report['converted']
+        
+        # Проход возвращает файлу до max_pages свободных страниц, а не одну
+        with storage.db.connection() as conn:
+            conn.execute('CREATE TABLE filler (data BLOB)')
+            conn.executemany('INSERT INTO filler VALUES (zeroblob(4096))', [()] * 100)
+            conn.execute('DROP TABLE filler')
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            free_before = conn.execute('PRAGMA freelist_count').fetchone()[0] * page_size
+        assert free_before > 20 * page_size
+        report = asyncio.run(run_maintenance(max_pages=10))
+        assert report['free_bytes'] == free_before - 10 * page_size
+        print("✅ Обслуживание базы данных работает")
+    finally:
+        storage.configure_database()
+
+def test_async_store():
+    """Тест асинхронного хранилища"""
+    print("\n🧪 Тестирование асинхронного хранилища...")
+    
+    storage.configure_database(os.path.join(tempfile.mkdtemp(), 'users.db'))
+    try:
+        init_database()
+        
+        async def scenario():
+            store = storage.AsyncStore(max_pending=2)
+            try:
+                # Запросы выполняются вне цикла событий, в потоке базы данных
+                thread_name = await store.run(lambda: threading.current_thread().name)
+                assert thread_name.startswith('storage')
+                
+                await asyncio.gather(*(store.save_user_state(user_id, 'survey_genres') for user_id in range(10)))
+                states = await asyncio.gather(*(store.get_user_state(user_id) for user_id in range(10)))
+                assert states == ['survey_genres'] * 10
+                
+                # Одновременные записи фиксируются общими транзакциями
+                commits = store.commits
+                await asyncio.gather(*(store.save_user_state(user_id, 'waiting_mode') for user_id in range(100)))
+                assert store.commits - commits < 100
+                
+                # Ошибка одной записи не откатывает остальные записи пачки
+                def failing_write():
+                    storage.save_user_state(1000, 'survey_type')
+                    raise ValueError("ошибка записи")
+                results = await asyncio.gather(
+                    store.save_user_state(1001, 'survey_years'), store.run(failing_write),
+                    store.save_user_state(1002, 'survey_years'), return_exceptions=True
+                )
+                assert isinstance(results[1], ValueError)
+                states = await asyncio.gather(*(store.get_user_state(user_id) for user_id in (1000, 1001, 1002)))
+                assert states == ['waiting_mode', 'survey_years', 'survey_years']
+                
+                # Монопольная задача выполняется между пачками, когда транзакция писателя не открыта
+                def vacuum():
+                    conn = sqlite3.connect(storage.db.path, isolation_level=None, timeout=0.1)
+                    try:
+                        conn.execute('VACUUM')
+                    finally:
+                        conn.close()
+                await asyncio.gather(
+                    *(store.save_user_state(user_id, 'survey_type') for user_id in range(50)),
+                    store.run_exclusive(vacuum),
+                    *(store.save_user_state(user_id, 'survey_years') for user_id in range(50))
+                )
+                assert await store.get_user_state(49) == 'survey_years'
+                
+                # Сбой внутри потока-писателя завершает ошибкой только свою пачку
+                write_batch = store._write_batch
+                def broken_batch(batch):
+                    store._write_batch = write_batch
+                    raise RuntimeError("сбой писателя")
+                store._write_batch = broken_batch
+                results = await asyncio.gather(store.save_user_state(2000, 'survey_type'), return_exceptions=True)
+                assert isinstance(results[0], RuntimeError)
+                await asyncio.wait_for(store.save_user_state(2000, 'survey_years'), timeout=5)
+                assert store._writer.is_alive() and await store.get_user_state(2000) == 'survey_years'
+                reads = store.reads
+                assert (await store.read(lambda: threading.current_thread().name)).startswith('storage-reader')
+                assert store.reads == reads + 1
+            finally:
+                store.close()
+        
+        asyncio.run(scenario())
+        print("✅ Асинхронное хранилище работает")
+    finally:
+        storage.configure_database()
+
+def test_vote_aggregator():
+    """Тест подсчета голосов в памяти"""
+    print("\n🧪 Тестирование подсчета голосов...")
+    
+    storage.configure_database(os.path.join(tempfile.mkdtemp(), 'users.db'))
+    try:
+        init_database()
+        
+        async def scenario():
+            aggregator = VoteAggregator('interval')
+            
+            # Одновременные голоса не теряются, повторные отклоняются
+            results = await asyncio.gather(*(
+                aggregator.record(1, 1, user_id % 20, 1 if user_id % 3 else 2) for user_id in range(40)
+            ))
+            assert sum(result is not None for result in results) == 20
+            round_votes = await aggregator.get(1, 1)
+            assert len(round_votes) == 20 and sum(round_votes.counts) == 20
+            assert aggregator.pending == 20 and await storage.store.load_round_votes(1, 1) == []
+            
+            # Накопленные голоса сохраняются одной транзакцией
+            assert await aggregator.flush() == 20 and aggregator.flushes == 1
+            assert len(await storage.store.load_round_votes(1, 1)) == 20
+            
+            # Следующий раунд начинается с чистого листа
+            await aggregator.close_round(1, 1)
+            assert await aggregator.record(1, 2, 0, 2) is not None
+            
+            # После перезапуска голоса восстанавливаются из базы данных
+            restarted = VoteAggregator('vote')
+            assert await restarted.record(1, 1, 0, 1) is None
+            assert (await restarted.get(1, 1)).counts == round_votes.counts
+            assert await restarted.record(1, 3, 5, 1) is not None and restarted.pending == 0
+            
+            # Раундов в памяти не больше лимита, вытесненный раунд восстанавливается
+            bounded = VoteAggregator('interval', max_rounds=2)
+            assert await bounded.record(7, 1, 1, 1) is not None
+            for round_num in (2, 3):
+                await bounded.record(7, round_num, 1, 2)
+            assert len(bounded._rounds) == 2
+            assert await bounded.record(7, 1, 1, 2) is None
+            assert (await bounded.get(7, 1)).counts == [1, 0]
+        
+        asyncio.run(scenario())
+        print("✅ Голоса подсчитываются")
+    finally:
+        storage.configure_database()
+
+def test_ttl_cache():
+    """Тест кэша с TTL и вытеснением LRU"""
+    print("\n🧪 Тестирование кэша...")
+    
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    
+    # 'b' использовалась давнее всего и вытесняется
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    
+    # Записи истекают по TTL
+    now[0] = 11
+    assert cache.get('a') is None
+    assert cache.stats() == {'size': 1, 'maxsize': 2, 'hits': 2, 'misses': 2, 'evictions': 1, 'expirations': 1}
+    print("✅ Кэш работает")
+
+def test_movie_catalog():
+    """Тест локального каталога фильмов"""
+    print("\n🧪 Тестирование каталога фильмов...")
+    
+    storage.configure_database(os.path.join(tempfile.mkdtemp(), 'users.db'))
+    try:
+        init_database()
+        now = [1000.0]
+        key = ((18, 35), 'tv', 'new')
+        records = [
+            normalize_movie({'id': 1, 'name': 'Сериал', 'first_air_date': '2020-01-01', 'genre_ids': [18]}, 'tv'),
+            normalize_movie({'id': 2, 'title': 'Фильм', 'release_date': '2019-05-05', 'genre_ids': [35]}, 'movie')
+        ]
+        assert records[0]['title'] == 'Сериал' and records[0]['release_date'] == '2020-01-01'
+        
+        catalog = MovieCatalog(max_age=60, clock=lambda: now[0])
+        asyncio.run(catalog.store_segment(key, records))
+        
+        # Новый экземпляр поднимает каталог с диска
+        warm = MovieCatalog(max_age=60, clock=lambda: now[0])
+        warm.load()
+        assert [movie['title'] for movie in warm.get_segment(key)] == ['Сериал', 'Фильм']
+        
+        # Устаревший сегмент не отдается как свежий, но доступен для запасного варианта
+        now[0] += 61
+        assert warm.get_segment(key) is None
+        assert len(warm.get_segment(key, allow_stale=True)) == 2
+        assert warm.stale_segments() == [key]
+        
+        # Локальный поиск по индексу жанров и годов
+        assert [movie['title'] for movie in warm.find((18,), 'tv', 2015, 2025)] == ['Сериал']
+        assert warm.find((18,), 'tv', 1900, 2000) == []
+        
+        # Игры ссылаются на записи по ключам каталога
+        mock = normalize_movie({'id': 1, 'title': 'Заглушка'}, 'mock')
+        movie_keys = asyncio.run(warm.ensure_keys(records + [mock]))
+        assert len(set(movie_keys)) == 3
+        
+        # Новые записи добавляются в уже построенный индекс, а не перестраивают его
+        index = warm.index
+        asyncio.run(warm.store_segment(key, [dict(records[0], genre_ids=[18, 35])]))
+        assert warm.index is index and len(warm.find((35,), 'tv', 2015, 2025)) == 1
+        cold = MovieCatalog()
+        assert [movie['title'] for movie in asyncio.run(cold.get_movies(movie_keys))] == ['Сериал', 'Фильм', 'Заглушка']
+        print("✅ Каталог фильмов работает")
+    finally:
+        storage.configure_database()
+
+def test_catalog_index():
+    """Тест инвертированного индекса каталога"""
+    print("\n🧪 Тестирование индекса каталога...")
+    
+    movies = {
+        1: {'media_type': 'movie', 'genre_ids': [35, 18], 'release_date': '1999-01-01'},
+        2: {'media_type': 'movie', 'genre_ids': [35], 'release_date': '2016-01-01'},
+        3: {'media_type': 'movie', 'genre_ids': [18], 'release_date': '2020-01-01'},
+        4: {'media_type': 'tv', 'genre_ids': [35, 18], 'release_date': '2021-01-01'},
+        5: {'media_type': 'movie', 'genre_ids': [35, 18], 'release_date': ''}
+    }
+    index = CatalogIndex(movies)
+    assert index.query((35, 18), 'movie', 1900, 2025) == {1}
+    assert index.query((35, 18), 'movie', 1900, 2025, match_all=False) == {1, 2, 3}
+    assert index.query((35,), 'movie', 2015, 2025) == {2}
+    assert index.query((), 'tv', 1900, 2025) == {4}
+    
+    # Новые и обновленные записи попадают в готовый индекс без перестройки
+    index.add(6, {'media_type': 'tv', 'genre_ids': [35], 'release_date': '2010-01-01'})
+    assert index.query((35,), 'tv', 2000, 2025) == {4, 6}
+    index.remove(2, movies[2])
+    index.add(2, {'media_type': 'movie', 'genre_ids': [18], 'release_date': '2001-01-01'})
+    assert index.query((35,), 'movie', 0, 2025) == {1, 5} and index.query((18,), 'movie', 2000, 2010) == {2}
+    print("✅ Индекс каталога работает")
+
+def test_bracket():
+    """Тест турнирной сетки"""
+    print("\n🧪 Тестирование турнирной сетки...")
+    
+    # Single elimination: 26 участников, 25 раундов, нечетные круги с проходом без пары
+    bracket = Bracket(range(1, 27))
+    played = []
+    while not bracket.finished:
+        first, second = bracket.current_pair()
+        played.append((first, second))
+        bracket.advance(0 if first < second else 1)
+        bracket = Bracket.from_bytes(bracket.to_bytes())
+    assert len(played) == bracket.total_rounds == 25
+    assert bracket.round == 26
+    assert played[:2] == [(1, 2), (3, 4)]
+    assert bracket.winner == 1
+    
+    # King of the hill: чемпион остается в паре до поражения
+    bracket = Bracket([10, 20, 30], 'king_of_the_hill')
+    assert bracket.current_pair() == (10, 20)
+    bracket.advance(1)
+    assert bracket.current_pair() == (20, 30)
+    bracket = Bracket.from_list(bracket.to_list())
+    bracket.advance(0)
+    assert bracket.finished and bracket.winner == 20
+    print("✅ Турнирная сетка работает")
+
+def test_member_count_cache():
+    """Тест кэша количества участников чата"""
+    print("\n🧪 Тестирование кэша участников...")
+    from datetime import datetime
+    from types import SimpleNamespace
+    from telegram import Chat, ChatMemberLeft, ChatMemberMember, ChatMemberUpdated, Update, User
+    
+    calls = []
+    
+    async def get_chat_member_count(chat_id):
+        calls.append(chat_id)
+        await asyncio.sleep(0.01)
+        return 5
+    
+    context = SimpleNamespace(bot=SimpleNamespace(get_chat_member_count=get_chat_member_count))
+    original_cache = bot.member_count_cache
+    bot.member_count_cache = TTLCache()
+    
+    async def scenario():
+        # Одновременные запросы по одному чату объединяются
+        counts = await asyncio.gather(*(bot.get_chat_member_count(context, -100) for _ in range(10)))
+        assert counts == [5] * 10 and calls == [-100]
+        
+        # Новый участник увеличивает закэшированное значение без запроса к Telegram
+        user = User(7, 'Новичок', False)
+        chat = Chat(-100, 'group')
+        update = Update(1, chat_member=ChatMemberUpdated(
+            chat, user, datetime.now(), ChatMemberLeft(user), ChatMemberMember(user)
+        ))
+        await bot.track_chat_members(update, context)
+        assert await bot.get_chat_member_count(context, -100) == 6 and calls == [-100]
+    
+    try:
+        asyncio.run(scenario())
+        print("✅ Кэш участников работает")
+    finally:
+        bot.member_count_cache = original_cache
+
+def test_edit_coalescer():
+    """Тест объединения правок сообщения"""
+    print("\n🧪 Тестирование объединения правок...")
+    from types import SimpleNamespace
+    from telegram.error import RetryAfter, TimedOut
+    from messaging import EditCoalescer
+    
+    edits = []
+    failures = [RetryAfter(0)]
+    
+    async def edit_message_text(text, chat_id=None, message_id=None, reply_markup=None):
+        if failures and len(edits) == 1:
+            raise failures.pop()
+        edits.append((chat_id, message_id, text))
+    
+    fake_bot = SimpleNamespace(edit_message_text=edit_message_text)
+    coalescer = EditCoalescer(window=0.02)
+    
+    async def scenario():
+        # Серия голосов превращается в одну правку с последним состоянием
+        for i in range(10):
+            coalescer.submit(fake_bot, -100, 1, f"Голосов: {i + 1}")
+        await asyncio.sleep(0.1)
+        assert edits == [(-100, 1, "Голосов: 10")]
+        assert coalescer.coalesced == 9 and coalescer.sent == 1
+        
+        # Повтор того же состояния не отправляется
+        coalescer.submit(fake_bot, -100, 1, "Голосов: 10")
+        await asyncio.sleep(0.1)
+        assert len(edits) == 1 and coalescer.skipped == 1
+        
+        # После RetryAfter отправка повторяется
+        coalescer.submit(fake_bot, -100, 1, "Голосов: 11")
+        await asyncio.sleep(0.1)
+        assert edits[-1] == (-100, 1, "Голосов: 11") and coalescer.flood_waits == 1
+        
+        # Отмененная правка не отправляется
+        coalescer.submit(fake_bot, -100, 1, "Голосов: 12")
+        coalescer.discard(-100, 1)
+        await asyncio.sleep(0.1)
+        assert len(edits) == 2
+        
+        # После таймаута правка повторяется один раз, после второго подряд - отбрасывается
+        timeouts = [TimedOut()]
+        flaky_edits = []
+        
+        async def flaky_edit(text, chat_id=None, message_id=None, reply_markup=None):
+            if timeouts:
+                raise timeouts.pop()
+            flaky_edits.append(text)
+        
+        flaky_bot = SimpleNamespace(edit_message_text=flaky_edit)
+        coalescer.submit(flaky_bot, -100, 2, "Голосов: 13")
+        await asyncio.sleep(0.1)
+        assert flaky_edits == ["Голосов: 13"] and coalescer.errors == 1
+        timeouts.extend([TimedOut(), TimedOut()])
+        coalescer.submit(flaky_bot, -100, 2, "Голосов: 14")
+        await asyncio.sleep(0.1)
+        assert flaky_edits == ["Голосов: 13"] and coalescer.errors == 3
+        assert not coalescer._pending and not coalescer._tasks
+    
+    asyncio.run(scenario())
+    print("✅ Правки объединяются")
+
+def test_round_scheduler():
+    """Тест отложенных действий раундов"""
+    print("\n🧪 Тестирование планировщика раундов...")
+    from types import SimpleNamespace
+    from scheduler import RoundScheduler
+    
+    calls = []
+    context = SimpleNamespace(job_queue=None)
+    
+    async def action(ctx, label):
+        calls.append(label)
+    
+    async def scenario():
+        scheduler = RoundScheduler()
+        
+        # Планирование возвращается сразу, действие выполняется позже
+        scheduler.schedule(context, 'next_round_1', 0.02, action, 'next')
+        assert calls == [] and scheduler.pending() == ['next_round_1']
+        
+        # Повторное планирование заменяет действие, отмена удаляет его
+        scheduler.schedule(context, 'round_timeout_1', 0.02, action, 'old')
+        scheduler.schedule(context, 'round_timeout_1', 0.02, action, 'timeout')
+        scheduler.schedule(context, 'round_timeout_2', 0.02, action, 'cancelled')
+        scheduler.cancel(context, 'round_timeout_2')
+        
+        await asyncio.sleep(0.1)
+        assert sorted(calls) == ['next', 'timeout'] and scheduler.pending() == []
+    
+    asyncio.run(scenario())
+    print("✅ Планировщик раундов работает")
+
+def test_update_processor():
+    """Тест параллельной обработки обновлений с порядком внутри чата"""
+    print("\n🧪 Тестирование обработки обновлений...")
+    from processing import ChatOrderedUpdateProcessor
+    
+    processed = {}
+    running = [0, 0]  # сейчас, максимум
+    
+    async def handle(chat_id, number):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.01 * ((number * 7 + chat_id) % 3))
+        processed.setdefault(chat_id, []).append(number)
+        running[0] -= 1
+    
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor(3, 100, key_func=lambda update: update[0])
+        async with processor:
+            await asyncio.gather(*(
+                processor.process_update((chat_id, number), handle(chat_id, number))
+                for number in range(5) for chat_id in range(6)
+            ))
+        # Внутри чата порядок сохраняется, разные чаты обрабатываются параллельно в пределах лимита
+        assert all(numbers == list(range(5)) for numbers in processed.values()) and len(processed) == 6
+        assert 1 < running[1] <= 3
+        assert processor._locks == {}
+    
+    asyncio.run(scenario())
+    print("✅ Обновления обрабатываются параллельно по чатам")
+
+def test_active_games():
+    """Тест статуса игр и указателя на текущую игру группы"""
+    print("\n🧪 Тестирование текущих игр...")
+    from types import SimpleNamespace
+    
+    storage.configure_database(os.path.join(tempfile.mkdtemp(), 'users.db'))
+    original_cache = bot.active_games
+    bot.active_games = TTLCache()
+    try:
+        init_database()
+        replies = []
+        
+        async def reply_text(text, reply_markup=None):
+            replies.append((text, reply_markup))
+            return SimpleNamespace(message_id=len(replies))
+        
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=-100, type='group'),
+            effective_user=SimpleNamespace(id=1),
+            message=SimpleNamespace(reply_text=reply_text)
+        )
+        
+        async def scenario():
+            movie_keys = await bot.movie_catalog.ensure_keys(bot.get_mock_popular_movies()[:4])
+            assert await bot.get_active_game(-100) is None
+            
+            # Групповая игра сразу становится текущей игрой чата
+            game_id = await storage.store.create_game(1, -100, 'group', Bracket(movie_keys))
+            bot.active_games.clear()
+            assert await bot.get_active_game(-100) == (game_id, storage.GAME_RUNNING)
+            assert storage.get_active_group_game(-100)[0] == game_id
+            
+            # /battle присоединяет к идущей игре и после перезапуска восстанавливает таймаут раунда
+            context = SimpleNamespace(job_queue=None)
+            await bot.battle_command(update, context)
+            assert replies and any(f"vote_1_{game_id}" == button.callback_data
+                                   for row in replies[-1][1].inline_keyboard for button in row)
+            assert f"round_timeout_{game_id}" in bot.round_scheduler.pending()
+            assert bot.open_rounds[game_id] == 1
+            bot.round_scheduler.cancel(context, f"round_timeout_{game_id}")
+            
+            # Раунд закрывается по таймауту, пока голос ждет базу данных или количество участников
+            answers = []
+            
+            async def answer(text=None):
+                answers.append(text)
+            
+            query = SimpleNamespace(from_user=SimpleNamespace(id=7, first_name='Аня', username=None), answer=answer,
+                                    message=SimpleNamespace(chat=SimpleNamespace(id=-100), message_id=1))
+            
+            async def close_round(*args):
+                bot.open_rounds[game_id] = None
+                return 4
+            
+            await storage.store.update_game_round(game_id, 1, json.dumps(list(Bracket(movie_keys).current_pair())))
+            original_aggregator, original_load = bot.vote_aggregator, storage.store.load_round_votes
+            original_member_count = bot.get_chat_member_count
+            bot.vote_aggregator = VoteAggregator(durability='round')
+            try:
+                async def load_round_votes(*args):
+                    await close_round()
+                    return await original_load(*args)
+                storage.store.load_round_votes = load_round_votes
+                await bot.process_vote(query, context, game_id, 1)
+                assert answers[-1] == "Раунд уже завершен!"
+                assert len(await bot.vote_aggregator.get(game_id, 1)) == 0
+                
+                del storage.store.load_round_votes
+                bot.open_rounds[game_id] = 1
+                bot.get_chat_member_count = close_round
+                await bot.process_vote(query, context, game_id, 1)
+                assert len(await bot.vote_aggregator.get(game_id, 1)) == 1
+                assert (-100, 1) not in bot.edit_coalescer._pending
+            finally:
+                bot.vote_aggregator = original_aggregator
+                bot.get_chat_member_count = original_member_count
+                storage.store.__dict__.pop('load_round_votes', None)
+                bot.open_rounds[game_id] = 1
+            
+            # Завершенная игра больше не текущая
+            await bot.finish_active_game(-100, game_id)
+            assert await bot.get_active_game(-100) is None and storage.get_active_group_game(-100) is None
+            assert storage.get_current_game_by_id(game_id)[11] == storage.GAME_FINISHED
+            bot.active_games.clear()
+            assert await bot.get_active_game(-100) is None
+            
+            # Кнопка или таймаут раунда завершенной игры ничего не делают
+            short_game_id = await storage.store.create_game(1, -100, 'group', Bracket(movie_keys[:2]))
+            await bot.finish_active_game(-100, short_game_id)
+            await bot.close_group_round(context, -100, 1, short_game_id)
+            await bot.close_group_round(context, -100, 1, short_game_id, 1)
+            assert short_game_id not in bot.open_rounds
+            
+            # Игра удалена обслуживанием, а указатель остался в кэше: /battle начинает новый опросник
+            game_id = await storage.store.create_game(1, -100, 'group', Bracket(movie_keys))
+            await bot.set_active_game(-100, game_id, storage.GAME_RUNNING)
+            with storage.db.connection() as conn:
+                conn.execute('DELETE FROM chat_active_games WHERE game_id = ?', (game_id,))
+                conn.execute('DELETE FROM games WHERE game_id = ?', (game_id,))
+            sent = []
+            
+            async def send_message(chat_id, text, reply_markup=None):
+                sent.append((chat_id, reply_markup))
+            
+            await bot.battle_command(update, SimpleNamespace(bot=SimpleNamespace(send_message=send_message)))
+            assert sent and sent[-1][1].inline_keyboard[0][0].callback_data == 'start_my_survey'
+            assert await bot.get_active_game(-100) == (None, storage.GAME_SURVEYING)
+        
+        asyncio.run(scenario())
+        print("✅ Текущие игры определяются по указателю")
+    finally:
+        bot.active_games = original_cache
+        storage.configure_database()
 
 def test_genres():
     """Тест жанров"""
@@ -54,17 +696,60 @@ def test_message_formatting():
         {
             'title': 'Тестовый фильм',
             'overview': 'Это тестовое описание фильма для проверки форматирования.'
+        },
+        {
+            'title': 'Второй фильм',
+            'overview': 'Описание второго фильма.'
         }
     ]
     
     try:
-        message = format_movie_message(test_movies, "Комедия")
-        if "Тестовый фильм" in message and "Комедия" in message:
+        message = format_movie_battle(test_movies[0], test_movies[1], 1, 25)
+        if "Тестовый фильм" in message and "Второй фильм" in message:
             print("✅ Форматирование сообщений работает")
         else:
             print("❌ Ошибка форматирования сообщений")
     except Exception as e:
         print(f"❌ Ошибка форматирования: {e}")
+    
+    # Раунд отрисовывается один раз, голоса только подставляют счетчики
+    from rendering import BattleRenderer
+    renderer = BattleRenderer()
+    view = renderer.view(7, 3, 25, [11, 12], test_movies)
+    assert renderer.view(7, 3, 25, [11, 12], test_movies) is view and renderer.cached(7, 3, [11, 12]) is view
+    assert view.text == format_movie_battle(test_movies[0], test_movies[1], 3, 25)
+    tally = view.tally("Аня", [2, 1], 3, 4)
+    assert "Тестовый фильм: 2 голосов" in tally and "Второй фильм: 1 голосов" in tally
+    assert "👤 Участник 3" in tally and "3/4 участников" in tally
+    assert [button.callback_data for row in view.finish_markup.inline_keyboard for button in row] == [
+        'vote_1_7', 'vote_2_7', 'finish_round_7'
+    ]
+    
+    # Фигурные скобки в названиях не ломают подстановку счетчиков
+    braces = renderer.view(9, 1, 25, [1, 2], [{'title': 'Movie {1}'}, {'title': 'Сцена {}'}])
+    tally = braces.tally("Аня", [4, 0], 4, 5)
+    assert "Movie {1}: 4 голосов" in tally and "Сцена {}: 0 голосов" in tally
+    renderer.discard(7, 3, [11, 12])
+    assert renderer.cached(7, 3, [11, 12]) is None
+    print("✅ Раунды отрисовываются один раз")
+    
+    # Длинные описания обрезаются по границе слова, сообщение не превышает лимит Telegram
+    from rendering import MESSAGE_LIMIT, CALLBACK_DATA_LIMIT, button, shorten, utf16_length
+    long_movie = {'title': 'Очень длинное название ' * 20, 'overview': 'Слово 🎬 ' * 2000}
+    assert shorten('Один два три четыре', 12) == 'Один два...'
+    message = format_movie_battle(long_movie, long_movie, 1, 25)
+    assert utf16_length(message) <= MESSAGE_LIMIT and 'Кто победит' in message
+    view = renderer.view(8, 1, 25, [1, 2], [long_movie, long_movie])
+    for voters in (1, 500):
+        assert utf16_length(view.tally('Имя ' * 100, [voters, 0], voters, 1000)) <= MESSAGE_LIMIT
+    assert 'и еще 490' in view.tally('Аня', [500, 0], 500, 1000)
+    assert all(len(b.text) <= 64 for row in view.finish_markup.inline_keyboard for b in row)
+    try:
+        button('Кнопка', 'x' * (CALLBACK_DATA_LIMIT + 1))
+        assert False, "слишком длинная callback_data должна отклоняться"
+    except ValueError:
+        pass
+    print("✅ Длина сообщений и кнопок ограничена")
 
 def test_api_connection():
     """Тест подключения к API (без ключа)"""
@@ -72,7 +757,7 @@ def test_api_connection():
     
     try:
         # Тест без API ключа (должен вернуть ошибку, но не краш)
-        movies = get_movies_by_genre(35)  # comedy genre
+        movies = asyncio.run(get_movies_by_survey(['comedy'], 'movie', 'all'))
         if isinstance(movies, list):
             print("✅ API функция работает (возвращает список)")
         else:
@@ -80,14 +765,256 @@ def test_api_connection():
     except Exception as e:
         print(f"✅ API функция обрабатывает ошибки корректно: {type(e).__name__}")
 
+class StubTMDbHandler(BaseHTTPRequestHandler):
+    """Заглушка TMDb API: отдает фиксированный список фильмов и запоминает запросы"""
+    requests_log = []
+    
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        StubTMDbHandler.requests_log.append((url.path, params))
+        if url.path == '/slow':
+            time.sleep(1)
+        page = int(params.get('page', ['1'])[0])
+        body = json.dumps({'page': page, 'total_pages': 10, 'results': [
+            {'id': movie_id, 'title': f'Фильм {movie_id}', 'overview': 'Описание'}
+            for movie_id in range((page - 1) * 20 + 1, page * 20 + 1)
+        ]}).encode()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # клиент уже отключился по таймауту (запрос /slow)
+    
+    def log_message(self, *args):
+        pass
+
+def test_tmdb_client():
+    """Тест асинхронного клиента TMDb на локальной заглушке"""
+    print("\n🧪 Тестирование клиента TMDb...")
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTMDbHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = TMDbClient('test-key', f'http://127.0.0.1:{server.server_port}', timeout=0.3)
+    original_client, original_key, original_cache = bot.tmdb_client, bot.TMDB_API_KEY, bot.discover_cache
+    bot.tmdb_client, bot.TMDB_API_KEY, bot.discover_cache = client, 'test-key', TTLCache()
+    storage.configure_database(os.path.join(tempfile.mkdtemp(), 'users.db'))
+    init_database()
+    
+    async def scenario():
+        try:
+            movies = await bot.get_movies_by_survey(['comedy', 'drama'], 'movie', 'new', 26)
+            assert len(movies) == 26
+            
+            path, params = StubTMDbHandler.requests_log[0]
+            assert path == '/discover/movie'
+            assert params['with_genres'] == ['18,35']
+            assert params['api_key'] == ['test-key']
+            
+            # Для 26 фильмов параллельно загружаются две страницы, без запроса популярных
+            assert sorted(int(params['page'][0]) for path, params in StubTMDbHandler.requests_log) == [1, 2]
+            assert len({movie['id'] for movie in movies}) == 26
+            
+            # Тот же опросник с другим порядком жанров обслуживается из кэша
+            requests_count = len(StubTMDbHandler.requests_log)
+            movies = await bot.get_movies_by_survey(['drama', 'comedy'], 'movie', 'new', 26)
+            assert len(movies) == 26
+            assert len(StubTMDbHandler.requests_log) == requests_count
+            assert bot.discover_cache.hits == 1
+            
+            # Зависший запрос прерывается по таймауту
+            try:
+                await client.get('/slow')
+                assert False, "ожидался таймаут"
+            except TMDbError:
+                pass
+        finally:
+            await client.aclose()
+    
+    try:
+        asyncio.run(scenario())
+        print("✅ Клиент TMDb работает")
+    finally:
+        bot.tmdb_client, bot.TMDB_API_KEY, bot.discover_cache = original_client, original_key, original_cache
+        storage.configure_database()
+        server.shutdown()
+        server.server_close()
+
+def test_metrics():
+    """Тест метрик обработчиков, хранилища и эндпоинта /metrics"""
+    print("\n🧪 Тестирование метрик...")
+    from types import SimpleNamespace
+    import metrics
+    
+    # Гистограмма отдает накопительные корзины, сумму и количество
+    registry = metrics.Registry()
+    histogram = registry.histogram('test_seconds', 'Тест', ('handler',), buckets=(0.1, 1.0))
+    counter = registry.counter('test_errors', 'Тест', ('handler',))
+    histogram.observe(0.05, handler='vote')
+    histogram.observe(0.5, handler='vote')
+    histogram.observe(5, handler='vote')
+    counter.inc(handler='say "hi"')
+    text = registry.render()
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{handler="vote",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{handler="vote",le="1"} 2' in text
+    assert 'test_seconds_bucket{handler="vote",le="+Inf"} 3' in text
+    assert 'test_seconds_count{handler="vote"} 3' in text
+    assert 'test_errors_total{handler="say \\"hi\\""} 1' in text
+    
+    # Ветки button_handler группируются по префиксу callback_data
+    def query_update(data):
+        return SimpleNamespace(callback_query=SimpleNamespace(data=data))
+    assert bot.callback_route(query_update('vote_1_42')) == 'vote'
+    assert bot.callback_route(query_update('group_survey_genre_comedy')) == 'group_survey_genre'
+    assert bot.callback_route(query_update('finish_round_7')) == 'finish_round'
+    assert bot.callback_route(query_update('survey_genres_done')) == 'survey_genres_done'
+    
+    async def failing(update, context):
+        raise RuntimeError('boom')
+    
+    async def scenario():
+        # Обернутый обработчик замеряется по метке ветки, исключение учитывается и пробрасывается
+        handler = metrics.instrument_handler(failing, route=bot.callback_route)
+        before = metrics.handler_errors.get(handler='finish_round')
+        try:
+            await handler(query_update('finish_round_7'), None)
+            assert False, "исключение должно пробрасываться"
+        except RuntimeError:
+            pass
+        assert metrics.handler_errors.get(handler='finish_round') == before + 1
+        assert metrics.handler_seconds.count(handler='finish_round') >= 1
+        
+        # Операции хранилища замеряются по имени функции
+        def ping():
+            return 'pong'
+        assert await storage.store.read(ping) == 'pong'
+        assert metrics.storage_seconds.count(operation='ping') == 1
+        
+        server = await metrics.start_metrics_server('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            async def get(path):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+                response = await reader.read()
+                writer.close()
+                return response.decode()
+            response = await get('/metrics')
+            assert response.startswith('HTTP/1.1 200') and 'text/plain; version=0.0.4' in response
+            assert 'bot_handler_seconds_bucket{handler="finish_round",le="0.001"}' in response
+            assert 'bot_storage_seconds_count{operation="ping"} 1' in response
+            assert (await get('/')).startswith('HTTP/1.1 404')
+        finally:
+            server.close()
+            await server.wait_closed()
+    
+    asyncio.run(scenario())
+    print("✅ Метрики работают")
+
+def test_profiler():
+    """Тест профилирования по запросу"""
+    print("\n🧪 Тестирование профилировщика...")
+    from types import SimpleNamespace
+    from profiling import Profiler
+    
+    async def slow_handler(update, context):
+        # Синхронная пауза держит цикл событий, как блокирующий вызов
+        time.sleep(0.06)
+        await asyncio.sleep(0)
+    
+    async def fast_handler(update, context):
+        await asyncio.sleep(0)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        profiler = Profiler(slow_threshold=0.05, directory=directory)
+        route = lambda update: update.callback_query.data.rsplit('_', 1)[0]
+        slow = profiler.wrap(slow_handler, route=route)
+        fast = profiler.wrap(fast_handler, 'fast')
+        update = SimpleNamespace(callback_query=SimpleNamespace(data='vote_1'))
+        
+        async def scenario():
+            # Вне сессии обработчики просто выполняются, ничего не записывается
+            await slow(update, None)
+            assert profiler.stop() == (None, None)
+            
+            assert profiler.start() and not profiler.start()
+            await slow(update, None)
+            await fast(update, None)
+            return profiler.stop()
+        
+        report, path = asyncio.run(scenario())
+        assert not profiler.active
+        assert os.path.exists(path) and os.path.exists(path.replace('.prof', '.txt'))
+        assert 'Обработчики дольше 50 мс: 1' in report and ' vote\n' in report
+        assert 'test_bot.py' in report and 'slow_handler' in report
+        assert 'fast' not in report.split('Функции проекта')[0]
+    
+    print("✅ Профилировщик работает")
+
+def test_loop_watchdog():
+    """Тест сторожа цикла событий"""
+    print("\n🧪 Тестирование сторожа цикла событий...")
+    import metrics
+    from loop_watchdog import LoopWatchdog, loop_blocks
+    
+    def blocking_query():
+        # Синхронный вызов внутри корутины, как sqlite3 без потока хранилища
+        time.sleep(0.2)
+    
+    async def handler():
+        blocking_query()
+    
+    async def scenario():
+        watchdog = LoopWatchdog(threshold=0.1, interval=0.01)
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.05)
+            assert not watchdog.blocks
+            await handler()
+            await asyncio.sleep(0.05)
+        finally:
+            await watchdog.stop()
+        return watchdog
+    
+    watchdog = asyncio.run(scenario())
+    # Одна блокировка отмечается один раз, виновник - функция проекта на вершине стека
+    assert len(watchdog.blocks) == 1
+    lag, function, stack = watchdog.blocks[0]
+    assert lag >= 0.1 and function.startswith('test_bot.py:') and function.endswith('(blocking_query)')
+    assert any(frame.name == 'handler' for frame in stack)
+    assert loop_blocks.get(function=function) == 1
+    assert 'bot_event_loop_lag_seconds_bucket{le="0.25"}' in metrics.registry.render()
+    print("✅ Сторож цикла событий работает")
+
 def main():
     """Основная функция тестирования"""
     print("🎬 Тестирование Telegram бота для рекомендаций фильмов\n")
     
     test_genres()
+    test_bracket()
+    test_ttl_cache()
+    test_member_count_cache()
+    test_edit_coalescer()
+    test_round_scheduler()
+    test_update_processor()
+    test_active_games()
+    test_metrics()
+    test_profiler()
+    test_loop_watchdog()
     test_database()
+    test_query_plans()
+    test_maintenance()
+    test_async_store()
+    test_vote_aggregator()
+    test_movie_catalog()
+    test_catalog_index()
     test_message_formatting()
     test_api_connection()
+    test_tmdb_client()
     
     print("\n✅ Все тесты завершены!")
     print("\n📝 Следующие шаги:")
@@ -0,0 +1,83 @@
+import os
+import asyncio
+import logging
+import httpx
+
+from metrics import measure, tmdb_seconds, tmdb_errors
+
+logger = logging.getLogger(__name__)
+
+# Настройки клиента TMDb
+TMDB_BASE_URL = os.getenv('TMDB_BASE_URL', 'https://api.themoviedb.org/3')
+TMDB_TIMEOUT = float(os.getenv('TMDB_TIMEOUT', '10'))
+TMDB_MAX_CONNECTIONS = int(os.getenv('TMDB_MAX_CONNECTIONS', '10'))
+TMDB_MAX_CONCURRENCY = int(os.getenv('TMDB_MAX_CONCURRENCY', '8'))
+
+class TMDbError(Exception):
+    """Ошибка запроса к TMDb API (сеть, таймаут или ответ с ошибкой)"""
+
+class TMDbClient:
+    """Асинхронный клиент TMDb с общим пулом keep-alive соединений.
+
+    Каждый запрос ограничен таймаутом, а количество одновременных запросов -
+    семафором, чтобы всплеск опросников не упирался в лимиты TMDb.
+    """
+
+    def __init__(self, api_key: str, base_url: str = TMDB_BASE_URL, timeout: float = TMDB_TIMEOUT,
+                 max_connections: int = TMDB_MAX_CONNECTIONS, max_concurrency: int = TMDB_MAX_CONCURRENCY,
+                 language: str = 'ru-RU'):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.language = language
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+
+    def _bind_loop(self):
+        """Создание HTTP-клиента и семафора для текущего цикла событий"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+
+    async def get(self, path: str, **params):
+        """GET-запрос к TMDb API, возвращает разобранный JSON"""
+        self._bind_loop()
+        query = {'api_key': self.api_key, 'language': self.language}
+        query.update(params)
+
+        async with self._semaphore:
+            with measure(tmdb_seconds, tmdb_errors, path=path):
+                try:
+                    response = await self._client.get(path, params=query)
+                    response.raise_for_status()
+                    return response.json()
+                except (httpx.HTTPError, ValueError) as e:
+                    raise TMDbError(f"{path}: {e}") from e
+
+    async def discover(self, media_type: str, **params):
+        """Поиск фильмов или сериалов через /discover"""
+        return await self.get(f"/discover/{media_type}", **params)
+
+    async def popular_movies(self, page: int = 1):
+        """Популярные фильмы"""
+        return await self.get("/movie/popular", page=page, include_adult=False)
+
+    async def aclose(self):
+        """Закрытие пула соединений"""
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+        self._loop = None
@@ -0,0 +1,131 @@
+import os
+import asyncio
+import logging
+
+import storage
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Режимы записи голосов на диск
+DURABILITY_VOTE = 'vote'          # каждый голос сохраняется до ответа пользователю
+DURABILITY_ROUND = 'round'        # голоса раунда сохраняются при его завершении
+DURABILITY_INTERVAL = 'interval'  # голоса сохраняются пакетами по таймеру
+DURABILITY_MODES = (DURABILITY_VOTE, DURABILITY_ROUND, DURABILITY_INTERVAL)
+
+VOTE_DURABILITY = os.getenv('VOTE_DURABILITY', DURABILITY_INTERVAL)
+if VOTE_DURABILITY not in DURABILITY_MODES:
+    VOTE_DURABILITY = DURABILITY_INTERVAL
+VOTE_FLUSH_INTERVAL = float(os.getenv('VOTE_FLUSH_INTERVAL', '2'))
+
+# Сколько раундов и как долго держать в памяти; раунды брошенных игр вытесняются сами
+VOTE_ROUNDS_CACHE_SIZE = int(os.getenv('VOTE_ROUNDS_CACHE_SIZE', '10000'))
+VOTE_ROUNDS_TTL = float(os.getenv('VOTE_ROUNDS_TTL', '3600'))
+
+class RoundVotes:
+    """Голоса одного раунда: счетчики по вариантам и проголосовавшие"""
+
+    def __init__(self, rows=()):
+        self.counts = [0, 0]
+        self.voters = {}  # user_id -> выбор (1 или 2) в порядке голосования
+        for user_id, choice in rows:
+            self.add(user_id, choice)
+
+    def add(self, user_id: int, choice: int):
+        """Учет голоса; False, если пользователь уже голосовал"""
+        if user_id in self.voters:
+            return False
+        self.voters[user_id] = choice
+        self.counts[choice - 1] += 1
+        return True
+
+    def __len__(self):
+        return len(self.voters)
+
+class VoteAggregator:
+    """Подсчет голосов в памяти с отложенной пакетной записью в SQLite.
+
+    Голоса хранятся по (game_id, round), проверка повторного голоса и
+    обновление счетчиков выполняются без await, поэтому атомарны в цикле
+    событий. Новые голоса копятся в очереди и сохраняются в таблицу votes
+    одной транзакцией в зависимости от режима durability.
+
+    Раунды хранятся в TTLCache: раунды брошенных или удаленных игр со временем
+    вытесняются, а вытесненный раунд идущей игры восстанавливается из базы
+    данных и очереди несохраненных голосов.
+    """
+
+    def __init__(self, durability: str = VOTE_DURABILITY, max_rounds: int = VOTE_ROUNDS_CACHE_SIZE,
+                 rounds_ttl: float = VOTE_ROUNDS_TTL):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Неизвестный режим сохранения голосов: {durability}")
+        self.durability = durability
+        self.flushes = 0
+        self._rounds = TTLCache(maxsize=max_rounds, ttl=rounds_ttl)  # (game_id, round) -> RoundVotes
+        self._pending = []  # (game_id, round, user_id, choice), еще не сохраненные
+        self._flushing = []  # голоса, которые сохраняются прямо сейчас
+        self._flush_lock = None
+        self._loop = None
+
+    async def get(self, game_id: int, round_num: int):
+        """Голоса раунда; после перезапуска восстанавливаются из базы данных"""
+        key = (game_id, round_num)
+        round_votes = self._rounds.get(key)
+        if round_votes is None:
+            rows = await storage.store.load_round_votes(game_id, round_num)
+            # Добавляем голоса, которые еще не успели попасть на диск
+            rows += [(user_id, choice) for g, r, user_id, choice in self._flushing + self._pending if (g, r) == key]
+            # Пока голоса читались, раунд мог загрузить другой обработчик
+            round_votes = self._rounds.get(key)
+            if round_votes is None:
+                round_votes = RoundVotes(rows)
+                self._rounds.set(key, round_votes)
+        return round_votes
+
+    async def record(self, game_id: int, round_num: int, user_id: int, choice: int):
+        """Регистрация голоса; возвращает голоса раунда или None, если пользователь уже голосовал"""
+        round_votes = await self.get(game_id, round_num)
+        if not round_votes.add(user_id, choice):
+            return None
+        self._pending.append((game_id, round_num, user_id, choice))
+        if self.durability == DURABILITY_VOTE:
+            await self.flush()
+        return round_votes
+
+    async def close_round(self, game_id: int, round_num: int):
+        """Завершение раунда: голоса больше не нужны в памяти"""
+        if self.durability != DURABILITY_INTERVAL:
+            await self.flush()
+        self._rounds.pop((game_id, round_num))
+
+    def _lock(self):
+        """Блокировка сброса для текущего цикла событий"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._flush_lock = asyncio.Lock()
+            self._loop = loop
+        return self._flush_lock
+
+    async def flush(self):
+        """Сохранение накопленных голосов одной транзакцией; возвращает их количество"""
+        async with self._lock():
+            if not self._pending:
+                return 0
+            rows = self._flushing = self._pending
+            self._pending = []
+            try:
+                await storage.store.save_votes(rows)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить {len(rows)} голосов: {e}")
+                # Возвращаем голоса в очередь, чтобы не потерять их при следующем сбросе
+                self._pending = rows + self._pending
+                raise
+            finally:
+                self._flushing = []
+            self.flushes += 1
+            return len(rows)
+
+    @property
+    def pending(self):
+        """Количество еще не сохраненных голосов"""
+        return len(self._pending)